@@ -22,6 +22,7 @@ from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QStyledItemDelegate, QLineEdit
 from PySide6.QtGui import QColor, QBrush
 
+from engine.compiler import parseValue
 import globals_
 
 
@@ -59,17 +60,15 @@ class MyDelegate(QStyledItemDelegate):
             globals_.defaultBackground
             )
         model.setData(index, font, role=Qt.FontRole)
-        model.setData(index, editor.text(), mode='s')
+        model.setData(index, parseValue(editor.text()), mode='s')
         model.setData(index, textColor, role=Qt.ForegroundRole)
         model.setData(index, backColor, role=Qt.BackgroundRole)
-        for f in model.formulas.values():
-            if (index.row(), index.column()) in f.domain:
-                model.setData(
-                    index,
-                    QBrush(QColor(255, 69, 69)),
-                    role=Qt.BackgroundRole
-                    )
-                break
+        if model.writers.queryPoint(index.row(), index.column()):
+            model.setData(
+                index,
+                QBrush(QColor(255, 69, 69)),
+                role=Qt.BackgroundRole
+                )
         self.parent().saveToHistory()
 
 
@@ -18,6 +18,7 @@
 #    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
 # --------------------------------------------------------------------
 
+import contextlib
 import copy
 import weakref
 import gc
@@ -27,27 +28,41 @@ from PySide6.QtCore import (
     QDataStream, QIODevice,
     Qt, QItemSelectionModel, QModelIndex
     )
+from PySide6.QtGui import QFont
+import numpy as np
 
+from engine.formula import Formula
+from engine.graph import CircularReferenceError
+from engine.styles import Palette, StyleLayer
+from engine.workbook import Workbook
 import globals_
-import MyView
+
+
+def brushKey(brush):
+    """Return what tells brushes apart"""
+    return brush.style(), brush.color().rgba()
 
 
 class MyModel(QAbstractTableModel):
     def __init__(self, parent=None):
         """Initialize the model"""
         super().__init__(parent)
-        self.dataContainer = {}
+        self.engine = Workbook()
         self.rows = 52
         self.columns = 52
-        self.formulas = {}
         self.ftoapply = weakref.WeakSet()
         self.formulaSnap = weakref.WeakSet()
+        self.batchDepth = 0
+        self.batchHistory = True
+        self.batchCells = set()
+        self.batchArea = None
         self.highlight = None
         self.domainHighlight = {}
-        self.alignmentDict = {}
-        self.fonts = {}
-        self.background = {}
-        self.foreground = {}
+        brushes = Palette(brushKey)
+        self.alignmentDict = StyleLayer()
+        self.fonts = StyleLayer(palette=Palette(QFont.toString))
+        self.background = StyleLayer(palette=brushes)
+        self.foreground = StyleLayer(palette=brushes)
         self.history = []
         self.history.append((
             self.dataContainer.copy(),
@@ -59,6 +74,57 @@ class MyModel(QAbstractTableModel):
             ))
         self.thousandsSep = True
 
+    @contextlib.contextmanager
+    def batch(self, history=True):
+        """Group edits to recalculate, repaint and save history once
+
+        Inside the batch setData only records the edited cells, on exit
+        the formulas reading any of them are recalculated together, one
+        dataChanged covers every edit and a single history entry is
+        saved unless the outermost batch is opened without history, as
+        for the results of a recalculation level.
+        """
+        if not self.batchDepth:
+            self.batchHistory = history
+        self.batchDepth += 1
+        try:
+            yield
+        finally:
+            self.batchDepth -= 1
+            if not self.batchDepth:
+                self.commitBatch()
+
+    def commitBatch(self):
+        """Apply the edits recorded by the batch just closed"""
+        cells, self.batchCells = self.batchCells, set()
+        area, self.batchArea = self.batchArea, None
+        dirty = set()
+        for row, column in cells:
+            dirty.update(self.readers.queryPoint(row, column))
+        if dirty:
+            main = self.parent().parent()
+            main.executeOrder(main.topologicalSort(dirty))
+        if area is not None:
+            self.dataChanged.emit(
+                self.index(area[0], area[1]),
+                self.index(area[2], area[3])
+                )
+        if self.batchHistory:
+            self.parent().saveToHistory()
+
+    def changed(self, r1, c1, r2, c2):
+        """Emit dataChanged for the range or add it to the batch area"""
+        if not self.batchDepth:
+            self.dataChanged.emit(self.index(r1, c1), self.index(r2, c2))
+        elif self.batchArea is None:
+            self.batchArea = r1, c1, r2, c2
+        else:
+            top, left, bottom, right = self.batchArea
+            self.batchArea = (
+                min(top, r1), min(left, c1),
+                max(bottom, r2), max(right, c2)
+                )
+
     def enableThousandsSep(self):
         """Enable thousands separator"""
         self.thousandsSep = True
@@ -124,7 +190,6 @@ class MyModel(QAbstractTableModel):
             newBottomColumn = rightColumn + newColumnDiff
             selectionModel = self.parent().selectionModel()
             selectionModel.clearSelection()
-            self.formulaSnap.update(self.formulas.values())
             if newRowDiff > 0:
                 if newRowDiff >= (bottomRow - topRow + 1):
                     beginRow = topRow
@@ -151,113 +216,48 @@ class MyModel(QAbstractTableModel):
                 beginColumn = leftColumn
                 endColumn = rightColumn + 1
                 stepColumn = 1
-            for row in range(beginRow, endRow, stepRow):
-                for column in range(beginColumn, endColumn, stepColumn):
-                    movedIndex = self.index(
-                        row + newRowDiff,
-                        column + newColumnDiff
-                        )
-                    self.setData(
-                        movedIndex,
-                        self.dataContainer.get((row, column), ''),
-                        mode='m'
-                        )
-                    if action == Qt.MoveAction:
-                        if self.formulas.get((row, column), None):
-                            possibleF = MyView.Formula(
-                                self.formulas[row, column]
-                                )
-                            try:
-                                self.checkForCircularRef(
-                                    possibleF,
-                                    newRowDiff,
-                                    newColumnDiff
+            with self.batch():
+                for row in range(beginRow, endRow, stepRow):
+                    for column in range(beginColumn, endColumn, stepColumn):
+                        movedIndex = self.index(
+                            row + newRowDiff,
+                            column + newColumnDiff
+                            )
+                        self.setData(
+                            movedIndex,
+                            self.dataContainer.get((row, column), ''),
+                            mode='m'
+                            )
+                        if action == Qt.MoveAction:
+                            if self.formulas.get((row, column), None):
+                                possibleF = Formula(
+                                    self.formulas[row, column]
                                     )
-                            except Exception as e:
-                                print(e)
-                            else:
-                                origRow = possibleF.row - newRowDiff
-                                origCol = possibleF.col - newColumnDiff
-                                for f in self.ftoapply:
-                                    if f.row == origRow:
-                                        if f.col == origCol:
-                                            self.ftoapply.add(possibleF)
-                                            break
-                                f = None
-                                del self.formulas[row, column]
-                                self.formulas[
-                                        possibleF.row,
-                                        possibleF.col] = possibleF
-                                self.formulaSnap.update(self.formulas.values())
-                        if not self.formulas.get((row, column)):
-                            self.setData(
-                                self.index(row, column),
-                                '',
-                                mode='m'
-                                )
-                    selectionModel.select(
-                        movedIndex,
-                        QItemSelectionModel.Select
-                        )
-            gc.collect()
-            if self.ftoapply:
-                main = self.parent().parent()
-                order = main.topologicalSort(self.ftoapply)
-                main.executeOrder(order)
-                self.ftoapply.clear()
-            self.dataChanged.emit(
-                self.index(topRow, leftColumn),
-                self.index(newBottomRow, newBottomColumn)
-                )
-            self.formulaSnap.clear()
+                                try:
+                                    self.engine.moveFormula(
+                                        possibleF,
+                                        newRowDiff,
+                                        newColumnDiff
+                                        )
+                                except Exception as e:
+                                    print(e)
+                                else:
+                                    self.removeFormula(row, column)
+                                    self.addFormula(possibleF)
+                            if not self.formulas.get((row, column)):
+                                self.setData(
+                                    self.index(row, column),
+                                    '',
+                                    mode='m'
+                                    )
+                        selectionModel.select(
+                            movedIndex,
+                            QItemSelectionModel.Select
+                            )
+                gc.collect()
+                self.changed(topRow, leftColumn, newBottomRow, newBottomColumn)
             return True
 
-    def checkForCircularRef(self, formula, *deltas):
-        """Check circular reference when formula is to be dropped"""
-        rowsDomain = []
-        columnsDomain = []
-        newRowDiff = deltas[0]
-        newColumnDiff = deltas[1]
-        for index in formula.domain:
-            rowsDomain.append(index[0])
-            columnsDomain.append(index[1])
-        topLeftDomain = [min(rowsDomain), min(columnsDomain)]
-        bottomRightDomain = [max(rowsDomain), max(columnsDomain)]
-        topLeftDomain[0] = topLeftDomain[0] + newRowDiff
-        topLeftDomain[1] = topLeftDomain[1] + newColumnDiff
-        bottomRightDomain[0] = bottomRightDomain[0] + newRowDiff
-        bottomRightDomain[1] = bottomRightDomain[1] + newColumnDiff
-        newDomain = []
-        for row in range(
-                topLeftDomain[0], bottomRightDomain[0] + 1):
-            for column in range(
-                    topLeftDomain[1], bottomRightDomain[1] + 1):
-                newDomain.append((row, column))
-        formulaIndexesSet = set(formula.indexes)
-        newDomainSet = set(newDomain)
-        if formulaIndexesSet.intersection(newDomainSet):
-            raise CircularReferenceError(
-                formula.row, formula.col
-                )
-        formula.precedence.clear()
-        for f_ in self.formulas.values():
-            f_Domain = set(f_.domain)
-            f_Indexes = set(f_.indexes)
-            if newDomainSet.intersection(f_Indexes):
-                formula.precedence.add(f_)
-                f_.subsequent.add(formula)
-            if formulaIndexesSet.intersection(f_Domain):
-                f_.precedence.add(formula)
-        if formula.precedence.intersection(formula.subsequent):
-            raise CircularReferenceError(
-                formula.row,
-                formula.col
-                )
-        self.parent().circularReferenceCheck(formula)
-        formula.domain = newDomain
-        formula.row = formula.row + newRowDiff
-        formula.col = formula.col + newColumnDiff
-
     def columnCount(self, parent=QModelIndex()):
         """Return number of columns"""
         return self.columns
@@ -299,6 +299,61 @@ class MyModel(QAbstractTableModel):
                 ]
             return letter1 + letter2 + letter3 + str(row + 1)
 
+    @property
+    def dataContainer(self):
+        """Return the cells mapping of the engine"""
+        return self.engine.cells
+
+    @dataContainer.setter
+    def dataContainer(self, cells):
+        """Replace the cells mapping of the engine"""
+        self.engine.cells = cells
+
+    @property
+    def store(self):
+        """Return the numeric store of the engine"""
+        return self.engine.store
+
+    @property
+    def formulas(self):
+        """Return the formulas mapping of the engine"""
+        return self.engine.formulas
+
+    @formulas.setter
+    def formulas(self, formulas):
+        """Replace the formulas mapping of the engine"""
+        self.engine.formulas = formulas
+
+    @property
+    def readers(self):
+        """Return the index of the ranges read by formulas"""
+        return self.engine.readers
+
+    @property
+    def writers(self):
+        """Return the index of the ranges written by formulas"""
+        return self.engine.writers
+
+    def addFormula(self, formula):
+        """Store formula at its address replacing the previous one"""
+        self.engine.addFormula(formula)
+
+    def removeFormula(self, row, column):
+        """Remove the formula stored at the given address if any"""
+        self.engine.removeFormula(row, column)
+
+    def writersOf(self, rects):
+        """Return the formulas whose domain intersects any of rects"""
+        return self.engine.writersOf(rects)
+
+    def gatherRange(self, r1, c1, r2, c2):
+        """Return the values of the given cell range as a numpy array"""
+        return self.engine.gatherRange(r1, c1, r2, c2)
+
+    def cellValue(self, row, column):
+        """Return the raw value stored at the given cell"""
+        return self.engine.cellValue(row, column)
+
     def data(self, index, role=Qt.DisplayRole):
         """Return the appropiate data for the corresponding role"""
         if role == Qt.DisplayRole:
@@ -306,10 +361,12 @@ class MyModel(QAbstractTableModel):
                 (index.row(), index.column()),
                 ''
                 )
+            if isinstance(returnValue, str):
+                return returnValue
             if hasattr(returnValue, "ndim") and returnValue.ndim > 0:
                 return f'array {returnValue.shape}'
-            elif returnValue == '':
-                return ''
+            if isinstance(returnValue, (bool, np.bool_)):
+                return str(bool(returnValue))
             try:
                 returnValue = complex(returnValue)
                 if returnValue.imag == 0:
@@ -331,8 +388,8 @@ class MyModel(QAbstractTableModel):
                                 )
                 else:
                     return str(returnValue).strip('()')
-            except ValueError:
-                return returnValue
+            except (TypeError, ValueError):
+                return str(returnValue)
         if role == Qt.BackgroundRole:
             if self.highlight:
                 if index.row() == self.highlight[0][0]:
@@ -375,34 +432,40 @@ class MyModel(QAbstractTableModel):
         if role == Qt.EditRole:
             if str(value) == self.data(index):
                 return True
-            if hasattr(value, "ndim"):
-                self.dataContainer[(index.row(), index.column())] = value
-            elif value != '':
-                self.dataContainer[(index.row(), index.column())] = value
+            stored = hasattr(value, "ndim") or value != ''
+            if stored:
+                self.engine.setCell(index.row(), index.column(), value)
             elif erase == 'y':
-                if (index.row(), index.column()) in self.dataContainer:
-                    del self.dataContainer[index.row(), index.column()]
+                self.engine.clearCell(index.row(), index.column())
+            if mode != 'a' and (stored or erase == 'y'):
+                trace = self.engine.trace
+                if trace is not None:
+                    trace.edit(index.row(), index.column(), value)
+            if self.batchDepth:
+                row, column = index.row(), index.column()
+                self.changed(row, column, row, column)
+                if mode != 'a':
+                    if erase == 'y':
+                        self.removeFormula(row, column)
+                    self.batchCells.add((row, column))
+                return True
             try:
                 assert self.formulas
             except AssertionError:
                 return True
             if mode == 'm':
                 if erase == 'y':
-                    if self.formulas.get(
-                            (index.row(), index.column()), None):
-                        del self.formulas[index.row(), index.column()]
-                for f in self.formulaSnap.copy():
-                    if (index.row(), index.column()) in f.indexes:
+                    self.removeFormula(index.row(), index.column())
+                for f in self.readers.queryPoint(index.row(), index.column()):
+                    if f in self.formulaSnap:
                         self.ftoapply.add(f)
                         self.formulaSnap.remove(f)
             elif mode == 's':
                 if erase == 'y':
-                    if self.formulas.get(
-                            (index.row(), index.column()), None):
-                        del self.formulas[index.row(), index.column()]
-                for f in self.formulas.values():
-                    if (index.row(), index.column()) in f.indexes:
-                        self.ftoapply.add(f)
+                    self.removeFormula(index.row(), index.column())
+                self.ftoapply.update(
+                    self.readers.queryPoint(index.row(), index.column())
+                    )
                 if self.ftoapply:
                     main = self.parent().parent()
                     order = main.topologicalSort(self.ftoapply)
@@ -429,6 +492,26 @@ class MyModel(QAbstractTableModel):
             self.foreground[index.row(), index.column()] = value
             return True
 
+    def setBlock(self, row, column, array, font=None):
+        """Write an array result and its font in one operation
+
+        One dimensional arrays are written as a column, the model grows
+        once to fit the block and a single dataChanged is emitted.
+        """
+        if array.ndim == 1:
+            array = array.reshape(-1, 1)
+        nRows, nCols = array.shape
+        if (rowsToAdd := row + nRows - self.rowCount()) > 0:
+            self.insertRows(self.rowCount(), rowsToAdd)
+        if (columnsToAdd := column + nCols - self.columnCount()) > 0:
+            self.insertColumns(self.columnCount(), columnsToAdd)
+        self.engine.setBlock(row, column, array)
+        if font is not None:
+            rect = (row, column, row + nRows - 1, column + nCols - 1)
+            if font != globals_.defaultFont or self.fonts.overlaps(*rect):
+                self.fonts.setRange(*rect, font)
+        self.changed(row, column, row + nRows - 1, column + nCols - 1)
+
     def flags(self, index):
         """Return allowed flags for model"""
         if index.isValid():
@@ -470,16 +553,3 @@ class MyModel(QAbstractTableModel):
             if role == Qt.DisplayRole:
                 return section+1
 
-
-class CircularReferenceError(Exception):
-    def __init__(self, row, column):
-        self.formulaRow = row
-        self.formulaColumn = column
-
-    def __str__(self):
-        errorInfo = \
-            "(row {}, column {}), creates a circular reference".format(
-                self.formulaRow,
-                self.formulaColumn
-                )
-        return errorInfo
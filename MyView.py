@@ -19,7 +19,6 @@
 # --------------------------------------------------------------------
 
 import copy
-import weakref
 import gc
 
 from PySide6.QtCore import Qt, QEvent, QPoint, QRect, QSize, QTimer
@@ -30,6 +29,8 @@ from PySide6.QtWidgets import (
 from PySide6.QtGui import QColor, QPainter, QPen, QBrush
 
 from MyModel import CircularReferenceError
+from engine.formula import Formula
+from engine.spatial import cells
 import globals_
 
 
@@ -164,7 +165,7 @@ class MyView(QTableView):
                         (index.row(), index.column()), None):
                     lineEdit.setText('='+f.text)
                     globals_.domainHighlight = True
-                    for d in f.domain:
+                    for d in cells(f.domain):
                         coloredIndex = self.model().index(d[0], d[1])
                         self.model().setData(
                             coloredIndex,
@@ -295,89 +296,22 @@ class MyView(QTableView):
         super().selectionChanged(selected, deselected)
         self.overlay.createRect()
 
-    def createFormula(self, text, arrayRanges, scalars, domain):
+    def createFormula(self, text, arrayRanges, scalars, domain, compiled=None):
         """Check formula integrity and call the formula constructor"""
-        indexes = []
-        precedence = weakref.WeakSet()
-        subsequent = weakref.WeakSet()
-        for array in arrayRanges:
-            rowLimit1 = array[0][0]
-            rowLimit2 = array[1][0] + 1
-            columnLimit1 = array[0][1]
-            columnLimit2 = array[1][1] + 1
-            for row in range(rowLimit1, rowLimit2):
-                for column in range(columnLimit1, columnLimit2):
-                    indexes.append((row, column))
-        if scalars:
-            indexes += scalars
-        domainIndexes = []
+        indexes = [(r1, c1, r2, c2) for (r1, c1), (r2, c2) in arrayRanges]
+        indexes += [(row, column, row, column) for row, column in scalars]
         rowIdx = domain['rowIdx']
         nRows = domain['nRows']
         colIdx = domain['colIdx']
         nCols = domain['nCols']
-        address = rowIdx, colIdx
-        for row in range(rowIdx, rowIdx+nRows):
-            for column in range(
-                    colIdx,
-                    colIdx
-                    + nCols):
-                domainIndexes.append((row, column))
-        possibleF = Formula(
+        domainRect = (rowIdx, colIdx, rowIdx + nRows - 1, colIdx + nCols - 1)
+        self.model().engine.createFormula(
             text,
-            address,
+            (rowIdx, colIdx),
             indexes,
-            domainIndexes,
-            precedence,
-            subsequent
+            (domainRect,),
+            compiled
             )
-        indexesSet = set(indexes)
-        domainIndexesSet = set(domainIndexes)
-        if indexesSet.intersection(domainIndexesSet):
-            raise CircularReferenceError(rowIdx, colIdx)
-        if self.model().formulas:
-            for f_ in self.model().formulas.values():
-                formulaIndexSet = set(f_.indexes)
-                formulaDomainSet = set(f_.domain)
-                if domainIndexesSet.intersection(formulaIndexSet):
-                    possibleF.precedence.add(f_)
-                    f_.subsequent.add(possibleF)
-                if indexesSet.intersection(formulaDomainSet):
-                    possibleF.subsequent.add(f_)
-                    f_.precedence.add(possibleF)
-                if possibleF.precedence.intersection(possibleF.subsequent):
-                    raise CircularReferenceError(
-                            rowIdx,
-                            colIdx
-                            )
-            self.circularReferenceCheck(possibleF)
-            if f_ := self.model().formulas.get(
-                    (rowIdx, colIdx), None):
-                if f_.text != text:
-                    self.model().formulas[rowIdx, colIdx]\
-                        = possibleF
-            else:
-                self.model().formulas[rowIdx, colIdx] \
-                    = possibleF
-        else:
-            self.model().formulas[rowIdx, colIdx] \
-                = possibleF
-
-    def circularReferenceCheck(self, possibleF):
-        """Check for circular references"""
-        marked = set()
-
-        def dfs(f):
-            marked.add(f)
-            if possibleF in f.precedence:
-                raise CircularReferenceError(
-                    possibleF.row,
-                    possibleF.col
-                    )
-            else:
-                for n in f.precedence:
-                    if n not in marked and n.precedence:
-                        dfs(n)
-        dfs(possibleF)
 
     def startDrag(self, supportedActions):
         """Begin dragging operation"""
@@ -433,8 +367,14 @@ class MyView(QTableView):
                         self.hScrollBar.maximum()
                         )
 
-    def saveToHistory(self):
-        """Save current model and formulas state up to 5 instances"""
+    def saveToHistory(self, amend=False):
+        """Save current model and formulas state up to 5 instances
+
+        With amend the newest instance is replaced, as long as nothing
+        was undone since it was saved.
+        """
+        if amend and self.model().history and globals_.historyIndex == -1:
+            self.model().history.pop()
         if len(self.model().history) == 5:
             self.model().history = self.model().history[1:]
         data = self.model().dataContainer.copy()
@@ -453,6 +393,7 @@ class MyView(QTableView):
         """Basic redo functionality"""
         if globals_.historyIndex == -1:
             return
+        self.parent().cancelRecalc()
         globals_.historyIndex += 1
         model = self.model().history[globals_.historyIndex]
         data = model[0]
@@ -478,6 +419,7 @@ class MyView(QTableView):
         """Basic undo functionality"""
         if globals_.historyIndex + len(self.model().history) == 0:
             return
+        self.parent().cancelRecalc()
         globals_.historyIndex -= 1
         model = self.model().history[globals_.historyIndex]
         data = model[0]
@@ -508,27 +450,10 @@ class MyView(QTableView):
                 self.model().history = self.model().history[:hIndex]
             selectionModel = self.selectionModel()
             selectedIndexes = selectionModel.selectedIndexes()
-            rows = []
-            columns = []
-            self.model().formulaSnap.update(self.model().formulas.values())
-            for selIndex in selectedIndexes:
-                self.model().setData(selIndex, '', mode='m')
-                rows.append(selIndex.row())
-                columns.append(selIndex.column())
-            gc.collect()
-            if self.model().ftoapply:
-                main = self.parent()
-                order = main.topologicalSort(self.model().ftoapply)
-                main.executeOrder(order)
-                self.model().ftoapply.clear()
-            minRow = min(rows)
-            minColumn = min(columns)
-            maxRow = max(rows)
-            maxColumn = max(columns)
-            minIndex = self.model().index(minRow, minColumn)
-            maxIndex = self.model().index(maxRow, maxColumn)
-            self.model().dataChanged.emit(minIndex, maxIndex)
-            self.saveToHistory()
+            with self.model().batch():
+                for selIndex in selectedIndexes:
+                    self.model().setData(selIndex, '', mode='m')
+                gc.collect()
         elif event.modifiers() == Qt.ControlModifier:
             if event.key() == Qt.Key_Z:
                 self.undo()
@@ -544,22 +469,11 @@ class MyView(QTableView):
                             index2copy.row(),
                             index2copy.column()
                             ]
-                        self.model().formulaSnap.update(
-                            self.model().formulas.values()
-                            )
-                        for ind in selected[1:]:
-                            self.model().setData(
-                                ind, data2copy, mode='m'
-                                )
-                        if self.model().ftoapply:
-                            main = self.parent()
-                            order = main.topologicalSort(self.ftoapply)
-                            main.executeOrder(order)
-                            self.model().ftoapply.clear()
-                        self.saveToHistory()
-                        self.model().dataChanged.emit(
-                            selected[0],
-                            selected[-1])
+                        with self.model().batch():
+                            for ind in selected[1:]:
+                                self.model().setData(
+                                    ind, data2copy, mode='m'
+                                    )
                     elif len(selected) == 1:
                         rowIdx = selected[0].row()
                         colIdx = selected[0].column()
@@ -570,7 +484,8 @@ class MyView(QTableView):
                                 fcomp.text,
                                 rowIdx,
                                 colIdx,
-                                com=True
+                                com=True,
+                                compiled=fcomp.compiled
                                 )
 
             else:
@@ -717,28 +632,3 @@ class Overlay(QWidget):
             painter.setBrush(brush)
             painter.drawRect(self.rect_)
             painter.end()
-
-
-class Formula():
-    def __init__(self, *args):
-        """Constructor for Formula object"""
-        if len(args) > 1:
-            self.text = args[0]
-            self.row = args[1][0]
-            self.col = args[1][1]
-            self.indexes = tuple(args[2])
-            self.domain = tuple(args[3])
-            self.precedence = args[4]
-            self.subsequent = args[5]
-        elif len(args) == 1:
-            self.text = args[0].text
-            self.row = args[0].row
-            self.col = args[0].col
-            self.indexes = args[0].indexes
-            self.domain = args[0].domain
-            self.precedence = args[0].precedence
-            self.subsequent = args[0].subsequent
-        weakref.finalize(self, print, 'Formula {} killed'.format(self.text))
-
-    def __repr__(self):
-        return self.text
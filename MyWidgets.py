@@ -18,18 +18,20 @@
 #    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
 # --------------------------------------------------------------------
 
+import os
 import platform
+import time
 import numbers
 import traceback
-import random
 import csv
 import pickle
 import copy
-import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from PySide6.QtCore import (
     QTimer, QSize,
-    QEvent, Qt, Signal
+    QEvent, Qt, Signal,
+    QObject, QRunnable, QThreadPool
     )
 from PySide6.QtWidgets import (
     QMainWindow, QLineEdit, QToolBar,
@@ -38,7 +40,8 @@ from PySide6.QtWidgets import (
     QPushButton, QVBoxLayout, QWidget,
     QGridLayout, QGraphicsScene, QGraphicsView,
     QSplitter, QStackedWidget, QCheckBox,
-    QSpinBox
+    QSpinBox, QInputDialog, QDockWidget,
+    QTableWidget, QTableWidgetItem, QHBoxLayout
     )
 from PySide6.QtGui import (
     QAction, QGuiApplication,
@@ -62,12 +65,20 @@ import numpy as np
 from MyView import MyView
 from MyModel import MyModel
 from MyDelegate import MyDelegate
+from engine import graph, scheduler, vnp
+from engine.trace import TraceWriter
+from engine.compiler import CompiledFormula, getCoord, parseValue
+from engine.cache import ResultCache
+from engine.processes import ProcessPool
+from engine.profiler import PHASES, Profiler
+from engine.pager import Pager
+from engine.store import GatherCache
+from engine.styles import END
+from engine.vnp import FILE_VERSION, MAGIC_NUMBER
 import rcIcons
 import globals_
 
 version = '3.1.1-alpha'
-MAGIC_NUMBER = 0x2384E
-FILE_VERSION = 4
 
 
 class MainWindow(QMainWindow):
@@ -80,9 +91,20 @@ class MainWindow(QMainWindow):
         """Initialize  MainWindow widgets and actions"""
         super().__init__(parent)
         self.plotMenu = None
+        self.executor = None
+        self.processes = ProcessPool()
+        self.results = ResultCache(globals_.cacheBudget)
+        self.profiler = Profiler()
+        self.recalcGeneration = 0
+        self.recalcLevels = []
+        self.recalcPending = set()
+        self.recalcTotal = 0
+        self.recalcTask = None
+        self.recalcGathers = None
         self.commandLineEdit = CommandLineEdit()
         self.view = MyView(self)
         self.view.setModel(MyModel(self.view))
+        self.view.model().engine.profiler = self.profiler
         self.view.setItemDelegate(MyDelegate(self.view))
         self.setCentralWidget(self.view)
         self.fontColor = QPushButton(self)
@@ -227,6 +249,51 @@ class MainWindow(QMainWindow):
         self.alignmentGroup2.addAction(self.alignU)
         self.alignmentGroup2.addAction(self.alignM)
         self.alignmentGroup2.addAction(self.alignD)
+        self.profilerPanel = ProfilerPanel(self.profiler, self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.profilerPanel)
+        self.profilerPanel.hide()
+        workers = QAction('Worker threads', self)
+        workers.setStatusTip('Set the threads used to recalculate formulas')
+        workers.triggered.connect(self.setWorkers)
+        cacheBudget = QAction('Result cache size', self)
+        cacheBudget.setStatusTip('Set the memory kept for formula results')
+        cacheBudget.triggered.connect(self.setCacheBudget)
+        residentTiles = QAction('Resident tiles', self)
+        residentTiles.setStatusTip(
+            'Set the cell tiles kept in memory, the others are spilled'
+            )
+        residentTiles.triggered.connect(self.setResidentTiles)
+        self.processMode = QAction('Use worker processes', self)
+        self.processMode.setStatusTip(
+            'Evaluate every formula of the workbook in worker processes'
+            )
+        self.processMode.setCheckable(True)
+        self.processMode.toggled.connect(self.setProcessMode)
+        processFormulas = QAction('Toggle worker processes', self)
+        processFormulas.setStatusTip(
+            'Evaluate the selected formulas in worker processes or not'
+            )
+        processFormulas.triggered.connect(self.toggleProcessFormulas)
+        self.mapAction = QAction('Keep cells on disk', self)
+        self.mapAction.setStatusTip(
+            'Map the cells to files in a working directory'
+            )
+        self.mapAction.setCheckable(True)
+        self.mapAction.toggled.connect(self.mapCells)
+        self.traceAction = QAction('Record trace', self)
+        self.traceAction.setStatusTip(
+            'Record every recalculation to a file that can be replayed'
+            )
+        self.traceAction.setCheckable(True)
+        self.traceAction.toggled.connect(self.recordTrace)
+        defineFunction = QAction('Define function', self)
+        defineFunction.setStatusTip(
+            'Define a function formulas can call by its name'
+            )
+        defineFunction.triggered.connect(self.defineFunction)
+        removeFunction = QAction('Remove function', self)
+        removeFunction.setStatusTip('Remove a user defined function')
+        removeFunction.triggered.connect(self.removeFunction)
         about = QAction('&About', self)
         about.setStatusTip('Show about information')
         about.triggered.connect(self.helpAbout)
@@ -244,6 +311,20 @@ class MainWindow(QMainWindow):
         plotMenu.addAction(plot)
         formatMenu = mainMenu.addMenu('For&mat')
         formatMenu.addAction(thsndsSep)
+        calculationMenu = mainMenu.addMenu('&Calculation')
+        calculationMenu.addAction(workers)
+        calculationMenu.addAction(cacheBudget)
+        calculationMenu.addAction(residentTiles)
+        calculationMenu.addAction(self.mapAction)
+        calculationMenu.addSeparator()
+        calculationMenu.addAction(self.processMode)
+        calculationMenu.addAction(processFormulas)
+        calculationMenu.addSeparator()
+        calculationMenu.addAction(defineFunction)
+        calculationMenu.addAction(removeFunction)
+        calculationMenu.addSeparator()
+        calculationMenu.addAction(self.profilerPanel.toggleViewAction())
+        calculationMenu.addAction(self.traceAction)
         helpMenu = self.menuBar().addMenu('&Help')
         helpMenu.addAction(about)
         toolBar = QToolBar('Command Toolbar')
@@ -313,8 +394,13 @@ class MainWindow(QMainWindow):
 
     def createNew(self):
         """Create a new file and clear history"""
+        self.cancelRecalc()
+        self.processMode.setChecked(False)
+        self.traceAction.setChecked(False)
+        self.view.model().engine.functions.load({})
+        self.results.clear()
         self.view.model().dataContainer = {}
-        self.view.model().formulas.clear()
+        self.view.model().formulas = {}
         self.view.model().alignmentDict.clear()
         self.view.model().fonts.clear()
         self.view.model().foreground.clear()
@@ -344,8 +430,13 @@ class MainWindow(QMainWindow):
             try:
                 with open(name, encoding='latin', newline='') as myFile:
                     reader = csv.reader(myFile, dialect='excel')
+                    self.cancelRecalc()
+                    self.processMode.setChecked(False)
+                    self.traceAction.setChecked(False)
+                    self.view.model().engine.functions.load({})
+                    self.results.clear()
                     self.view.model().dataContainer = {}
-                    self.view.model().formulas.clear()
+                    self.view.model().formulas = {}
                     self.view.model().alignmentDict.clear()
                     self.view.model().fonts.clear()
                     self.view.model().foreground.clear()
@@ -359,25 +450,21 @@ class MainWindow(QMainWindow):
                         self.view.model().foreground.copy(),
                         self.view.model().background.copy()
                         ))
-                    for rowNumber, row in enumerate(reader):
-                        for columnNumber, column in enumerate(row):
-                            index = \
-                                self.view.model().createIndex(
-                                    rowNumber,
-                                    columnNumber
+                    with self.view.model().batch():
+                        for rowNumber, row in enumerate(reader):
+                            for columnNumber, column in enumerate(row):
+                                index = \
+                                    self.view.model().createIndex(
+                                        rowNumber,
+                                        columnNumber
+                                        )
+                                self.view.model().setData(
+                                    index, parseValue(column),
+                                    mode='a'
                                     )
-                            self.view.model().setData(
-                                index, column,
-                                mode='a'
-                                )
-                    self.view.model().dataChanged.emit(
-                        self.view.model().index(0, 0),
-                        index
-                        )
                 MainWindow.currentFile = name
                 info = name+' was succesfully imported'
                 self.statusBar().showMessage(info, 5000)
-                self.view.saveToHistory()
             except Exception as e:
                 print(e)
                 info = 'There was an error importing '+name
@@ -405,16 +492,14 @@ class MainWindow(QMainWindow):
                     )
         if name:
             name = name.replace('.vnp', '')
-            model = self.view.model().dataContainer
-            alignment = self.view.model().alignmentDict
-            fonts = self.view.model().fonts.copy()
-            foreground = self.view.model().foreground.copy()
-            background = self.view.model().background.copy()
-            self.encodeFonts(fonts)
-            self.encodeColors(foreground)
-            self.encodeColors(background)
+            model = dict(self.view.model().dataContainer.items())
+            alignment = self.view.model().alignmentDict.entries()
+            fonts = self.encodeFonts(self.view.model().fonts)
+            foreground = self.encodeColors(self.view.model().foreground)
+            background = self.encodeColors(self.view.model().background)
             formulas = copy.deepcopy(self.view.model().formulas)
             self.prepareFormulas(formulas)
+            functions = self.view.model().engine.functions.sources()
             with open(name+'.vnp', 'wb') as myFile:
                 pickle.dump(MAGIC_NUMBER, myFile)
                 pickle.dump(FILE_VERSION, myFile)
@@ -424,32 +509,39 @@ class MainWindow(QMainWindow):
                 pickle.dump(fonts, myFile)
                 pickle.dump(foreground, myFile)
                 pickle.dump(background, myFile)
+                pickle.dump(functions, myFile)
             info = name + ' was succesfully saved'
             self.statusBar().showMessage(info, 5000)
             MainWindow.currentFile = name
 
     def encodeFonts(self, fonts):
         """Encode font objects so they can be pickled"""
-        for i, f in fonts.items():
-            fonts[i] = f.toString()
+        return fonts.map(QFont.toString).entries()
 
     def encodeColors(self, brushes):
         """Encode colors so they can be pickled"""
-        for i, b in brushes.items():
-            color = b.color().name()
-            brushes[i] = color
+        return brushes.map(lambda b: b.color().name()).entries()
 
     def decodeFonts(self, fonts):
-        """Decode fonts so they can be used"""
-        for i, f in fonts.items():
-            fonts[i] = QFont()
-            fonts[i].fromString(f)
+        """Decode fonts so they can be used, once per distinct font"""
+        decoded = {}
+
+        def decode(f):
+            if f not in decoded:
+                decoded[f] = QFont()
+                decoded[f].fromString(f)
+            return decoded[f]
+        return fonts.map(decode, self.view.model().fonts.palette)
 
     def decodeColors(self, colors):
-        """Decode colors so they can be used"""
-        for i, c in colors.items():
-            brush = QBrush(QColor(c))
-            colors[i] = brush
+        """Decode colors so they can be used, once per distinct color"""
+        decoded = {}
+
+        def decode(c):
+            if c not in decoded:
+                decoded[c] = QBrush(QColor(c))
+            return decoded[c]
+        return colors.map(decode, self.view.model().foreground.palette)
 
     def copyAction(self):
         """Basic copy action funcionality"""
@@ -560,23 +652,14 @@ class MainWindow(QMainWindow):
             height = bottomRow - topRow + 1
             width = rightColumn - leftColumn + 1
             if height * width == len(selected):
-                # Provides numpy < 2.0 compatibility
-                if hasattr(np, 'complex_'):
-                    array = np.zeros((height, width), dtype=np.complex_)
-                else:
-                    array = np.zeros((height, width), dtype=np.complex128)
-                for y, row in enumerate(range(topRow, bottomRow+1)):
-                    for x, column in enumerate(
-                            range(leftColumn, rightColumn+1)):
-                        try:
-                            number = complex(
-                                self.view.model().data(
-                                    self.view.model().index(row, column)))
-                        except ValueError:
-                            info = 'There was an error while saving array'
-                            self.statusBar().showMessage(info, 5000)
-                            return
-                        array[y, x] = number
+                try:
+                    array = self.view.model().gatherRange(
+                        topRow, leftColumn, bottomRow, rightColumn
+                        )
+                except ValueError:
+                    info = 'There was an error while saving array'
+                    self.statusBar().showMessage(info, 5000)
+                    return
                 np.save(name, array)
                 info = name + ' was succesfully saved'
                 self.statusBar().showMessage(info, 5000)
@@ -592,53 +675,53 @@ class MainWindow(QMainWindow):
             name = file
         if name:
             try:
-                with open(name, 'rb') as myFile:
-                    magic = pickle.load(myFile)
-                    if magic != MAGIC_NUMBER:
-                        raise IOError('File type not recognized')
-                    fVer = pickle.load(myFile)
-                    if fVer != FILE_VERSION:
-                        raise IOError('File version not supported')
-                    loadedModel = pickle.load(myFile)
-                    formulas = pickle.load(myFile)
-                    alignment = pickle.load(myFile)
-                    fonts = pickle.load(myFile)
-                    foreground = pickle.load(myFile)
-                    background = pickle.load(myFile)
-                    self.decodeFonts(fonts)
-                    self.decodeColors(foreground)
-                    self.decodeColors(background)
-                    self.view.model().dataContainer = loadedModel
-                    self.view.model().alignmentDict = alignment
-                    self.view.model().fonts = fonts
-                    self.view.model().foreground = foreground
-                    self.view.model().background = background
-                    self.view.model().formulas.clear()
-                    self.view.model().history.clear()
-                    self.rebuildFormulas(formulas)
-                    self.view.model().formulas = formulas
-                    rows = (max(v[0] for v in loadedModel.keys()))
-                    columns = (max(v[1] for v in loadedModel.keys()))
-                    currentRows = self.view.model().rowCount()
-                    currentColumns = self.view.model().columnCount()
-                    if (rowsToAdd := (rows + 1) - currentRows) > 0:
-                        self.view.model().insertRows(currentRows, rowsToAdd)
-                    if (columnsToAdd := (columns + 1) - currentColumns) > 0:
-                        self.view.model().insertColumns(
-                            currentColumns, columnsToAdd
-                            )
-                    self.view.model().dataChanged.emit(
-                        self.view.model().index(0, 0),
-                        self.view.model().index(rows, columns)
+                sections = vnp.read(name)
+                loadedModel = sections['cells']
+                formulas = sections['formulas']
+                alignment = sections['alignment']
+                fonts = sections['fonts']
+                foreground = sections['foreground']
+                background = sections['background']
+                functions = sections['functions']
+                fonts = self.decodeFonts(fonts)
+                foreground = self.decodeColors(foreground)
+                background = self.decodeColors(background)
+                self.cancelRecalc()
+                self.processMode.setChecked(False)
+                self.traceAction.setChecked(False)
+                self.view.model().engine.functions.load(functions)
+                self.results.clear()
+                self.view.model().dataContainer = loadedModel
+                self.view.model().alignmentDict = alignment
+                self.view.model().fonts = fonts
+                self.view.model().foreground = foreground
+                self.view.model().background = background
+                self.view.model().formulas = {}
+                self.view.model().history.clear()
+                self.rebuildFormulas(formulas)
+                self.view.model().formulas = formulas
+                rows = (max(v[0] for v in loadedModel.keys()))
+                columns = (max(v[1] for v in loadedModel.keys()))
+                currentRows = self.view.model().rowCount()
+                currentColumns = self.view.model().columnCount()
+                if (rowsToAdd := (rows + 1) - currentRows) > 0:
+                    self.view.model().insertRows(currentRows, rowsToAdd)
+                if (columnsToAdd := (columns + 1) - currentColumns) > 0:
+                    self.view.model().insertColumns(
+                        currentColumns, columnsToAdd
                         )
-                    self.view.model().history.append((
-                        self.view.model().dataContainer.copy(),
-                        copy.deepcopy(self.view.model().formulas),
-                        self.view.model().alignmentDict.copy(),
-                        self.view.model().fonts.copy(),
-                        self.view.model().foreground.copy(),
-                        self.view.model().background.copy()
-                        ))
+                self.view.model().dataChanged.emit(
+                    self.view.model().index(0, 0),
+                    self.view.model().index(rows, columns)
+                    )
+                self.view.model().history.append((
+                    self.view.model().dataContainer.copy(),
+                    copy.deepcopy(self.view.model().formulas),
+                    self.view.model().alignmentDict.copy(),
+                    self.view.model().fonts.copy(),
+                    self.view.model().foreground.copy(),
+                    self.view.model().background.copy()
+                    ))
                 MainWindow.currentFile = name
                 info = name + ' was succesfully loaded'
                 self.statusBar().showMessage(info, 5000)
@@ -651,13 +734,7 @@ class MainWindow(QMainWindow):
 
     def rebuildFormulas(self, f):
         """Rebuild formulas from loaded file"""
-        for k, v in f.items():
-            sub = v.subsequent
-            prec = v.precedence
-            v.subsequent = weakref.WeakSet()
-            v.precedence = weakref.WeakSet()
-            v.subsequent.update({f[idx] for idx in sub})
-            v.precedence.update({f[idx] for idx in prec})
+        vnp.linkFormulas(f)
 
     def fileExport(self, file=None):
         """Export file into .csv format"""
@@ -711,11 +788,6 @@ class MainWindow(QMainWindow):
 
     def alignLeft(self):
         """Left align text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup2.actions():
             if action.isChecked():
                 if action.text() == 'Align top':
@@ -724,19 +796,13 @@ class MainWindow(QMainWindow):
                     vertical = Qt.AlignVCenter
                 else:
                     vertical = Qt.AlignBottom
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(Qt.AlignLeft | vertical)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(Qt.AlignLeft | vertical)
+            )
 
     def alignCenter(self):
         """Center text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup2.actions():
             if action.isChecked():
                 if action.text() == 'Align top':
@@ -745,19 +811,13 @@ class MainWindow(QMainWindow):
                     vertical = Qt.AlignVCenter
                 else:
                     vertical = Qt.AlignBottom
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(Qt.AlignHCenter | vertical)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(Qt.AlignHCenter | vertical)
+            )
 
     def alignRight(self):
         """Right align text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup2.actions():
             if action.isChecked():
                 if action.text() == 'Align top':
@@ -766,19 +826,13 @@ class MainWindow(QMainWindow):
                     vertical = Qt.AlignVCenter
                 else:
                     vertical = Qt.AlignBottom
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(Qt.AlignRight | vertical)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(Qt.AlignRight | vertical)
+            )
 
     def alignUp(self):
         """Top align text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup1.actions():
             if action.isChecked():
                 if action.text() == 'Align left':
@@ -787,19 +841,13 @@ class MainWindow(QMainWindow):
                     horizontal = Qt.AlignHCenter
                 else:
                     horizontal = Qt.AlignRight
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(horizontal | Qt.AlignTop)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(horizontal | Qt.AlignTop)
+            )
 
     def alignMiddle(self):
         """Center text vertically from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup1.actions():
             if action.isChecked():
                 if action.text() == 'Align left':
@@ -808,19 +856,13 @@ class MainWindow(QMainWindow):
                     horizontal = Qt.AlignHCenter
                 else:
                     horizontal = Qt.AlignRight
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(horizontal | Qt.AlignVCenter)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(horizontal | Qt.AlignVCenter)
+            )
 
     def alignDown(self):
         """Bottom align text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
         for action in self.alignmentGroup1.actions():
             if action.isChecked():
                 if action.text() == 'Align left':
@@ -829,90 +871,70 @@ class MainWindow(QMainWindow):
                     horizontal = Qt.AlignHCenter
                 else:
                     horizontal = Qt.AlignRight
-        for i in selected:
-            model.alignmentDict[i.row(), i.column()] = \
-                int(horizontal | Qt.AlignBottom)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(
+            self.view.model().alignmentDict,
+            int(horizontal | Qt.AlignBottom)
+            )
 
     def updateFont(self):
         """Update fonts from selected text to current font"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
         font = self.fontsComboBox.currentFont()
         globals_.currentFont = QFont(font)
         pointSize = float(self.pointSize.currentText())
         globals_.currentFont.setPointSizeF(pointSize)
-        for index in selected:
-            self.view.model().setData(
-                index, globals_.currentFont,
-                role=Qt.FontRole
-                )
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.styleSelection(self.view.model().fonts, globals_.currentFont)
+
+    def changeFonts(self, setter, value):
+        """Call setter with value on the fonts from selected cells"""
+        def change(font):
+            font = QFont(font)
+            setter(font, value)
+            return font
+        self.styleSelection(
+            self.view.model().fonts,
+            function=change,
+            default=globals_.defaultFont
+            )
 
     def bold(self):
         """Set bold to True for text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
-        for index in selected:
-            font = QFont(model.fonts.get(
-                (index.row(), index.column()),
-                globals_.defaultFont)
-                )
-            if self.sender().isChecked():
-                font.setBold(True)
-            else:
-                font.setBold(False)
-            model.setData(index, font, role=Qt.FontRole)
-        model.dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.changeFonts(QFont.setBold, self.sender().isChecked())
 
     def italic(self):
         """Set text to italic from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
-        model = self.view.model()
-        for index in selected:
-            font = QFont(model.fonts.get(
-                (index.row(), index.column()),
-                globals_.defaultFont)
-                )
-            if self.sender().isChecked():
-                font.setItalic(True)
-            else:
-                font.setItalic(False)
-            model.setData(index, font, role=Qt.FontRole)
-        model.dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        self.changeFonts(QFont.setItalic, self.sender().isChecked())
 
     def underline(self):
         """Underline text from selected cells"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
-        if not selected:
-            return
+        self.changeFonts(QFont.setUnderline, self.sender().isChecked())
+
+    def styleSelection(self, layer, value=None, function=None, default=None):
+        """Give value to the selected cells of a style layer
+
+        When function is given it is applied to the value every selected
+        cell has instead, default standing for cells without one. Each
+        selected range is written as a single rectangle, ranges spanning
+        every row or column run up to the last one possible.
+        """
         model = self.view.model()
-        for index in selected:
-            font = QFont(
-                model.fonts.get((
-                    index.row(), index.column()),
-                    globals_.defaultFont
-                    )
-                )
-            if self.sender().isChecked():
-                font.setUnderline(True)
+        selection = self.view.selectionModel().selection()
+        if selection.isEmpty():
+            return
+        for selected in selection:
+            r1, c1 = selected.top(), selected.left()
+            r2, c2 = selected.bottom(), selected.right()
+            if r1 == 0 and r2 == model.rowCount() - 1:
+                r2 = END
+            if c1 == 0 and c2 == model.columnCount() - 1:
+                c2 = END
+            if function is None:
+                layer.setRange(r1, c1, r2, c2, value)
             else:
-                font.setUnderline(False)
-            model.setData(index, font, role=Qt.FontRole)
-        model.dataChanged.emit(selected[0], selected[-1])
+                layer.transform(r1, c1, r2, c2, function, default)
+            model.dataChanged.emit(
+                selected.topLeft(),
+                selected.bottomRight()
+                )
         self.view.saveToHistory()
 
     def updateDecimals(self, val):
@@ -921,8 +943,6 @@ class MainWindow(QMainWindow):
 
     def showColorDialog(self):
         """Show color dialog for color selection"""
-        selectionModel = self.view.selectionModel()
-        selected = selectionModel.selectedIndexes()
         color = QColorDialog.getColor()
         if color.isValid():
             self.sender().color_ = color.getRgb()
@@ -946,17 +966,11 @@ class MainWindow(QMainWindow):
             backgroundR, backgroundG, backgroundB, backgroundA)
         self.setStyleSheet(styleSheet)
         model = self.view.model()
-        if not selected:
-            return
-        for index in selected:
-            if self.sender().objectName() == 'FontColor':
-                model.setData(index, QBrush(color), role=Qt.ForegroundRole)
-            else:
-                if globals_.domainHighlight:
-                    globals_.domainHighlight = False
-                model.setData(index, QBrush(color), role=Qt.BackgroundRole)
-        self.view.model().dataChanged.emit(selected[0], selected[-1])
-        self.view.saveToHistory()
+        if self.sender().objectName() == 'FontColor':
+            self.styleSelection(model.foreground, QBrush(color))
+        else:
+            globals_.domainHighlight = False
+            self.styleSelection(model.background, QBrush(color))
 
     def showPlotMenu(self):
         self.plotMenu = PlotMenu(self)
@@ -993,20 +1007,15 @@ class MainWindow(QMainWindow):
             if width > 2:
                 return
             if height * width == len(selected):
-                x = np.zeros((height), dtype=float)
-                y = np.zeros((height), dtype=float)
-                for ry, r in enumerate(range(topRow, bottomRow+1)):
-                    for cx, c in enumerate(range(leftColumn, rightColumn+1)):
-                        try:
-                            number = complex(model.dataContainer[r, c])
-                        except ValueError as e:
-                            print(e)
-                            return
-                        else:
-                            if cx == 0:
-                                x[ry] = number.real
-                            else:
-                                y[ry] = number.real
+                try:
+                    array = model.gatherRange(
+                        topRow, leftColumn, bottomRow, rightColumn
+                        ).real
+                except ValueError as e:
+                    print(e)
+                    return
+                x = array[:, 0]
+                y = array[:, 1] if width == 2 else np.zeros(height)
         print('printing x, y')
         print(x, y)
         self.plotWidget = PlotWidget()
@@ -1035,107 +1044,41 @@ class MainWindow(QMainWindow):
     @staticmethod
     def getCoord(index):
         """Get row, column (y, x) coordinates from alphanumeric coord"""
-        letters = globals_.LETTERS_REG_EXP.search(index).group()
-        numbers = globals_.NUMBERS_REG_EXP.search(index).group()
-        if len(letters) < 2:
-            column = globals_.ALPHABET.index(letters)
-        elif len(letters) == 2:
-            column = (1+globals_.ALPHABET.index(letters[0]))*26
-            column += globals_.ALPHABET.index(letters[1])
-        elif len(letters) == 3:
-            column = (1+globals_.ALPHABET.index(letters[0]))*676+26
-            column += globals_.ALPHABET.index(letters[1])*26
-            column += globals_.ALPHABET.index(letters[2])
-        row = int(numbers)-1
-        return row, column
-
-    def calculate(self, text, *ridx, com=False, flag=False):
-        """Format string into python executable code and evaluate"""
+        return getCoord(index)
+
+    def calculate(self, text, *ridx, com=False, flag=False, compiled=None):
+        """Evaluate the compiled form of a formula and spill its result"""
         print(text)
-        arrays = globals_.REGEXP1.findall(text)
-        coords = []
-        numpyArrayList = []
         model = self.view.model()
-        for array in arrays:
-            topLeft, bottomRight = globals_.REGEXP2.findall(array)
-            r1, c1 = self.getCoord(topLeft)
-            r2, c2 = self.getCoord(bottomRight)
-            coords.append(((r1, c1), (r2, c2)))
-            rows = [r1, r2+1]
-            columns = [c1, c2+1]
-            height = rows[1] - rows[0]
-            width = columns[1] - columns[0]
-            if hasattr(np, 'complex_'):
-                array = np.zeros((height, width), np.complex_)
+        if not flag and self.profiler.trace is not None:
+            self.profiler.trace.formula(ridx[0], ridx[1], text)
+        try:
+            if compiled is None:
+                with self.profiler.measure(ridx[0], ridx[1], text, 'parse'):
+                    compiled = CompiledFormula(text)
+            pF = model.formulas.get((ridx[0], ridx[1]))
+            if self.processes.everything or \
+                    pF is not None and pF.text == text and pF.process:
+                processes = self.processes
             else:
-                array = np.zeros((height, width), np.complex128)
-            for y, row in enumerate(range(rows[0], rows[1])):
-                for x, column in enumerate(range(columns[0], columns[1])):
-                    element = model.dataContainer.get(
-                        (row, column),
-                        0
-                        )
-                    try:
-                        element = complex(element)
-                    except Exception as e:
-                        print(e)
-                        return
-                    array[y, x] = element
-            numpyArrayList.append(array)
-        idPool = set()
-        while len(idPool) != len(numpyArrayList):
-            idPool.add(
-                'x_'
-                + str(random.randint(0, 255))
-                + str(random.randint(0, 255))
+                processes = None
+            result = model.engine.evaluate(
+                compiled,
+                cache=self.results,
+                processes=processes,
+                address=(ridx[0], ridx[1])
                 )
-        commandExecutable = globals_.REGEXP1.sub('{}', text)
-        idPool = list(idPool)
-        exec_scope = {}
-        for i1, i2 in zip(idPool, numpyArrayList):
-            exec_scope['i2'] = i2
-            exec(i1 + '= i2', exec_scope)
-        idPool = [f"exec_scope['{id_}']" for id_ in idPool]
-        commandExecutable = commandExecutable.format(*idPool)
-        single = globals_.REGEXP2.findall(commandExecutable)
-        singleIndexes = []
-        singleElements = []
-        idPool2 = set()
-        for s in single:
-            r, c = self.getCoord(s)
-            singleIndexes.append((r, c))
-            element = model.dataContainer.get((r, c), '0')
-            if isinstance(element, np.ndarray):
-                gen = (
-                    'w_'
-                    + str(random.randint(0, 255))
-                    + str(random.randint(0, 255))
-                    )
-                while gen in idPool2:
-                    gen = (
-                        'w_'
-                        + str(random.randint(0, 255))
-                        + str(random.randint(0, 255))
-                        )
-                idPool2.add(gen)
-                exec_scope['element'] = element
-                exec(gen + '= element', exec_scope)
-                singleElements.append(f"exec_scope['{gen}']")
-            else:
-                try:
-                    complex(element)
-                except Exception as e:
-                    print(e, element)
-                    return
-                singleElements.append(element)
-        commandExecutable = globals_.REGEXP2.sub('{}', commandExecutable)
-        commandExecutable = commandExecutable.format(*singleElements)
-        try:
-            result = eval(commandExecutable)
         except Exception as e:
-            print(commandExecutable)
             print(e)
             return
+        self.commit(text, compiled, result, *ridx, com=com, flag=flag)
+
+    def commit(self, text, compiled, result, *ridx, com=False, flag=False):
+        """Spill an evaluated result and register its formula"""
+        start = time.perf_counter()
+        model = self.view.model()
+        coords = compiled.ranges
+        singleIndexes = compiled.scalars
         if not flag:
             if globals_.historyIndex != -1:
                 hIndex = \
@@ -1177,18 +1120,18 @@ class MainWindow(QMainWindow):
                             text,
                             coords,
                             singleIndexes,
-                            domain
+                            domain,
+                            compiled
                             )
                     except Exception as e:
                         traceback.print_tb(e.__traceback__)
                         print(e)
                         return
-                startIndex = model.index(rowIdx, colIdx)
-                endIndex = startIndex
                 model.setData(
                     model.index(rowIdx, colIdx),
                     result,
                     mode='a')
+                model.changed(rowIdx, colIdx, rowIdx, colIdx)
             elif len(result.shape) == 2:
                 nRows = result.shape[0]
                 nCols = result.shape[1]
@@ -1199,39 +1142,18 @@ class MainWindow(QMainWindow):
                 if not flag and text != pText or invert:
                     try:
                         self.view.createFormula(
-                            text, coords, singleIndexes, domain
+                            text, coords, singleIndexes, domain, compiled
                             )
                     except Exception as e:
                         traceback.print_tb(e.__traceback__)
                         print(e)
                         return
-                for line, rY in zip(
-                        result,
-                        range(rowIdx, rowIdx+nRows)):
-                    for dE, cX in zip(
-                            line,
-                            range(
-                                colIdx,
-                                colIdx
-                                + nCols)):
-                        ind = model.createIndex(rY, cX)
-                        model.setData(
-                            ind,
-                            globals_.currentFont,
-                            role=Qt.FontRole
-                            )
-                        model.setData(
-                            ind,
-                            dE,
-                            mode='a'
-                            )
-                startIndex = model.index(
+                model.setBlock(
                     rowIdx,
-                    colIdx
+                    colIdx,
+                    result,
+                    font=globals_.currentFont
                     )
-                endIndex = model.index(
-                    rowIdx+nRows-1,
-                    colIdx+nCols-1)
             elif len(result.shape) == 1:
                 nRows = result.shape[0]
                 nCols = 1
@@ -1245,31 +1167,20 @@ class MainWindow(QMainWindow):
                             text,
                             coords,
                             singleIndexes,
-                            domain)
+                            domain,
+                            compiled)
                     except Exception as e:
                         traceback.print_tb(e.__traceback__)
                         print(e)
                         return
-                for row, ry in zip(
-                        result,
-                        range(rowIdx, rowIdx+nRows)):
-                    ind = model.createIndex(ry, colIdx)
-                    model.setData(
-                        ind,
-                        globals_.currentFont,
-                        role=Qt.FontRole
-                        )
-                    model.setData(ind, row, mode='a')
-                startIndex = model.index(
+                model.setBlock(
                     rowIdx,
-                    colIdx
+                    colIdx,
+                    result,
+                    font=globals_.currentFont
                     )
-                endIndex = model.index(
-                    rowIdx+nRows-1,
-                    colIdx)
             else:
                 return
-            model.dataChanged.emit(startIndex, endIndex)
             self.commandLineEdit.clearFocus()
         elif isinstance(result, numbers.Number):
             rowIdx = ridx[0]
@@ -1284,7 +1195,8 @@ class MainWindow(QMainWindow):
                         text,
                         coords,
                         singleIndexes,
-                        domain
+                        domain,
+                        compiled
                         )
                 except Exception as e:
                     traceback.print_tb(e.__traceback__)
@@ -1294,7 +1206,6 @@ class MainWindow(QMainWindow):
                 rowIdx,
                 colIdx
                 )
-            endIndex = startIndex
             model.setData(
                 startIndex,
                 globals_.currentFont,
@@ -1305,8 +1216,15 @@ class MainWindow(QMainWindow):
                 result,
                 mode='a'
                 )
-            model.dataChanged.emit(startIndex, endIndex)
+            model.changed(rowIdx, colIdx, rowIdx, colIdx)
             self.commandLineEdit.clearFocus()
+        self.profiler.record(
+            ridx[0],
+            ridx[1],
+            text,
+            'scatter',
+            time.perf_counter() - start
+            )
         currentFormula = model.formulas[
             ridx[0],
             ridx[1]
@@ -1317,8 +1235,6 @@ class MainWindow(QMainWindow):
             model.ftoapply.clear()
             model.formulaSnap.clear()
             self.view.saveToHistory()
-        else:
-            self.view.saveToHistory()
         self.view.setFocus()
 
     def clean(self, x, y, rows, cols):
@@ -1342,33 +1258,413 @@ class MainWindow(QMainWindow):
         model.dataChanged.emit(startIndex, endIndex)
 
     def executeOrder(self, formulas):
-        """Execute formulas in order"""
-        for f in formulas:
-            self.calculate(
+        """Recalculate formulas level by level on the thread pool
+
+        Formulas left by a background recalculation still running are
+        recalculated along, long cascades go to the background.
+        """
+        model = self.view.model()
+        if self.recalcPending:
+            formulas = graph.affected(set(formulas).union(
+                f for f in self.recalcPending
+                if model.formulas.get((f.row, f.col)) is f
+                ))
+        self.cancelRecalc()
+        if len(formulas) >= globals_.backgroundRecalc:
+            self.recalcGathers = GatherCache(None)
+            self.recalcLevels = scheduler.levels(formulas)
+            self.recalcPending = set(formulas)
+            self.recalcTotal = len(formulas)
+            self.nextLevel()
+            return
+        model.engine.recalculate(
+            formulas,
+            apply=lambda f, result: self.commit(
                 f.text,
+                f.compiled,
+                result,
                 f.row,
                 f.col,
                 flag=True
+                ),
+            executor=self.recalcPool(),
+            processes=self.processes,
+            cache=self.results,
+            batch=lambda: model.batch(history=False)
+            )
+
+    def nextLevel(self):
+        """Evaluate the next level in the background against a snapshot
+
+        The snapshot only holds the tiles the level reads, so the next
+        writes only copy those.
+        """
+        model = self.view.model()
+        level = self.recalcLevels.pop(0)
+        values = {
+            cell: model.cellValue(*cell)
+            for f in level for cell in f.compiled.scalars
+            }
+        generation = self.recalcGeneration
+        self.recalcGathers.store = model.store.snapshot(
+            rect for f in level for rect in f.compiled.rects()
+            )
+        self.recalcTask = RecalcTask(
+            generation,
+            level,
+            self.recalcGathers,
+            values,
+            self.recalcPool(),
+            lambda: generation != self.recalcGeneration,
+            self.processes,
+            self.results,
+            self.profiler,
+            model.engine.functions
+            )
+        self.recalcTask.signals.evaluated.connect(self.commitLevel)
+        QThreadPool.globalInstance().start(self.recalcTask)
+
+    def commitLevel(self, generation, results):
+        """Commit a level evaluated in the background unless superseded"""
+        if generation != self.recalcGeneration:
+            return
+        model = self.view.model()
+        with model.batch(history=False):
+            for f, result in results:
+                self.recalcPending.discard(f)
+                if isinstance(result, Exception):
+                    print(result)
+                    continue
+                if model.formulas.get((f.row, f.col)) is not f:
+                    continue
+                self.commit(
+                    f.text,
+                    f.compiled,
+                    result,
+                    f.row,
+                    f.col,
+                    flag=True
+                    )
+        done = self.recalcTotal - len(self.recalcPending)
+        if self.recalcLevels:
+            info = 'Recalculating {} of {} formulas'.format(
+                done,
+                self.recalcTotal
+                )
+            self.statusBar().showMessage(info)
+            self.nextLevel()
+        else:
+            self.recalcTask = None
+            self.statusBar().showMessage(
+                'Recalculated {} formulas'.format(done),
+                5000
                 )
+            self.view.saveToHistory(amend=True)
+
+    def cancelRecalc(self):
+        """Discard the background recalculation if any"""
+        self.recalcGeneration += 1
+        self.recalcLevels = []
+        self.recalcPending = set()
+        self.recalcGathers = None
+
+    def setCacheBudget(self):
+        """Ask for the megabytes kept for formula results"""
+        budget, ok = QInputDialog.getInt(
+            self,
+            'Recalculation',
+            'Result cache size (MB):',
+            globals_.cacheBudget // 2**20,
+            0,
+            2**16
+            )
+        if ok:
+            globals_.cacheBudget = budget * 2**20
+            self.results.resize(globals_.cacheBudget)
+
+    def setResidentTiles(self, resident=None):
+        """Ask for the cell tiles kept in memory, 0 keeping every one"""
+        if resident is None:
+            resident, ok = QInputDialog.getInt(
+                self,
+                'Recalculation',
+                'Resident tiles (0 for all):',
+                globals_.residentTiles,
+                0,
+                2**20
+                )
+            if not ok:
+                return
+        self.cancelRecalc()
+        globals_.residentTiles = resident
+        self.view.model().engine.pageTiles(resident or None)
+
+    def setProcessMode(self, checked):
+        """Evaluate every formula of the workbook in worker processes"""
+        self.processes.everything = checked
+
+    def mapCells(self, checked, directory=None):
+        """Keep the cells mapped to files in a working directory or not"""
+        if checked and not directory:
+            directory = QFileDialog.getExistingDirectory(
+                self,
+                'Working directory'
+                )
+            if not directory:
+                self.mapAction.setChecked(False)
+                return
+        self.cancelRecalc()
+        self.view.model().engine.mapTiles(directory if checked else None)
+        if checked:
+            info = 'Cells kept in ' + directory
+        else:
+            info = 'Cells kept in memory'
+        self.statusBar().showMessage(info, 5000)
+
+    def toggleProcessFormulas(self):
+        """Flip the worker processes flag of the selected formulas"""
+        model = self.view.model()
+        for index in self.view.selectionModel().selectedIndexes():
+            if f := model.formulas.get((index.row(), index.column())):
+                f.process = not f.process
+                if f.process:
+                    info = 'Formula evaluated in worker processes'
+                else:
+                    info = 'Formula evaluated in the main process'
+                self.statusBar().showMessage(info, 5000)
+
+    def defineFunction(self):
+        """Ask for the source of a function formulas can call"""
+        source, ok = QInputDialog.getMultiLineText(
+            self,
+            'Functions',
+            'Function source:',
+            'def name(x):\n    return x\n'
+            )
+        if not ok:
+            return
+        try:
+            name = self.view.model().engine.functions.define(source)
+        except Exception as e:
+            print(e)
+            self.statusBar().showMessage('Function not defined', 5000)
+            return
+        self.functionChanged(name)
+        self.statusBar().showMessage(f'Function {name} defined', 5000)
+
+    def removeFunction(self):
+        """Ask for a user defined function to remove"""
+        functions = self.view.model().engine.functions
+        names = sorted(functions.sources())
+        if not names:
+            return
+        name, ok = QInputDialog.getItem(
+            self,
+            'Functions',
+            'Remove function:',
+            names,
+            editable=False
+            )
+        if ok:
+            functions.remove(name)
+            self.functionChanged(name)
+
+    def functionChanged(self, name):
+        """Recalculate the formulas calling the function name"""
+        self.results.clear()
+        model = self.view.model()
+        callers = [
+            f for f in model.formulas.values()
+            if name in f.compiled.code.co_names
+            ]
+        if callers:
+            self.executeOrder(self.topologicalSort(callers))
+            self.view.saveToHistory()
+
+    def recalcPool(self):
+        """Return the thread pool used to recalculate formula levels"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(globals_.workers)
+        return self.executor
+
+    def setWorkers(self):
+        """Ask for the number of threads used to recalculate"""
+        workers, ok = QInputDialog.getInt(
+            self,
+            'Recalculation',
+            'Worker threads:',
+            globals_.workers or os.cpu_count(),
+            1,
+            256
+            )
+        if ok:
+            globals_.workers = workers
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
 
     def topologicalSort(self, formulas):
         """Create ordered list of formulas"""
-        marked = set()
-        ordered = []
-
-        def dfs(node):
-            marked.add(node)
-            for n in node.precedence:
-                if n not in marked:
-                    dfs(n)
-            ordered.append(node)
-
-        for f in formulas:
-            if f not in marked:
-                dfs(f)
-        ordered = list(reversed(ordered))
+        ordered = graph.affected(formulas)
+        if self.profiler.trace is not None:
+            self.profiler.trace.order(formulas, ordered)
         return ordered
 
+    def recordTrace(self, checked, name=None):
+        """Start writing recalculations to a trace file or stop it"""
+        if self.profiler.trace is not None:
+            self.profiler.trace.close()
+            self.profiler.trace = None
+            self.statusBar().showMessage('Trace stopped', 5000)
+        if not checked:
+            return
+        if not name:
+            name, notUsed = QFileDialog.getSaveFileName(
+                self,
+                'Record Trace',
+                '',
+                'trace files (*.jsonl)'
+                )
+        if not name:
+            self.traceAction.setChecked(False)
+            return
+        workbook = MainWindow.currentFile
+        if workbook and not workbook.endswith('.vnp'):
+            workbook += '.vnp'
+        self.profiler.trace = TraceWriter(name, workbook)
+        if not self.traceAction.isChecked():
+            self.traceAction.blockSignals(True)
+            self.traceAction.setChecked(True)
+            self.traceAction.blockSignals(False)
+        self.statusBar().showMessage('Recording trace to ' + name, 5000)
+
+
+class RecalcSignals(QObject):
+    """Carry the results of a background level to the GUI thread"""
+    evaluated = Signal(int, list)
+
+
+class RecalcTask(QRunnable):
+    """Evaluate a level of formulas against a snapshot of the cells"""
+    def __init__(
+            self, generation, level, store, values,
+            executor, cancelled, processes, results, profiler, functions):
+        super().__init__()
+        self.signals = RecalcSignals()
+        self.generation = generation
+        self.level = level
+        self.store = store
+        self.values = values
+        self.executor = executor
+        self.cancelled = cancelled
+        self.processes = processes
+        self.results = results
+        self.profiler = profiler
+        self.functions = functions
+
+    def run(self):
+        results = scheduler.evaluate(
+            self.level,
+            self.store,
+            lambda row, column: self.values[row, column],
+            self.executor,
+            self.cancelled,
+            self.processes,
+            self.results,
+            self.profiler,
+            self.functions
+            )
+        self.signals.evaluated.emit(self.generation, results)
+
+
+class ProfilerPanel(QDockWidget):
+    """Show the recalculation time of every formula, slowest first"""
+    COLUMNS = ('Cell', 'Formula', 'Calls') + tuple(
+        phase.capitalize() + ' (ms)' for phase in PHASES
+        ) + ('Total (ms)', 'Size (bytes)')
+
+    def __init__(self, profiler, parent=None):
+        super().__init__('Profiler', parent)
+        self.profiler = profiler
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(len(self.COLUMNS) - 2, Qt.DescendingOrder)
+        self.recordBox = QCheckBox('Record')
+        self.recordBox.toggled.connect(self.setRecording)
+        self.tilesLabel = QLabel()
+        refresh = QPushButton('Refresh')
+        refresh.clicked.connect(self.refresh)
+        reset = QPushButton('Reset')
+        reset.clicked.connect(self.reset)
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.recordBox)
+        buttons.addStretch()
+        buttons.addWidget(refresh)
+        buttons.addWidget(reset)
+        layout = QVBoxLayout()
+        layout.addLayout(buttons)
+        layout.addWidget(self.table)
+        layout.addWidget(self.tilesLabel)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+    def setRecording(self, checked):
+        """Start or stop recording and refreshing the stats"""
+        self.profiler.enabled = checked
+        if checked:
+            self.timer.start()
+        else:
+            self.timer.stop()
+            self.refresh()
+
+    def refresh(self):
+        """Fill the table with the stats recorded so far"""
+        model = self.parent().view.model()
+        report = self.profiler.report()
+        self.table.setSortingEnabled(False)
+        self.table.setRowCount(len(report))
+        for row, stats in enumerate(report):
+            values = [
+                model.getAlphanumeric(stats.column, stats.row),
+                stats.text,
+                stats.calls
+                ]
+            values += [
+                round(getattr(stats, phase) * 1000, 3) for phase in PHASES
+                ]
+            values += [round(stats.total * 1000, 3), stats.size]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, value)
+                self.table.setItem(row, column, item)
+        self.table.setSortingEnabled(True)
+        tiles = model.store.tiles
+        if isinstance(tiles, Pager):
+            self.tilesLabel.setText(
+                'Tiles: {} of {} resident, {hits} hits, {misses} misses, '
+                '{evictions} evictions'.format(
+                    len(tiles.tiles), len(tiles), **tiles.counters
+                    )
+                )
+        else:
+            self.tilesLabel.setText(
+                'Tiles: {} in memory'.format(len(tiles))
+                )
+
+    def reset(self):
+        """Forget the stats recorded so far"""
+        self.profiler.reset()
+        tiles = self.parent().view.model().store.tiles
+        if isinstance(tiles, Pager):
+            tiles.reset()
+        self.refresh()
+
 
 class CommandLineEdit(QLineEdit):
     """Handle expression and emit corresponding signals"""
@@ -1772,23 +2068,18 @@ class PlotConf(QWidget):
             end = MainWindow.getCoord(end)
             rows = end[0] - start[0] + 1
             cols = end[1] - start[1] + 1
-            array = np.zeros((rows, cols), dtype=float)
+            labels = option == 'pie'
             if option == 'bar':
                 check = model.dataContainer[start[0], start[1]]
-                if type(check) is str:
-                    array = np.zeros((rows, cols), dtype='<U7')
-            if option == 'pie':
-                array = np.zeros((rows, cols), dtype='<U7')
+                labels = type(check) is str
+            if not labels:
+                return model.gatherRange(
+                    start[0], start[1], end[0], end[1]
+                    ).real
+            array = np.zeros((rows, cols), dtype='<U7')
             for y, row in enumerate(range(start[0], end[0]+1)):
                 for x, col in enumerate(range(start[1], end[1]+1)):
-                    if type(array[0][0]) is not np.str_:
-                        number = complex(
-                            model.dataContainer[row, col]
-                            )
-                        array[y, x] = number.real
-                    else:
-                        str_ = model.dataContainer[row, col]
-                        array[y, x] = str_
+                    array[y, x] = model.dataContainer[row, col]
             return array
         else:
             compact = globals_.REGEXP2.findall(text)
@@ -0,0 +1,21 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+"""Calculation engine shared by the spreadsheet widgets"""
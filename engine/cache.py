@@ -0,0 +1,101 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import collections
+import sys
+import threading
+
+import numpy as np
+
+
+def resultSize(result):
+    """Return the bytes a cached result is accounted for"""
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    return sys.getsizeof(result)
+
+
+class ResultCache():
+    """Results of formulas keyed on their text and input versions
+
+    The key is the formula text followed by the version of each range
+    it reads and the generation of the user defined functions it may
+    call, so a result is reused only while every input is the same.
+    The least recently used results are dropped once their size goes
+    over budget bytes.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.results = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, compiled, store, functions=None):
+        """Return the key of a compiled formula reading from store
+
+        functions is the udf.Registry the formula calls if any.
+        Volatile formulas get None, they are never cached.
+        """
+        if compiled.volatile:
+            return None
+        versions = tuple(
+            store.version(*rect) for rect in compiled.rects()
+            )
+        generation = None if functions is None else functions.generation
+        return compiled.text, versions, generation
+
+    def get(self, key):
+        """Return the result cached for key or None"""
+        if key is None:
+            return None
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key][0]
+
+    def put(self, key, result):
+        """Cache result for key dropping the oldest results as needed"""
+        size = resultSize(result)
+        if key is None or result is None or size > self.budget:
+            return
+        with self.lock:
+            if key in self.results:
+                self.size -= self.results.pop(key)[1]
+            self.results[key] = result, size
+            self.size += size
+            self.shrink()
+
+    def shrink(self):
+        """Drop the least recently used results until within budget"""
+        while self.size > self.budget:
+            result, size = self.results.popitem(last=False)[1]
+            self.size -= size
+
+    def resize(self, budget):
+        """Change the budget dropping results as needed"""
+        with self.lock:
+            self.budget = budget
+            self.shrink()
+
+    def clear(self):
+        """Drop every cached result"""
+        with self.lock:
+            self.results.clear()
+            self.size = 0
@@ -0,0 +1,169 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import cmath
+
+import numpy as np
+
+from engine import fused
+import globals_
+
+
+def getCoord(index):
+    """Get row, column (y, x) coordinates from alphanumeric coord"""
+    letters = globals_.LETTERS_REG_EXP.search(index).group()
+    numbers = globals_.NUMBERS_REG_EXP.search(index).group()
+    if len(letters) < 2:
+        column = globals_.ALPHABET.index(letters)
+    elif len(letters) == 2:
+        column = (1+globals_.ALPHABET.index(letters[0]))*26
+        column += globals_.ALPHABET.index(letters[1])
+    elif len(letters) == 3:
+        column = (1+globals_.ALPHABET.index(letters[0]))*676+26
+        column += globals_.ALPHABET.index(letters[1])*26
+        column += globals_.ALPHABET.index(letters[2])
+    row = int(numbers)-1
+    return row, column
+
+
+def parseNumber(text):
+    """Convert text into the narrowest python number it represents"""
+    text = text.strip()
+    for type_ in (int, float, complex):
+        try:
+            return type_(text)
+        except ValueError:
+            pass
+    raise ValueError(f'could not convert string to number: {text!r}')
+
+
+def parseValue(text):
+    """Convert typed text into the value its cell holds
+
+    Numbers and booleans are parsed once when entered. Other text is
+    kept as typed, as is text a number can not give back, such as a
+    float overflowing to infinity.
+    """
+    stripped = text.strip()
+    if stripped in ('True', 'False'):
+        return stripped == 'True'
+    try:
+        value = parseNumber(stripped)
+    except ValueError:
+        return text
+    if isinstance(value, (float, complex)) and not cmath.isfinite(value):
+        if 'inf' not in stripped.lower() and 'nan' not in stripped.lower():
+            return text
+    return value
+
+
+def scalarValue(element):
+    """Return the value a single cell reference binds to"""
+    if isinstance(element, np.ndarray):
+        return element
+    if isinstance(element, str):
+        return parseNumber(element)
+    complex(element)
+    if isinstance(element, np.generic):
+        return element.item()
+    return element
+
+
+class CompiledFormula():
+    """Formula text parsed once into a code object and its bindings
+
+    Every range reference ([A1:B5]) is replaced by a name bound to an
+    array and every single reference (C1) by a name bound to the cell
+    value, so recalculation only gathers the inputs and evaluates.
+    Formulas drawing random numbers are volatile, their results are
+    never reused. Elementwise only formulas are evaluated fused, see
+    engine.fused, and user defined functions are called by name, see
+    engine.udf.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.ranges = []
+        self.scalars = []
+        rangeNames = {}
+        scalarNames = {}
+
+        def bindRange(match):
+            topLeft, bottomRight = globals_.REGEXP2.findall(match.group())
+            coords = (getCoord(topLeft), getCoord(bottomRight))
+            if coords not in rangeNames:
+                rangeNames[coords] = f'_r{len(self.ranges)}'
+                self.ranges.append(coords)
+            return rangeNames[coords]
+
+        def bindScalar(match):
+            coords = getCoord(match.group())
+            if coords not in scalarNames:
+                scalarNames[coords] = f'_s{len(self.scalars)}'
+                self.scalars.append(coords)
+            return scalarNames[coords]
+
+        source = globals_.REGEXP1.sub(bindRange, text)
+        source = globals_.REGEXP2.sub(bindScalar, source)
+        self.source = source.strip()
+        self.rangeNames = list(rangeNames.values())
+        self.scalarNames = list(scalarNames.values())
+        self.code = compile(self.source, '<formula>', 'eval')
+        self.volatile = 'random' in self.source
+        self.fused = fused.plan(
+            self.source,
+            self.rangeNames + self.scalarNames
+            )
+
+    def __reduce__(self):
+        return (CompiledFormula, (self.text,))
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def rects(self):
+        """Return every referenced cell or range as (r1, c1, r2, c2)"""
+        rects = [(r1, c1, r2, c2) for (r1, c1), (r2, c2) in self.ranges]
+        rects += [(r, c, r, c) for r, c in self.scalars]
+        return rects
+
+    def bindings(self, getRange, getScalar, functions=None):
+        """Gather the values every reference of the formula is bound to
+
+        The user defined functions of functions, a udf.Registry, are
+        bound by name when given.
+        """
+        namespace = {} if functions is None else functions.functions()
+        namespace['np'] = np
+        for name, ((r1, c1), (r2, c2)) in zip(self.rangeNames, self.ranges):
+            namespace[name] = getRange(r1, c1, r2, c2)
+        for name, (r, c) in zip(self.scalarNames, self.scalars):
+            namespace[name] = scalarValue(getScalar(r, c))
+        return namespace
+
+    def evaluate(self, getRange, getScalar, functions=None):
+        """Evaluate the formula against the given input accessors"""
+        return self.run(self.bindings(getRange, getScalar, functions))
+
+    def run(self, namespace):
+        """Evaluate the formula against gathered bindings"""
+        if self.fused is not None:
+            if (result := self.fused.evaluate(namespace)) is not None:
+                return result
+        return eval(self.code, namespace)
@@ -0,0 +1,71 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import weakref
+
+from engine import graph
+from engine.compiler import CompiledFormula
+
+
+class Formula():
+    def __init__(self, *args, compiled=None):
+        """Constructor for Formula object"""
+        if len(args) > 1:
+            self.text = args[0]
+            self.row = args[1][0]
+            self.col = args[1][1]
+            self.indexes = tuple(args[2])
+            self.domain = tuple(args[3])
+            self.precedence = args[4]
+            self.subsequent = args[5]
+            self.compiled = compiled or CompiledFormula(self.text)
+            self.ord = graph.nextOrd()
+            self.process = False
+        elif len(args) == 1:
+            self.text = args[0].text
+            self.row = args[0].row
+            self.col = args[0].col
+            self.indexes = args[0].indexes
+            self.domain = args[0].domain
+            self.precedence = args[0].precedence
+            self.subsequent = args[0].subsequent
+            self.compiled = args[0].compiled
+            self.ord = graph.nextOrd()
+            self.process = args[0].process
+        weakref.finalize(self, print, 'Formula {} killed'.format(self.text))
+
+    def __setstate__(self, state):
+        """Upgrade old formulas and leave their position to the model"""
+        self.__dict__.update(state)
+        self.__dict__.pop('versions', None)
+        self.ord = None
+        self.process = state.get('process', False)
+        if 'compiled' not in state:
+            self.compiled = CompiledFormula(self.text)
+        if self.domain and len(self.domain[0]) == 2:
+            self.indexes = tuple(self.compiled.rects())
+            rows = [d[0] for d in self.domain]
+            columns = [d[1] for d in self.domain]
+            self.domain = (
+                (min(rows), min(columns), max(rows), max(columns)),
+                )
+
+    def __repr__(self):
+        return self.text
@@ -0,0 +1,267 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import ast
+import numbers
+
+import numpy as np
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+FUSE_SIZE = 1 << 15
+CHUNK_SIZE = 1 << 14
+
+BINARY = {
+    ast.Add: (np.add, '+'),
+    ast.Sub: (np.subtract, '-'),
+    ast.Mult: (np.multiply, '*'),
+    ast.Div: (np.true_divide, '/'),
+    ast.FloorDiv: (np.floor_divide, None),
+    ast.Mod: (np.remainder, '%'),
+    ast.Pow: (np.power, '**'),
+    ast.Lt: (np.less, '<'),
+    ast.LtE: (np.less_equal, '<='),
+    ast.Gt: (np.greater, '>'),
+    ast.GtE: (np.greater_equal, '>='),
+    ast.Eq: (np.equal, '=='),
+    ast.NotEq: (np.not_equal, '!='),
+    }
+UNARY = {
+    ast.USub: (np.negative, '-'),
+    ast.UAdd: (np.positive, '+'),
+    }
+NUMEXPR_FUNCTIONS = {
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan',
+    'arcsin': 'arcsin', 'arccos': 'arccos', 'arctan': 'arctan',
+    'arctan2': 'arctan2', 'sinh': 'sinh', 'cosh': 'cosh', 'tanh': 'tanh',
+    'arcsinh': 'arcsinh', 'arccosh': 'arccosh', 'arctanh': 'arctanh',
+    'log': 'log', 'log10': 'log10', 'log1p': 'log1p', 'exp': 'exp',
+    'expm1': 'expm1', 'sqrt': 'sqrt', 'absolute': 'abs', 'abs': 'abs',
+    'conj': 'conj', 'conjugate': 'conj'
+    }
+
+
+def ufunc(node):
+    """Return the numpy ufunc a call node stands for if any"""
+    if not isinstance(node.func, ast.Attribute) or node.keywords:
+        return None
+    if not isinstance(node.func.value, ast.Name) or \
+            node.func.value.id != 'np':
+        return None
+    function = getattr(np, node.func.attr, None)
+    if isinstance(function, np.ufunc) and function.nout == 1 and \
+            function.nin == len(node.args):
+        return function
+    return None
+
+
+def elementwise(node, names):
+    """Return whether node only combines names element by element"""
+    if isinstance(node, ast.Name):
+        return node.id in names
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, numbers.Number)
+    if isinstance(node, ast.BinOp):
+        return type(node.op) in BINARY and \
+            elementwise(node.left, names) and \
+            elementwise(node.right, names)
+    if isinstance(node, ast.UnaryOp):
+        return type(node.op) in UNARY and elementwise(node.operand, names)
+    if isinstance(node, ast.Compare):
+        return len(node.ops) == 1 and type(node.ops[0]) in BINARY and \
+            elementwise(node.left, names) and \
+            elementwise(node.comparators[0], names)
+    if isinstance(node, ast.Call):
+        return ufunc(node) is not None and \
+            all(elementwise(a, names) for a in node.args)
+    return False
+
+
+def translate(node):
+    """Return node written for numexpr or None when not supported"""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Constant):
+        return repr(node.value)
+    if isinstance(node, ast.BinOp):
+        operands = [translate(node.left), translate(node.right)]
+        operator = BINARY[type(node.op)][1]
+    elif isinstance(node, ast.Compare):
+        operands = [translate(node.left), translate(node.comparators[0])]
+        operator = BINARY[type(node.ops[0])][1]
+    elif isinstance(node, ast.UnaryOp):
+        operand = translate(node.operand)
+        operator = UNARY[type(node.op)][1]
+        return None if operand is None else f'({operator}{operand})'
+    else:
+        operands = [translate(a) for a in node.args]
+        operator = NUMEXPR_FUNCTIONS.get(node.func.attr)
+        if operator is None or None in operands:
+            return None
+        return '{}({})'.format(operator, ', '.join(operands))
+    if operator is None or None in operands:
+        return None
+    return '({} {} {})'.format(operands[0], operator, operands[1])
+
+
+def plan(source, names):
+    """Return a FusedExpression for source if it is elementwise only
+
+    names are the bindings of the formula, at least one range binding
+    has to show up for fusing to pay off.
+    """
+    try:
+        tree = ast.parse(source, mode='eval').body
+    except SyntaxError:
+        return None
+    if isinstance(tree, ast.Name) or not elementwise(tree, set(names)):
+        return None
+    used = sorted({
+        n.id for n in ast.walk(tree)
+        if isinstance(n, ast.Name) and n.id in names
+        })
+    if not any(name.startswith('_r') for name in used):
+        return None
+    return FusedExpression(tree, used)
+
+
+class FusedExpression():
+    """Elementwise formula evaluated in one pass over its inputs
+
+    numexpr evaluates the whole expression when installed, otherwise
+    the inputs are walked in blocks of CHUNK_SIZE elements and every
+    operation writes into a buffer allocated once, so no full size
+    temporary is created besides the result. Inputs smaller than
+    FUSE_SIZE elements or of different shapes are left to numpy.
+    """
+    def __init__(self, tree, names):
+        self.tree = tree
+        self.names = names
+        self.expression = translate(tree)
+
+    def evaluate(self, namespace):
+        """Return the value of the expression or None if not fusable"""
+        values = {name: namespace[name] for name in self.names}
+        shapes = {
+            v.shape for v in values.values()
+            if isinstance(v, np.ndarray) and v.ndim
+            }
+        if len(shapes) != 1:
+            return None
+        shape, = shapes
+        for value in values.values():
+            if isinstance(value, np.ndarray):
+                if value.dtype.hasobject:
+                    return None
+            elif not isinstance(value, numbers.Number):
+                return None
+        if np.prod(shape) < FUSE_SIZE:
+            return None
+        if numexpr is not None and self.expression is not None:
+            try:
+                return numexpr.evaluate(self.expression, local_dict=values)
+            except Exception:
+                pass
+        return self.chunked(values, shape)
+
+    def chunked(self, values, shape):
+        """Evaluate the expression block by block into one result
+
+        Contiguous inputs are walked flat, otherwise, as for a column
+        of a tile, in blocks of rows so they are never copied.
+        """
+        if all(
+                v.flags.c_contiguous for v in values.values()
+                if isinstance(v, np.ndarray)):
+            values = {
+                name: value.reshape(-1) if np.ndim(value) else value
+                for name, value in values.items()
+                }
+            blocks = (int(np.prod(shape)),)
+        else:
+            blocks = shape
+        probe = {
+            name: value[:1] if np.ndim(value) else value
+            for name, value in values.items()
+            }
+        dtypes = {}
+        constants = {}
+        try:
+            self.apply(self.tree, probe, dtypes, constants)
+        except Exception:
+            return None
+        size = blocks[0]
+        step = max(1, CHUNK_SIZE // int(np.prod(blocks[1:])))
+        result = np.empty(blocks, dtypes[self.tree])
+        buffers = {
+            node: np.empty((min(size, step),) + blocks[1:], dtype)
+            for node, dtype in dtypes.items() if node is not self.tree
+            }
+        for start in range(0, size, step):
+            stop = min(start + step, size)
+            chunk = {
+                name: value[start:stop] if np.ndim(value) else value
+                for name, value in values.items()
+                }
+            out = {
+                node: buffer[:stop - start]
+                for node, buffer in buffers.items()
+                }
+            out[self.tree] = result[start:stop]
+            self.apply(self.tree, chunk, out, constants)
+        return result.reshape(shape)
+
+    def apply(self, node, values, out, constants):
+        """Evaluate node against values writing into the buffers of out
+
+        out maps nodes to dtypes while probing, the dtype of every node
+        producing an array is recorded then and the value of every node
+        not depending on an array is kept in constants.
+        """
+        if isinstance(node, ast.Name):
+            return values[node.id]
+        if isinstance(node, ast.Constant):
+            return node.value
+        if node in constants:
+            return constants[node]
+        if isinstance(node, ast.BinOp):
+            function = BINARY[type(node.op)][0]
+            operands = (node.left, node.right)
+        elif isinstance(node, ast.Compare):
+            function = BINARY[type(node.ops[0])][0]
+            operands = (node.left, node.comparators[0])
+        elif isinstance(node, ast.UnaryOp):
+            function = UNARY[type(node.op)][0]
+            operands = (node.operand,)
+        else:
+            function = ufunc(node)
+            operands = node.args
+        arguments = [self.apply(o, values, out, constants) for o in operands]
+        buffer = out.get(node)
+        if isinstance(buffer, np.ndarray):
+            return function(*arguments, out=buffer)
+        result = function(*arguments)
+        if np.ndim(result):
+            out[node] = result.dtype
+        else:
+            constants[node] = result
+        return result
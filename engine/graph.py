@@ -0,0 +1,151 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import collections
+import itertools
+
+_ords = itertools.count(1)
+
+
+class CircularReferenceError(Exception):
+    def __init__(self, row, column):
+        self.formulaRow = row
+        self.formulaColumn = column
+
+    def __str__(self):
+        errorInfo = \
+            "(row {}, column {}), creates a circular reference".format(
+                self.formulaRow,
+                self.formulaColumn
+                )
+        return errorInfo
+
+
+def nextOrd():
+    """Return a position after every formula placed so far"""
+    return next(_ords)
+
+
+def link(source, target):
+    """Record that target has to be calculated after source"""
+    source.precedence.add(target)
+    target.subsequent.add(source)
+
+
+def unlink(formula):
+    """Remove formula from the edges of the formulas linked to it"""
+    for f in formula.precedence:
+        f.subsequent.discard(formula)
+    for f in formula.subsequent:
+        f.precedence.discard(formula)
+
+
+def forward(start, upper, source):
+    """Collect the dependents of start placed before upper"""
+    found = [start]
+    stack = [start]
+    seen = {start}
+    while stack:
+        for f in stack.pop().precedence:
+            if f is source:
+                raise CircularReferenceError(source.row, source.col)
+            if f not in seen and f.ord < upper:
+                seen.add(f)
+                found.append(f)
+                stack.append(f)
+    return found
+
+
+def backward(start, lower):
+    """Collect the formulas start depends on placed after lower"""
+    found = [start]
+    stack = [start]
+    seen = {start}
+    while stack:
+        for f in stack.pop().subsequent:
+            if f not in seen and f.ord > lower:
+                seen.add(f)
+                found.append(f)
+                stack.append(f)
+    return found
+
+
+def reorder(source, target):
+    """Place target after source following Pearce and Kelly
+
+    Only the formulas between both positions that are reachable from
+    target, or that reach source, are renumbered, reusing their own
+    positions so the rest of the order is untouched.
+    """
+    if source.ord < target.ord:
+        return
+    after = forward(target, source.ord, source)
+    before = backward(source, target.ord)
+    after.sort(key=lambda f: f.ord)
+    before.sort(key=lambda f: f.ord)
+    ords = sorted(f.ord for f in after + before)
+    for f, ord_ in zip(before + after, ords):
+        f.ord = ord_
+
+
+def place(formula):
+    """Move formulas as needed so the edges of formula are respected
+
+    Raise CircularReferenceError when one of the edges closes a cycle,
+    only the formulas between both ends of the edge are visited.
+    """
+    for f in list(formula.precedence):
+        reorder(formula, f)
+    for f in list(formula.subsequent):
+        reorder(f, formula)
+
+
+def rebuild(formulas):
+    """Number formulas from scratch following their edges"""
+    formulas = list(formulas)
+    indegree = dict.fromkeys(formulas, 0)
+    for f in formulas:
+        for d in f.precedence:
+            if d in indegree:
+                indegree[d] += 1
+    queue = collections.deque(f for f in formulas if not indegree[f])
+    while queue:
+        f = queue.popleft()
+        f.ord = nextOrd()
+        for d in f.precedence:
+            if d in indegree:
+                indegree[d] -= 1
+                if not indegree[d]:
+                    queue.append(d)
+    for f in formulas:
+        if indegree[f]:
+            f.ord = nextOrd()
+
+
+def affected(formulas):
+    """Return formulas and all their dependents in calculation order"""
+    found = set(formulas)
+    stack = list(found)
+    while stack:
+        for f in stack.pop().precedence:
+            if f not in found:
+                found.add(f)
+                stack.append(f)
+    return sorted(found, key=lambda f: f.ord)
@@ -0,0 +1,233 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import bisect
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+COUNTERS = ('hits', 'misses', 'evictions')
+
+
+class SpillFile():
+    """Temporary file holding compressed tiles, shared by pagers
+
+    Records are never rewritten while in use, so the pagers of a store
+    and of its snapshots can share the file. Every pager holding a
+    record retains it, once the last one releases it the space of the
+    record is reused by the next writes that fit in it.
+    """
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.size = 0
+        self.references = {}
+        self.free = []
+        self.released = []
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        """Store data and return its (offset, length) record"""
+        length = len(data)
+        with self.lock:
+            self.collect()
+            fits = (i for i, (o, size) in enumerate(self.free)
+                    if size >= length)
+            index = next(fits, None)
+            if index is None:
+                offset = self.size
+                self.size += length
+            else:
+                offset, size = self.free[index]
+                if size > length:
+                    self.free[index] = (offset + length, size - length)
+                else:
+                    del self.free[index]
+            self.file.seek(offset)
+            self.file.write(data)
+            self.references[offset] = 1
+        return offset, length
+
+    def read(self, offset, length):
+        """Return the data of the given record"""
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def retain(self, records):
+        """Count one more holder of every given record"""
+        with self.lock:
+            for offset, length, *rest in records:
+                self.references[offset] += 1
+
+    def release(self, records):
+        """Count one holder less of every given record
+
+        Nothing is locked here so pagers can release their records as
+        they are garbage collected, the records are freed on next write.
+        """
+        self.released.extend(records)
+
+    def collect(self):
+        """Free the space of the records nothing holds anymore"""
+        while self.released:
+            offset, length, *rest = self.released.pop()
+            count = self.references.pop(offset) - 1
+            if count:
+                self.references[offset] = count
+                continue
+            index = bisect.bisect(self.free, (offset, length))
+            if index and sum(self.free[index - 1]) == offset:
+                index -= 1
+                offset, size = self.free.pop(index)
+                length += size
+            end = offset + length
+            if index < len(self.free) and self.free[index][0] == end:
+                length += self.free.pop(index)[1]
+            if offset + length == self.size:
+                self.size = offset
+                self.file.truncate(offset)
+            else:
+                self.free.insert(index, (offset, length))
+
+    def unused(self):
+        """Return the bytes of the file free for reuse"""
+        with self.lock:
+            self.collect()
+            return sum(length for offset, length in self.free)
+
+
+class Pager(MutableMapping):
+    """Tiles by key keeping only the most recently used ones in memory
+
+    Beyond resident tiles the least recently used one is packed into
+    the spill file and unpacked by load when asked for again. A tile
+    unpacked and left unwritten, as told by its version, keeps its
+    record instead of being packed again. Hits, misses and evictions
+    are counted in counters, under the lock of the pager.
+    """
+    def __init__(self, resident, load, spill=None, directory=None):
+        self.resident = max(1, resident)
+        self.load = load
+        self.spill = SpillFile(directory) if spill is None else spill
+        self.tiles = OrderedDict()
+        self.records = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.RLock()
+        weakref.finalize(self, releaseAll, self.spill, self.records)
+
+    def __getitem__(self, key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.counters['hits'] += 1
+                self.tiles.move_to_end(key)
+                return tile
+            offset, length, version = self.records[key]
+            self.counters['misses'] += 1
+            tile = self.tiles[key] = self.load(self.spill.read(offset, length))
+            self.evict()
+            return tile
+
+    def __setitem__(self, key, tile):
+        with self.lock:
+            if (record := self.records.pop(key, None)) is not None:
+                self.spill.release([record])
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            self.evict()
+
+    def __delitem__(self, key):
+        with self.lock:
+            if self.tiles.pop(key, None) is None:
+                record = self.records.pop(key)
+            else:
+                record = self.records.pop(key, None)
+            if record is not None:
+                self.spill.release([record])
+
+    def __contains__(self, key):
+        return key in self.tiles or key in self.records
+
+    def __iter__(self):
+        with self.lock:
+            keys = list(self.tiles)
+            keys += [key for key in self.records if key not in self.tiles]
+        return iter(keys)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.tiles.keys() | self.records.keys())
+
+    def record(self, key, tile):
+        """Give tile a record of its current version in the spill file"""
+        version = tile.version()
+        record = self.records.get(key)
+        if record is None or record[2] != version:
+            self.records[key] = self.spill.write(tile.pack()) + (version,)
+            if record is not None:
+                self.spill.release([record])
+
+    def evict(self):
+        """Spill the least recently used tiles beyond the resident ones"""
+        while len(self.tiles) > self.resident:
+            key, tile = self.tiles.popitem(last=False)
+            self.record(key, tile)
+            self.counters['evictions'] += 1
+
+    def resize(self, resident):
+        """Keep resident tiles in memory from now on"""
+        with self.lock:
+            self.resident = max(1, resident)
+            self.evict()
+
+    def reset(self):
+        """Set the counters back to zero"""
+        with self.lock:
+            for name in COUNTERS:
+                self.counters[name] = 0
+
+    def copy(self, keys=None):
+        """Return a pager sharing the spill file but no tile in memory
+
+        Resident tiles are recorded in the spill file first, unless
+        already there, so the copy never holds a live tile and the
+        tiles in memory stay within resident. The copy counts its own
+        hits, misses and evictions. When keys are given the copy only
+        holds those tiles.
+        """
+        with self.lock:
+            if keys is None:
+                keys = self.keys()
+            records = {}
+            for key in keys:
+                if key in self.tiles:
+                    self.record(key, self.tiles[key])
+                records[key] = self.records[key]
+            pager = Pager(self.resident, self.load, self.spill)
+            pager.records.update(records)
+            self.spill.retain(records.values())
+        return pager
+
+
+def releaseAll(spill, records):
+    """Release the records left by a pager garbage collected"""
+    spill.release(list(records.values()))
@@ -0,0 +1,168 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from engine import udf
+from engine.compiler import CompiledFormula
+
+SHARED_BYTES = 1 << 16
+
+_compiled = {}
+_registries = {}
+
+
+def pack(array):
+    """Return array ready to be sent to a worker and its shared block
+
+    Arrays of at least SHARED_BYTES are copied once into a shared
+    memory block and only its name travels, smaller ones are pickled.
+    """
+    if array.nbytes < SHARED_BYTES:
+        return ('array', array), None
+    block = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return ('shared', block.name, array.shape, array.dtype.str), block
+
+
+def unpack(packed, blocks):
+    """Return the array a packed input stands for inside a worker"""
+    if packed[0] == 'array':
+        return packed[1]
+    kind, name, shape, dtype = packed
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype, buffer=block.buf)
+
+
+def run(text, ranges, scalars, functions):
+    """Evaluate formula text in a worker against the inputs sent
+
+    functions holds the source of the user defined functions of the
+    workbook, the worker keeps a registry for every set of sources so
+    workbooks never see the functions of one another.
+    """
+    key = tuple(sorted(functions.items()))
+    if key not in _registries:
+        _registries[key] = udf.Registry()
+        _registries[key].load(functions)
+    if text not in _compiled:
+        _compiled[text] = CompiledFormula(text)
+    blocks = []
+    arrays = {}
+    try:
+        for rect, packed in ranges.items():
+            arrays[rect] = unpack(packed, blocks)
+        result = _compiled[text].evaluate(
+            lambda *rect: arrays[rect],
+            lambda row, column: scalars[row, column],
+            _registries[key]
+            )
+        if isinstance(result, np.ndarray):
+            result = result.copy()
+    except Exception as e:
+        result = e.with_traceback(None)
+    arrays = None
+    for block in blocks:
+        block.close()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+class ProcessPool():
+    """Evaluate formulas in worker processes, free from the GIL
+
+    Formulas travel as text along with their gathered inputs. Only the
+    formulas flagged with process are sent, or every formula when the
+    workbook asks for it through everything.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.everything = False
+        self.executor = None
+
+    def wants(self, formula):
+        """Return whether formula has to be evaluated in a worker"""
+        return self.everything or formula.process
+
+    def start(self):
+        """Return the process pool, starting it on first use"""
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+                )
+        return self.executor
+
+    def evaluate(
+            self, compiled, getRange, getScalar,
+            cancelled=None, functions=None):
+        """Evaluate compiled formulas and return their results in order
+
+        A formula that fails gets its exception as result and once
+        cancelled returns True the remaining formulas get None. The
+        sources of the user defined functions of functions, a
+        udf.Registry, are sent along when given.
+        """
+        packed = {}
+        blocks = []
+        futures = []
+        sources = {} if functions is None else functions.sources()
+        try:
+            for formula in compiled:
+                if cancelled is not None and cancelled():
+                    futures.append(None)
+                    continue
+                try:
+                    ranges = {}
+                    for (r1, c1), (r2, c2) in formula.ranges:
+                        rect = r1, c1, r2, c2
+                        if rect not in packed:
+                            packed[rect], block = pack(getRange(*rect))
+                            if block is not None:
+                                blocks.append(block)
+                        ranges[rect] = packed[rect]
+                    scalars = {
+                        cell: getScalar(*cell) for cell in formula.scalars
+                        }
+                    futures.append(self.start().submit(
+                        run, formula.text, ranges, scalars, sources
+                        ))
+                except Exception as e:
+                    futures.append(e)
+            results = []
+            for future in futures:
+                if future is None or isinstance(future, Exception):
+                    results.append(future)
+                    continue
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+            return results
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
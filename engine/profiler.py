@@ -0,0 +1,143 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import contextlib
+import threading
+import time
+
+from engine.cache import resultSize
+
+PHASES = ('parse', 'gather', 'eval', 'scatter')
+
+
+class FormulaStats():
+    """Time spent on a formula by phase along with its last result size"""
+    __slots__ = ('row', 'column', 'text', 'calls', 'size') + PHASES
+
+    def __init__(self, row, column, text):
+        self.row = row
+        self.column = column
+        self.text = text
+        self.calls = 0
+        self.size = 0
+        for phase in PHASES:
+            setattr(self, phase, 0.0)
+
+    @property
+    def total(self):
+        """Return the seconds spent on every phase"""
+        return sum(getattr(self, phase) for phase in PHASES)
+
+    def asDict(self):
+        """Return the stats as a plain dict"""
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats['total'] = self.total
+        return stats
+
+    def __repr__(self):
+        return '{} at ({}, {}): {} calls, {:.6f} s'.format(
+            self.text,
+            self.row,
+            self.column,
+            self.calls,
+            self.total
+            )
+
+
+class Profiler():
+    """Record where recalculation time goes, formula by formula
+
+    Formulas are told apart by address and text, so editing a formula
+    starts its stats anew. Nothing is recorded until enabled is set,
+    every sample also goes to trace when one is set, see engine.trace.
+    Threads evaluating formulas in parallel may record at the same
+    time. Formulas evaluated in worker processes only record their
+    calls and result size.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.trace = None
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @property
+    def active(self):
+        """Return whether samples are kept anywhere"""
+        return self.enabled or self.trace is not None
+
+    def entry(self, row, column, text):
+        """Return the stats of a formula creating them if missing"""
+        key = row, column, text
+        if (stats := self.stats.get(key)) is None:
+            stats = self.stats[key] = FormulaStats(row, column, text)
+        return stats
+
+    def record(self, row, column, text, phase, seconds):
+        """Add seconds to the given phase of a formula"""
+        if self.trace is not None:
+            self.trace.sample(row, column, phase, seconds)
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.entry(row, column, text)
+            setattr(stats, phase, getattr(stats, phase) + seconds)
+
+    @contextlib.contextmanager
+    def measure(self, row, column, text, phase):
+        """Record the time spent inside the block on a formula phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(
+                row,
+                column,
+                text,
+                phase,
+                time.perf_counter() - start
+                )
+
+    def count(self, row, column, text, result):
+        """Record an evaluation of a formula and its result size"""
+        if not self.active:
+            return
+        size = None
+        if result is not None and not isinstance(result, Exception):
+            size = resultSize(result)
+        if self.trace is not None and size is not None:
+            self.trace.result(row, column, size)
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.entry(row, column, text)
+            stats.calls += 1
+            if size is not None:
+                stats.size = size
+
+    def report(self, order='total'):
+        """Return the stats of every formula, largest order first"""
+        with self.lock:
+            stats = list(self.stats.values())
+        return sorted(stats, key=lambda s: getattr(s, order), reverse=True)
+
+    def reset(self):
+        """Forget every stat recorded so far"""
+        with self.lock:
+            self.stats.clear()
@@ -0,0 +1,116 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+"""Replay a recalculation trace headlessly against a .vnp workbook
+
+    python -m engine.replay workbook.vnp trace.jsonl
+"""
+
+import argparse
+
+from engine import trace, vnp
+from engine.profiler import Profiler
+from engine.workbook import Workbook
+
+TIMED = ('gather', 'eval')
+
+
+def load(path):
+    """Return a Workbook holding the cells and formulas of a .vnp file"""
+    sections = vnp.read(path)
+    formulas = vnp.linkFormulas(sections['formulas'])
+    book = Workbook(sections['cells'], formulas, Profiler())
+    book.functions.load(sections['functions'])
+    return book
+
+
+def replay(book, records):
+    """Apply the edits of a trace to book and time its recalculations
+
+    Formulas of the trace missing from book, or holding other text, are
+    left out. Return a list with, for every recalculation, the number of
+    formulas recalculated and the seconds spent gathering and
+    evaluating them when traced and when replayed.
+    """
+    book.profiler.enabled = True
+    cascades = []
+    current = None
+    for record in records:
+        event = record['event']
+        if event in ('edit', 'formula'):
+            current = None
+        if event == 'edit':
+            value = trace.decode(record['value'])
+            if value == '':
+                book.removeFormula(*record['cell'])
+                book.clearCell(*record['cell'])
+            elif value is not None:
+                book.removeFormula(*record['cell'])
+                book.setCell(*record['cell'], value)
+        elif event == 'formula':
+            try:
+                book.define(*record['cell'], record['text'])
+            except Exception as e:
+                print(e)
+        elif event == 'order':
+            ordered = []
+            for entry in record['order']:
+                f = book.formulas.get(tuple(entry['cell']))
+                if f is not None and f.text == entry['text']:
+                    ordered.append(f)
+            book.profiler.reset()
+            book.recalculate(ordered)
+            current = {
+                'formulas': len(ordered),
+                'traced': 0.0,
+                'replayed': sum(
+                    getattr(s, phase)
+                    for s in book.profiler.report() for phase in TIMED
+                    )
+                }
+            cascades.append(current)
+        elif event == 'sample' and current is not None:
+            if record['phase'] in TIMED:
+                current['traced'] += record['seconds']
+    return cascades
+
+
+def main(argv=None):
+    """Replay the trace given on the command line and print timings"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('workbook', help='.vnp file the trace started on')
+    parser.add_argument('trace', help='JSON Lines trace to replay')
+    args = parser.parse_args(argv)
+    cascades = replay(load(args.workbook), trace.read(args.trace))
+    print('{:>5} {:>9} {:>12} {:>12}'.format(
+        '#', 'formulas', 'traced ms', 'replayed ms'
+        ))
+    for n, cascade in enumerate(cascades):
+        print('{:>5} {:>9} {:>12.3f} {:>12.3f}'.format(
+            n,
+            cascade['formulas'],
+            cascade['traced'] * 1000,
+            cascade['replayed'] * 1000
+            ))
+    return cascades
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+
+def levels(formulas):
+    """Group formulas given in calculation order into independent levels
+
+    A formula goes one level after the deepest formula it depends on,
+    so the formulas of a level can be evaluated in any order.
+    """
+    depth = {}
+    grouped = []
+    for f in formulas:
+        level = max(
+            (depth[s] + 1 for s in f.subsequent if s in depth),
+            default=0
+            )
+        depth[f] = level
+        if level == len(grouped):
+            grouped.append([])
+        grouped[level].append(f)
+    return grouped
+
+
+def evaluate(
+        formulas, store, getScalar,
+        executor=None, cancelled=None, processes=None, cache=None,
+        profiler=None, functions=None):
+    """Evaluate formulas reading from store, return (formula, result) pairs
+
+    A formula that fails gets its exception as result. The formulas
+    are mapped over executor when given, numpy releases the GIL for
+    most of its kernels so independent formulas run in parallel. The
+    formulas processes wants are sent to its worker processes instead.
+    Results found in cache for the current input versions are reused,
+    volatile formulas are always evaluated.
+    Once cancelled returns True the remaining formulas get None. The
+    gather and eval time of every formula goes to profiler if enabled.
+    Formulas call the user defined functions of functions when given.
+    """
+    def run(f):
+        if cancelled is not None and cancelled():
+            return None
+        try:
+            if profiler is None or not profiler.active:
+                return f.compiled.evaluate(
+                    store.gather,
+                    getScalar,
+                    functions
+                    )
+            with profiler.measure(f.row, f.col, f.text, 'gather'):
+                namespace = f.compiled.bindings(
+                    store.gather,
+                    getScalar,
+                    functions
+                    )
+            with profiler.measure(f.row, f.col, f.text, 'eval'):
+                return f.compiled.run(namespace)
+        except Exception as e:
+            return e
+
+    results = {}
+    keys = {}
+    if cache is not None:
+        for f in formulas:
+            if (key := cache.key(f.compiled, store, functions)) is None:
+                continue
+            keys[f] = key
+            if (result := cache.get(key)) is not None:
+                results[f] = result
+    pending = [f for f in formulas if f not in results]
+    remote = []
+    if processes is not None:
+        remote = [f for f in pending if processes.wants(f)]
+    chosen = set(remote)
+    local = [f for f in pending if f not in chosen]
+    if remote:
+        args = [f.compiled for f in remote], store.gather, getScalar
+        args += cancelled, functions
+        if executor is None:
+            evaluated = processes.evaluate(*args)
+        else:
+            evaluated = executor.submit(processes.evaluate, *args)
+    if executor is None or len(local) == 1:
+        results.update(zip(local, map(run, local)))
+    else:
+        results.update(zip(local, executor.map(run, local)))
+    if remote:
+        if executor is not None:
+            evaluated = evaluated.result()
+        results.update(zip(remote, evaluated))
+    if cache is not None:
+        for f in pending:
+            if f in keys and not isinstance(results[f], Exception):
+                cache.put(keys[f], results[f])
+    if profiler is not None:
+        for f in formulas:
+            profiler.count(f.row, f.col, f.text, results[f])
+    return [(f, results[f]) for f in formulas]
@@ -0,0 +1,156 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import bisect
+
+
+def intersects(a, b):
+    """Return whether rectangles a and b share at least one cell"""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def contains(rect, row, column):
+    """Return whether rect covers the given cell"""
+    return rect[0] <= row <= rect[2] and rect[1] <= column <= rect[3]
+
+
+def cells(rects):
+    """Yield every (row, column) covered by the given rectangles"""
+    for r1, c1, r2, c2 in rects:
+        for row in range(r1, r2 + 1):
+            for column in range(c1, c2 + 1):
+                yield row, column
+
+
+def decompose(r1, r2):
+    """Yield the aligned power of two row blocks covering rows r1 to r2
+
+    Blocks are given as (level, index) and cover the rows from
+    index << level up to ((index + 1) << level) - 1.
+    """
+    lo = r1
+    hi = r2 + 1
+    level = 0
+    while lo < hi:
+        if lo & 1:
+            yield level, lo
+            lo += 1
+        if hi & 1:
+            hi -= 1
+            yield level, hi
+        lo >>= 1
+        hi >>= 1
+        level += 1
+
+
+class RectIndex():
+    """Index of rectangles answering which owners cover a cell or block
+
+    Every rectangle (r1, c1, r2, c2) is split into the canonical row
+    blocks and column blocks of two implicit segment trees, see
+    decompose, and its owner stored in the node of every pair of them,
+    O(log rows * log columns) nodes that cover exactly the rectangle.
+    A cell query looks up the single node holding the cell for every
+    pair of levels in use, and a block query bisects the occupied rows
+    and then the occupied columns of every pair of levels. Both run in
+    time independent of the owners stored, plus the owners found.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.rows = {}
+        self.columns = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, owner):
+        return owner in self.entries
+
+    def insert(self, owner, rects):
+        """Add the rectangles read or written by owner"""
+        entries = self.entries.setdefault(owner, set())
+        for r1, c1, r2, c2 in rects:
+            columnBlocks = list(decompose(c1, c2))
+            for rowLevel, row in decompose(r1, r2):
+                for columnLevel, column in columnBlocks:
+                    key = rowLevel, row, columnLevel, column
+                    node = self.nodes.get(key)
+                    if node is None:
+                        node = self.nodes[key] = set()
+                        columns = self.columns.get(key[:3])
+                        if columns is None:
+                            columns = self.columns[key[:3]] = []
+                            bisect.insort(
+                                self.rows.setdefault(
+                                    (rowLevel, columnLevel), []
+                                    ),
+                                row
+                                )
+                        bisect.insort(columns, column)
+                    node.add(owner)
+                    entries.add(key)
+
+    def remove(self, owner):
+        """Remove every rectangle of owner"""
+        for key in self.entries.pop(owner, ()):
+            node = self.nodes[key]
+            node.discard(owner)
+            if node:
+                continue
+            del self.nodes[key]
+            rowLevel, row, columnLevel, column = key
+            columns = self.columns[key[:3]]
+            del columns[bisect.bisect_left(columns, column)]
+            if columns:
+                continue
+            del self.columns[key[:3]]
+            rows = self.rows[rowLevel, columnLevel]
+            del rows[bisect.bisect_left(rows, row)]
+            if not rows:
+                del self.rows[rowLevel, columnLevel]
+
+    def queryPoint(self, row, column):
+        """Return the owners with a rectangle covering the given cell"""
+        found = set()
+        for rowLevel, columnLevel in self.rows:
+            node = self.nodes.get((
+                rowLevel, row >> rowLevel,
+                columnLevel, column >> columnLevel
+                ))
+            if node is not None:
+                found |= node
+        return found
+
+    def query(self, r1, c1, r2, c2):
+        """Return the owners with a rectangle intersecting the block"""
+        found = set()
+        for (rowLevel, columnLevel), rows in self.rows.items():
+            start = bisect.bisect_left(rows, r1 >> rowLevel)
+            end = bisect.bisect_right(rows, r2 >> rowLevel)
+            left = c1 >> columnLevel
+            right = c2 >> columnLevel
+            for row in rows[start:end]:
+                columns = self.columns[rowLevel, row, columnLevel]
+                for column in columns[
+                        bisect.bisect_left(columns, left):
+                        bisect.bisect_right(columns, right)]:
+                    found |= self.nodes[rowLevel, row, columnLevel, column]
+        return found
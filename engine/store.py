@@ -0,0 +1,602 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import itertools
+import numbers
+import pickle
+import tempfile
+import threading
+import zlib
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+
+import numpy as np
+
+from engine.compiler import parseNumber
+from engine.pager import Pager
+
+TILE_ROWS = 256
+TILE_COLUMNS = 256
+STAMP_ROWS = 16
+STAMP_COLUMNS = 16
+FLOAT_INTEGERS = 2**53
+VIEW_SIZE = TILE_ROWS * TILE_COLUMNS // 4
+EMPTY = 0
+BOOL = 1
+INTEGER = 2
+REAL = 3
+COMPLEX = 4
+OTHER = 5
+DTYPES = {
+    EMPTY: np.float64,
+    BOOL: np.bool_,
+    INTEGER: np.int64,
+    REAL: np.float64,
+    COMPLEX: np.complex128
+    }
+
+_stamps = itertools.count(1)
+
+
+def classify(value):
+    """Return the kind of a cell value and the number it holds"""
+    if isinstance(value, str):
+        try:
+            value = parseNumber(value)
+        except ValueError:
+            return OTHER, 0
+    elif isinstance(value, np.ndarray):
+        if value.ndim:
+            return OTHER, 0
+        value = value.item()
+    if isinstance(value, (bool, np.bool_)):
+        return BOOL, value
+    if isinstance(value, numbers.Integral):
+        if -2**63 <= value < 2**63:
+            return INTEGER, value
+        return REAL, float(value)
+    if isinstance(value, numbers.Real):
+        return REAL, value
+    if isinstance(value, numbers.Complex):
+        if value.imag == 0:
+            return REAL, value.real
+        return COMPLEX, value
+    return OTHER, 0
+
+
+def arrayKinds(array):
+    """Return the kind of every element of a numeric array"""
+    if array.dtype.kind == 'b':
+        return np.full(array.shape, BOOL, np.int8)
+    if array.dtype.kind == 'i' or \
+            array.dtype.kind == 'u' and array.dtype.itemsize < 8:
+        return np.full(array.shape, INTEGER, np.int8)
+    if array.dtype.kind in 'uf':
+        return np.full(array.shape, REAL, np.int8)
+    if array.dtype.kind == 'c':
+        return np.where(array.imag == 0, REAL, COMPLEX).astype(np.int8)
+    return None
+
+
+def allocate(shape, dtype, directory=None):
+    """Return a zeroed array, mapped to a file in directory when given
+
+    The file is unlinked right away, the operating system pages the
+    array in and out and frees its disk space once it is released.
+    """
+    if directory is None:
+        return np.zeros(shape, dtype)
+    with tempfile.TemporaryFile(dir=directory) as backing:
+        return np.memmap(backing, dtype, 'w+', shape=shape)
+
+
+def stampBlocks(rows, columns):
+    """Return the slices of the stamp blocks under the given cell slices"""
+    return (
+        slice(rows.start // STAMP_ROWS, (rows.stop - 1) // STAMP_ROWS + 1),
+        slice(
+            columns.start // STAMP_COLUMNS,
+            (columns.stop - 1) // STAMP_COLUMNS + 1
+            )
+        )
+
+
+def exact(value, kind, dtype):
+    """Return whether value comes back unchanged from an array of dtype
+
+    Floating dtypes only hold integers up to FLOAT_INTEGERS exactly.
+    """
+    if isinstance(value, str) or kind == OTHER:
+        return False
+    if isinstance(value, numbers.Integral) and \
+            not isinstance(value, (bool, np.bool_)):
+        if dtype.kind in 'fc':
+            return -FLOAT_INTEGERS <= value <= FLOAT_INTEGERS
+        return -2**63 <= value < 2**63
+    return True
+
+
+def inexact(values):
+    """Return the positions of integers a float64 can not hold exactly"""
+    return np.argwhere(
+        (values > FLOAT_INTEGERS) | (values < -FLOAT_INTEGERS)
+        ).tolist()
+
+
+def number(values, y, x, kind):
+    """Return the python number of the given kind stored at y, x"""
+    value = values[y, x]
+    if kind == BOOL:
+        return bool(value)
+    if kind == INTEGER:
+        return int(value.real)
+    if kind == REAL:
+        return float(value.real)
+    return complex(value)
+
+
+class Tile():
+    """Fixed size block of cells holding numbers and their kind
+
+    The values array has the narrowest dtype able to hold every number
+    of the tile, kinds records the narrowest dtype of each single cell,
+    EMPTY marking cells holding nothing, and stamps the last write to
+    each block of STAMP_ROWS by STAMP_COLUMNS cells. Values a number
+    can not stand for, such as text or arrays, are kept in objects by
+    their position in the tile. Values and kinds are mapped to files in
+    directory when one is given.
+    """
+    __slots__ = ('values', 'kinds', 'stamps', 'objects', 'directory')
+
+    def __init__(self, kind, directory=None):
+        self.directory = directory
+        self.values = allocate(
+            (TILE_ROWS, TILE_COLUMNS),
+            DTYPES.get(kind, np.bool_),
+            directory
+            )
+        self.kinds = allocate((TILE_ROWS, TILE_COLUMNS), np.int8, directory)
+        self.stamps = np.zeros(
+            (TILE_ROWS // STAMP_ROWS, TILE_COLUMNS // STAMP_COLUMNS),
+            np.int64
+            )
+        self.objects = {}
+
+    def copy(self):
+        """Return a tile holding copies of the arrays of this one"""
+        return self.moved(self.directory)
+
+    def moved(self, directory):
+        """Return a copy of the tile kept in memory or mapped to directory"""
+        tile = Tile.__new__(Tile)
+        tile.directory = directory
+        tile.values = allocate(self.values.shape, self.values.dtype, directory)
+        tile.values[...] = self.values
+        tile.kinds = allocate(self.kinds.shape, np.int8, directory)
+        tile.kinds[...] = self.kinds
+        tile.stamps = self.stamps.copy()
+        tile.objects = self.objects.copy()
+        return tile
+
+    def version(self):
+        """Return the stamp of the last write to the tile"""
+        return int(self.stamps.max())
+
+    def pack(self):
+        """Return the tile compressed into bytes, see unpack"""
+        return zlib.compress(pickle.dumps((
+            self.values.dtype.str,
+            self.values.tobytes(),
+            self.kinds.tobytes(),
+            self.stamps,
+            self.objects,
+            self.directory
+            ), pickle.HIGHEST_PROTOCOL), 1)
+
+    @staticmethod
+    def unpack(data):
+        """Return the tile packed into data"""
+        dtype, values, kinds, stamps, objects, directory = \
+            pickle.loads(zlib.decompress(data))
+        tile = Tile.__new__(Tile)
+        tile.directory = directory
+        tile.values = allocate((TILE_ROWS, TILE_COLUMNS), dtype, directory)
+        tile.values.flat = np.frombuffer(values, dtype)
+        tile.kinds = allocate((TILE_ROWS, TILE_COLUMNS), np.int8, directory)
+        tile.kinds.flat = np.frombuffer(kinds, np.int8)
+        tile.stamps = stamps
+        tile.objects = objects
+        return tile
+
+    def stamp(self, rows, columns, stamp=None):
+        """Mark the blocks under the given slices as just written"""
+        if stamp is None:
+            stamp = next(_stamps)
+        self.stamps[stampBlocks(rows, columns)] = stamp
+
+    def promote(self, kind):
+        """Widen the values dtype so it can hold numbers of kind
+
+        Integers a floating dtype can not hold exactly are kept in
+        objects first.
+        """
+        dtype = np.result_type(self.values.dtype, DTYPES[kind])
+        if dtype != self.values.dtype:
+            if self.values.dtype.kind in 'iu' and dtype.kind in 'fc':
+                for y, x in inexact(self.values):
+                    if (y, x) not in self.objects:
+                        self.objects[y, x] = int(self.values[y, x])
+            values = allocate(self.values.shape, dtype, self.directory)
+            values[...] = self.values
+            self.values = values
+
+
+class BlockStore(MutableMapping):
+    """Cells kept in fixed size numpy tiles, keyed by (row, column)
+
+    Numbers take the few bytes of their dtype instead of a python
+    object per cell and ranges are gathered by copying whole tile
+    slices. Anything else is kept aside in its tile, gathering it is
+    reported. Snapshots share the tiles with the store, a shared tile
+    is copied before it is written by either of them, so copying the
+    cells for the history is cheap. When directory is given tiles are
+    mapped to files there, so sheets larger than memory are paged by
+    the operating system. When resident is given only that many tiles
+    are kept in memory, see pageTo.
+    """
+    def __init__(self, cells=None, directory=None, resident=None):
+        self.tiles = {}
+        self.shared = set()
+        self.directory = directory
+        self.pageTo(resident)
+        if cells:
+            for (row, column), value in cells.items():
+                self.setValue(row, column, value)
+
+    def __getitem__(self, key):
+        row, column = key
+        tile = self.tiles.get((row // TILE_ROWS, column // TILE_COLUMNS))
+        if tile is None:
+            raise KeyError(key)
+        y = row % TILE_ROWS
+        x = column % TILE_COLUMNS
+        kind = tile.kinds[y, x]
+        if kind == EMPTY:
+            raise KeyError(key)
+        if (y, x) in tile.objects:
+            return tile.objects[y, x]
+        return number(tile.values, y, x, kind)
+
+    def __setitem__(self, key, value):
+        self.setValue(*key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.clearValue(*key)
+
+    def __contains__(self, key):
+        row, column = key
+        tile = self.tiles.get((row // TILE_ROWS, column // TILE_COLUMNS))
+        if tile is None:
+            return False
+        return tile.kinds[row % TILE_ROWS, column % TILE_COLUMNS] != EMPTY
+
+    def __iter__(self):
+        for tileRow, tileColumn in list(self.tiles):
+            tile = self.tiles[tileRow, tileColumn]
+            top = tileRow * TILE_ROWS
+            left = tileColumn * TILE_COLUMNS
+            for y, x in np.argwhere(tile.kinds != EMPTY).tolist():
+                yield top + y, left + x
+
+    def __len__(self):
+        return sum(
+            int(np.count_nonzero(tile.kinds)) for tile in self.tiles.values()
+            )
+
+    def copy(self):
+        """Return a copy of the cells, see snapshot"""
+        return self.snapshot()
+
+    def tile(self, row, column, kind=None):
+        """Return the tile holding the given cell
+
+        When kind is given the tile is created if missing and widened
+        so it can hold a number of that kind.
+        """
+        key = row // TILE_ROWS, column // TILE_COLUMNS
+        if kind is None:
+            return self.tiles.get(key)
+        return self.writable(key, kind)
+
+    def writable(self, key, kind=None):
+        """Return the tile at key ready to be written
+
+        A tile shared with a snapshot is replaced by a copy first, when
+        kind is given the tile is also created or widened as needed.
+        """
+        tile = self.tiles.get(key)
+        if tile is None:
+            if kind is not None:
+                tile = self.tiles[key] = Tile(kind, self.directory)
+            return tile
+        if key in self.shared:
+            tile = self.tiles[key] = tile.copy()
+            self.shared.discard(key)
+        if kind is not None and kind != OTHER:
+            tile.promote(kind)
+        return tile
+
+    def snapshot(self, rects=None):
+        """Return a copy of the store sharing its tiles until written
+
+        A paged store shares the records of its tiles in the spill file
+        instead, its tiles are never shared. When rects are given as
+        (r1, c1, r2, c2) the copy only holds the tiles under them, so
+        only those are copied by the next writes.
+        """
+        if rects is None:
+            keys = list(self.tiles)
+        else:
+            keys = {
+                (tileRow, tileColumn)
+                for r1, c1, r2, c2 in rects
+                for tileRow in range(r1 // TILE_ROWS, r2 // TILE_ROWS + 1)
+                for tileColumn in range(
+                    c1 // TILE_COLUMNS,
+                    c2 // TILE_COLUMNS + 1
+                    )
+                if (tileRow, tileColumn) in self.tiles
+                }
+        snapshot = BlockStore(directory=self.directory)
+        if isinstance(self.tiles, Pager):
+            snapshot.tiles = self.tiles.copy(keys)
+        else:
+            snapshot.tiles = {key: self.tiles[key] for key in keys}
+            snapshot.shared = set(keys)
+            self.shared.update(keys)
+        return snapshot
+
+    def moveTo(self, directory):
+        """Keep the tiles mapped to files in directory or in memory if None
+
+        Snapshots keep the tiles they had.
+        """
+        self.directory = directory
+        for key in list(self.tiles):
+            self.tiles[key] = self.tiles[key].moved(directory)
+        self.shared.clear()
+
+    def pageTo(self, resident):
+        """Keep at most resident tiles in memory or every one if None
+
+        The least recently used tiles beyond resident are compressed
+        into a spill file, in the directory of the store if any, and
+        loaded back when read or written, see engine.pager.
+        """
+        if resident is None:
+            if isinstance(self.tiles, Pager):
+                self.tiles = {key: self.tiles[key] for key in list(self.tiles)}
+        elif isinstance(self.tiles, Pager):
+            self.tiles.resize(resident)
+        else:
+            tiles = self.tiles
+            self.tiles = Pager(resident, Tile.unpack, directory=self.directory)
+            for key, tile in tiles.items():
+                self.tiles[key] = tile
+
+    def setValue(self, row, column, value):
+        """Store the numeric form of value at the given cell"""
+        kind, number = classify(value)
+        tile = self.tile(row, column, kind)
+        y = row % TILE_ROWS
+        x = column % TILE_COLUMNS
+        tile.values[y, x] = number
+        tile.kinds[y, x] = kind
+        if exact(value, kind, tile.values.dtype):
+            tile.objects.pop((y, x), None)
+        else:
+            tile.objects[y, x] = value
+        tile.stamp(slice(y, y + 1), slice(x, x + 1))
+
+    def clearValue(self, row, column):
+        """Remove the value stored at the given cell"""
+        tile = self.writable((row // TILE_ROWS, column // TILE_COLUMNS))
+        if tile is not None:
+            y = row % TILE_ROWS
+            x = column % TILE_COLUMNS
+            tile.values[y, x] = 0
+            tile.kinds[y, x] = EMPTY
+            tile.objects.pop((y, x), None)
+            tile.stamp(slice(y, y + 1), slice(x, x + 1))
+
+    @staticmethod
+    def overlaps(r1, c1, r2, c2):
+        """Yield the key of every tile overlapping the range and its overlap
+
+        Each overlap is given as the slices inside the tile followed by
+        the slices inside an array shaped like the range.
+        """
+        for tileRow in range(r1 // TILE_ROWS, r2 // TILE_ROWS + 1):
+            top = tileRow * TILE_ROWS
+            y1 = max(r1, top)
+            y2 = min(r2, top + TILE_ROWS - 1)
+            for tileColumn in range(
+                    c1 // TILE_COLUMNS, c2 // TILE_COLUMNS + 1):
+                left = tileColumn * TILE_COLUMNS
+                x1 = max(c1, left)
+                x2 = min(c2, left + TILE_COLUMNS - 1)
+                inTile = (
+                    slice(y1 - top, y2 - top + 1),
+                    slice(x1 - left, x2 - left + 1)
+                    )
+                inRange = (
+                    slice(y1 - r1, y2 - r1 + 1),
+                    slice(x1 - c1, x2 - c1 + 1)
+                    )
+                yield (tileRow, tileColumn), inTile, inRange
+
+    def blocks(self, r1, c1, r2, c2):
+        """Yield every stored tile overlapping the range and its overlap"""
+        for key, inTile, inRange in self.overlaps(r1, c1, r2, c2):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                yield tile, inTile, inRange
+
+    def setBlock(self, row, column, array):
+        """Store a 2-D array with its top left value at the given cell"""
+        kinds = arrayKinds(array)
+        if kinds is None:
+            for (y, x), value in np.ndenumerate(array):
+                self.setValue(row + y, column + x, value)
+            return
+        if array.dtype.kind == 'c' and kinds.max() < COMPLEX:
+            array = array.real
+        r2 = row + array.shape[0] - 1
+        c2 = column + array.shape[1] - 1
+        stamp = next(_stamps)
+        for key, inTile, inRange in self.overlaps(row, column, r2, c2):
+            blockKinds = kinds[inRange]
+            kind = int(blockKinds.max())
+            tile = self.writable(key, kind)
+            tile.values[inTile] = array[inRange]
+            tile.kinds[inTile] = blockKinds
+            if tile.objects:
+                rows, columns = inTile
+                tile.objects = {
+                    (y, x): value for (y, x), value in tile.objects.items()
+                    if not (rows.start <= y < rows.stop and
+                            columns.start <= x < columns.stop)
+                    }
+            if array.dtype.kind in 'iu' and tile.values.dtype.kind in 'fc':
+                values = array[inRange]
+                for y, x in inexact(values):
+                    tile.objects[inTile[0].start + y, inTile[1].start + x] = \
+                        int(values[y, x])
+            tile.stamp(*inTile, stamp)
+
+    def version(self, r1, c1, r2, c2):
+        """Return the newest write stamp of the blocks under the range
+
+        Stamps only grow, so the version changes whenever a cell of the
+        range may have changed and comes back when a snapshot taken
+        before is restored.
+        """
+        newest = 0
+        for tile, inTile, inRange in self.blocks(r1, c1, r2, c2):
+            newest = max(newest, int(tile.stamps[stampBlocks(*inTile)].max()))
+        return newest
+
+    def gather(self, r1, c1, r2, c2):
+        """Return the given range as an array, empty cells being zero
+
+        The array gets the narrowest dtype able to hold every number
+        of the range, regardless of the other cells of its tiles. A
+        range of at least VIEW_SIZE cells inside a single tile of that
+        dtype is returned as a read only view instead of a copy, the
+        tile being shared so the next write copies it first. A column
+        of a tile holds only TILE_ROWS cells, so column ranges and any
+        range across tiles are always copied. A paged store always
+        copies too, a view would keep its tile in memory past eviction
+        and its tiles are never shared.
+        """
+        blocks = []
+        kind = EMPTY
+        for tile, inTile, inRange in self.blocks(r1, c1, r2, c2):
+            kinds = tile.kinds[inTile]
+            if (kinds == OTHER).any():
+                y, x = np.argwhere(kinds == OTHER)[0]
+                raise ValueError(
+                    'cell (row {}, column {}) does not hold a number'.format(
+                        inRange[0].start + r1 + y,
+                        inRange[1].start + c1 + x
+                        )
+                    )
+            kind = max(kind, kinds.max())
+            blocks.append((tile, inTile, inRange))
+        key = r1 // TILE_ROWS, c1 // TILE_COLUMNS
+        if len(blocks) == 1 and not isinstance(self.tiles, Pager) and \
+                key == (r2 // TILE_ROWS, c2 // TILE_COLUMNS):
+            tile, inTile, inRange = blocks[0]
+            values = tile.values[inTile]
+            if values.size >= VIEW_SIZE and values.dtype == DTYPES[kind]:
+                self.shared.add(key)
+                view = values.view(np.ndarray)
+                view.flags.writeable = False
+                return view
+        array = np.zeros((r2 - r1 + 1, c2 - c1 + 1), DTYPES[kind])
+        for tile, inTile, inRange in blocks:
+            values = tile.values[inTile]
+            if values.dtype.kind == 'c' and array.dtype.kind != 'c':
+                values = values.real
+            array[inRange] = values
+            if kind == INTEGER and values.dtype.kind == 'f':
+                rows, columns = inTile
+                for (y, x), value in tile.objects.items():
+                    if rows.start <= y < rows.stop and \
+                            columns.start <= x < columns.stop:
+                        array[
+                            y - rows.start + inRange[0].start,
+                            x - columns.start + inRange[1].start
+                            ] = value
+        return array
+
+
+class GatherCache():
+    """Ranges gathered once for every formula of a recalculation pass
+
+    Arrays are keyed on the range and its version, so a range is only
+    gathered again after a write under it. The same array is handed to
+    every formula reading the range, hence it is read only. The lock
+    only guards the table, the first reader of a range gathers it
+    outside the lock while later readers wait on its future, so
+    different ranges are gathered in parallel.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+    def version(self, r1, c1, r2, c2):
+        """Return the version of the range in the store read"""
+        return self.store.version(r1, c1, r2, c2)
+
+    def gather(self, r1, c1, r2, c2):
+        """Return the given range as a read only array"""
+        store = self.store
+        key = r1, c1, r2, c2, store.version(r1, c1, r2, c2)
+        with self.lock:
+            future = self.arrays.get(key)
+            first = future is None
+            if first:
+                future = self.arrays[key] = Future()
+        if not first:
+            return future.result()
+        try:
+            array = store.gather(r1, c1, r2, c2)
+            array.flags.writeable = False
+        except Exception as e:
+            with self.lock:
+                del self.arrays[key]
+            future.set_exception(e)
+            raise
+        future.set_result(array)
+        return array
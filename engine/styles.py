@@ -0,0 +1,245 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+from engine.spatial import RectIndex, contains
+
+END = (1 << 31) - 1
+
+
+def covers(outer, inner):
+    """Return whether rectangle outer holds every cell of inner"""
+    return outer[0] <= inner[0] and outer[1] <= inner[1] \
+        and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def clip(rect, bounds):
+    """Return the part of rect inside bounds, both must intersect"""
+    return (
+        max(rect[0], bounds[0]), max(rect[1], bounds[1]),
+        min(rect[2], bounds[2]), min(rect[3], bounds[3])
+        )
+
+
+class Palette():
+    """Style objects interned by key and referred to by small IDs
+
+    Values telling the same key are stored once, the first one given
+    being shared by every cell using it, so values must not be changed
+    once interned. IDs are never reused, layers copied into the history
+    can share a palette.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.values = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, styleId):
+        return self.values[styleId]
+
+    def intern(self, value):
+        """Return the ID of value adding it when new"""
+        key = self.key(value)
+        styleId = self.ids.get(key)
+        if styleId is None:
+            styleId = self.ids[key] = len(self.values)
+            self.values.append(value)
+        return styleId
+
+
+class StyleLayer():
+    """One style attribute of the cells kept as rectangles
+
+    Every write gives a value to a rectangle (r1, c1, r2, c2) and gets a
+    sequence number, the latest write covering a cell gives its value.
+    Whole rows and columns run up to END, so styling them takes a single
+    entry whatever the number of cells. Single cells are kept in a dict
+    and larger rectangles in a RectIndex, writes left fully covered by a
+    newer rectangle are dropped. Cells can also be read and written one
+    at a time with the mapping syntax, layer[row, column]. With a
+    palette the writes keep style IDs and reading gives the shared
+    values.
+    """
+    def __init__(self, entries=None, palette=None):
+        self.points = {}
+        self.runs = {}
+        self.index = RectIndex()
+        self.sequence = 0
+        self.palette = palette
+        if isinstance(entries, dict):
+            for (row, column), value in entries.items():
+                self.setRange(row, column, row, column, value)
+        elif entries:
+            for entry in entries:
+                self.setRange(*entry)
+
+    def __len__(self):
+        return len(self.points) + len(self.runs)
+
+    def __contains__(self, key):
+        return self.lookup(*key) is not None
+
+    def __getitem__(self, key):
+        found = self.lookup(*key)
+        if found is None:
+            raise KeyError(key)
+        return self.resolve(found[1])
+
+    def __setitem__(self, key, value):
+        self.setRange(*key, *key, value)
+
+    def get(self, key, default=None):
+        """Return the value of the given cell or default"""
+        found = self.lookup(*key)
+        return default if found is None else self.resolve(found[1])
+
+    def resolve(self, stored):
+        """Return the value a write keeps as stored"""
+        return stored if self.palette is None else self.palette[stored]
+
+    def apply(self, function):
+        """Return function over stored values, called once per style ID"""
+        if self.palette is None:
+            return function
+        results = {}
+
+        def apply(stored):
+            if stored not in results:
+                results[stored] = function(self.palette[stored])
+            return results[stored]
+        return apply
+
+    def lookup(self, row, column):
+        """Return (sequence, stored) of the latest write covering the cell
+
+        A single cell write always outlives the rectangles covering it,
+        so it is returned right away when found.
+        """
+        found = self.points.get((row, column))
+        if found is not None:
+            return found
+        for sequence in self.index.queryPoint(row, column):
+            if found is None or sequence > found[0]:
+                found = sequence, self.runs[sequence][1]
+        return found
+
+    def pointsIn(self, rect):
+        """Return the single cell writes inside rect"""
+        r1, c1, r2, c2 = rect
+        if (r2 - r1 + 1) * (c2 - c1 + 1) < len(self.points):
+            return [
+                (row, column)
+                for row in range(r1, r2 + 1)
+                for column in range(c1, c2 + 1)
+                if (row, column) in self.points
+                ]
+        return [key for key in self.points if contains(rect, *key)]
+
+    def setRange(self, r1, c1, r2, c2, value):
+        """Give value to every cell of the rectangle"""
+        if self.palette is not None:
+            value = self.palette.intern(value)
+        self.sequence += 1
+        if r1 == r2 and c1 == c2:
+            self.points[r1, c1] = self.sequence, value
+            return
+        rect = (r1, c1, r2, c2)
+        for key in self.pointsIn(rect):
+            del self.points[key]
+        for sequence in self.index.query(*rect):
+            if covers(rect, self.runs[sequence][0]):
+                del self.runs[sequence]
+                self.index.remove(sequence)
+        self.runs[self.sequence] = rect, value
+        self.index.insert(self.sequence, (rect,))
+
+    def transform(self, r1, c1, r2, c2, function, default=None):
+        """Replace the value of every cell in the rectangle by function of it
+
+        Cells without value get function(default). The writes found are
+        clipped to the rectangle and written again in their order, so
+        the cost grows with them and not with the cells.
+        """
+        rect = (r1, c1, r2, c2)
+        found = [
+            (sequence, clip(self.runs[sequence][0], rect),
+             self.runs[sequence][1])
+            for sequence in self.index.query(*rect)
+            ]
+        found += [
+            (self.points[key][0], key + key, self.points[key][1])
+            for key in self.pointsIn(rect)
+            ]
+        found.sort(key=lambda write: write[0])
+        apply = self.apply(function)
+        self.setRange(*rect, function(default))
+        for sequence, clipped, stored in found:
+            self.setRange(*clipped, apply(stored))
+
+    def overlaps(self, r1, c1, r2, c2):
+        """Return whether any write covers a cell of the rectangle"""
+        rect = (r1, c1, r2, c2)
+        return bool(self.index.query(*rect)) or bool(self.pointsIn(rect))
+
+    def writes(self):
+        """Return the writes as (rect, stored) in their order"""
+        writes = [
+            (sequence, key + key, stored)
+            for key, (sequence, stored) in self.points.items()
+            ]
+        writes += [
+            (sequence, rect, stored)
+            for sequence, (rect, stored) in self.runs.items()
+            ]
+        writes.sort(key=lambda write: write[0])
+        return [(rect, stored) for sequence, rect, stored in writes]
+
+    def entries(self):
+        """Return the writes as (r1, c1, r2, c2, value) in their order"""
+        return [rect + (self.resolve(s),) for rect, s in self.writes()]
+
+    def map(self, function, palette=None):
+        """Return a layer with function applied to every value
+
+        The values of the new layer are interned in palette when given.
+        """
+        apply = self.apply(function)
+        return StyleLayer(
+            [rect + (apply(stored),) for rect, stored in self.writes()],
+            palette
+            )
+
+    def clear(self):
+        """Remove every write"""
+        self.points.clear()
+        self.runs.clear()
+        self.index = RectIndex()
+
+    def copy(self):
+        """Return an independent copy of the layer sharing its palette"""
+        layer = StyleLayer(palette=self.palette)
+        layer.points = dict(self.points)
+        layer.runs = dict(self.runs)
+        layer.sequence = self.sequence
+        for sequence, (rect, value) in self.runs.items():
+            layer.index.insert(sequence, (rect,))
+        return layer
@@ -0,0 +1,145 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import json
+import numbers
+import threading
+import time
+
+import numpy as np
+
+TRACE_VERSION = 1
+
+
+def encode(value):
+    """Return a cell value as JSON, arrays keep their shape only"""
+    if isinstance(value, np.ndarray):
+        return {'shape': list(value.shape), 'dtype': value.dtype.str}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, complex):
+        return {'complex': [value.real, value.imag]}
+    if isinstance(value, (str, numbers.Number)):
+        return value
+    return str(value)
+
+
+def decode(value):
+    """Return the cell value encoded or None if it was an array"""
+    if isinstance(value, dict):
+        if 'complex' in value:
+            return complex(*value['complex'])
+        return None
+    return value
+
+
+def cell(formula):
+    """Return the address of formula as a list"""
+    return [formula.row, formula.col]
+
+
+def shapes(compiled):
+    """Return the shape of every range a compiled formula reads"""
+    return [
+        [r2 - r1 + 1, c2 - c1 + 1]
+        for (r1, c1), (r2, c2) in compiled.ranges
+        ]
+
+
+class TraceWriter():
+    """Write what every recalculation does as JSON Lines
+
+    Every line is an object whose event is one of:
+
+    - start: the trace version and the workbook traced
+    - edit: a value entered in a cell, '' when cleared
+    - formula: a formula entered in a cell
+    - order: the dirty formulas of a recalculation and the formulas
+      recalculated in order with the shapes of their ranges
+    - sample: seconds spent on a phase of the formula at cell
+    - result: the size of the result of the formula at cell
+
+    Samples may be written from several threads.
+    """
+    def __init__(self, path, workbook=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self.write(
+            event='start',
+            version=TRACE_VERSION,
+            workbook=workbook,
+            time=time.time()
+            )
+
+    def write(self, **record):
+        """Write record as one line"""
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + '\n')
+
+    def edit(self, row, column, value):
+        """Write a value entered in a cell"""
+        self.write(event='edit', cell=[row, column], value=encode(value))
+
+    def formula(self, row, column, text):
+        """Write a formula entered in a cell"""
+        self.write(event='formula', cell=[row, column], text=text)
+
+    def order(self, dirty, ordered):
+        """Write the dirty formulas and their calculation order"""
+        self.write(
+            event='order',
+            dirty=[cell(f) for f in dirty],
+            order=[
+                {'cell': cell(f), 'text': f.text,
+                 'shapes': shapes(f.compiled)}
+                for f in ordered
+                ]
+            )
+
+    def sample(self, row, column, phase, seconds):
+        """Write seconds spent on a phase of the formula at a cell"""
+        self.write(
+            event='sample',
+            cell=[row, column],
+            phase=phase,
+            seconds=seconds
+            )
+
+    def result(self, row, column, size):
+        """Write the result size of the formula at a cell"""
+        self.write(event='result', cell=[row, column], size=size)
+
+    def close(self):
+        """Flush and close the trace"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read(path):
+    """Yield the records of a trace"""
+    with open(path) as myFile:
+        for line in myFile:
+            if line.strip():
+                yield json.loads(line)
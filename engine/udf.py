@@ -0,0 +1,152 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import ast
+import itertools
+import hashlib
+import importlib.util
+import keyword
+import os
+
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import globals_
+
+CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'visual-numpy', 'udf'
+    )
+
+
+class Kernel():
+    """User defined function callable from formulas
+
+    When numba is installed the function is compiled lazily for every
+    signature it is called with and the machine code is cached on disk
+    next to a copy of its source, named after its hash, so a workbook
+    loaded again reuses it. Functions numba can not compile run as
+    plain python.
+    """
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.function = None
+        self.jitted = None
+        if numba is not None:
+            self.function = self.importSource()
+            self.jitted = numba.njit(cache=True)(self.function)
+        else:
+            namespace = {'np': np}
+            exec(compile(source, f'<{name}>', 'exec'), namespace)
+            self.function = namespace[name]
+
+    def importSource(self):
+        """Import the function from a copy of its source on disk"""
+        digest = hashlib.sha1(self.source.encode()).hexdigest()[:16]
+        path = os.path.join(CACHE_DIR, f'{self.name}_{digest}.py')
+        if not os.path.exists(path):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(path, 'w') as myFile:
+                myFile.write('import numpy as np\n\n\n' + self.source)
+        spec = importlib.util.spec_from_file_location(
+            f'udf_{self.name}_{digest}',
+            path
+            )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return getattr(module, self.name)
+
+    def __call__(self, *args):
+        if self.jitted is not None:
+            try:
+                return self.jitted(*args)
+            except numba.core.errors.NumbaError as e:
+                print(e)
+                self.jitted = None
+        return self.function(*args)
+
+
+def functionName(source):
+    """Return the name of the only function defined by source"""
+    tree = ast.parse(source)
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.FunctionDef):
+        raise ValueError('source has to define exactly one function')
+    name = tree.body[0].name
+    if name == 'np' or name.startswith('_') or keyword.iskeyword(name) \
+            or globals_.REGEXP2.search(name):
+        raise ValueError(f'{name} can not be used as a function name')
+    return name
+
+
+_generations = itertools.count()
+
+
+class Registry():
+    """User defined functions of a workbook by name
+
+    Every workbook keeps its own registry, so functions defined in one
+    are never seen by another. The generation changes with every change
+    of the functions and is never shared by two registries, results are
+    cached under it, see engine.cache.
+    """
+    def __init__(self):
+        self.kernels = {}
+        self.generation = next(_generations)
+
+    def define(self, source):
+        """Register the function defined by source and return its name"""
+        name = functionName(source)
+        self.kernels[name] = Kernel(name, source)
+        self.generation = next(_generations)
+        return name
+
+    def remove(self, name):
+        """Unregister the function called name if any"""
+        if self.kernels.pop(name, None) is not None:
+            self.generation = next(_generations)
+
+    def functions(self):
+        """Return the registered functions by name"""
+        return dict(self.kernels)
+
+    def sources(self):
+        """Return the source of every registered function by name"""
+        return {name: k.source for name, k in self.kernels.items()}
+
+    def update(self, sources):
+        """Register the functions of sources not registered as they are"""
+        for name, source in sources.items():
+            if name not in self.kernels or \
+                    self.kernels[name].source != source:
+                self.kernels[name] = Kernel(name, source)
+                self.generation = next(_generations)
+
+    def load(self, sources):
+        """Replace every registered function by those in sources"""
+        self.kernels.clear()
+        self.generation = next(_generations)
+        for source in sources.values():
+            try:
+                self.define(source)
+            except Exception as e:
+                print(e)
@@ -0,0 +1,80 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import pickle
+import weakref
+
+from engine.compiler import parseValue
+from engine.formula import Formula
+from engine.styles import StyleLayer
+
+MAGIC_NUMBER = 0x2384E
+FILE_VERSION = 5
+VERSIONS = (4, 5)
+SECTIONS = (
+    'cells', 'formulas', 'alignment',
+    'fonts', 'foreground', 'background'
+    )
+STYLES = ('alignment', 'fonts', 'foreground', 'background')
+
+
+class Unpickler(pickle.Unpickler):
+    """Unpickler resolving formulas saved from the views without Qt"""
+    def find_class(self, module, name):
+        if (module, name) == ('MyView', 'Formula'):
+            return Formula
+        return super().find_class(module, name)
+
+
+def read(path):
+    """Return the sections of a .vnp file by name
+
+    Files saved before user defined functions were kept get an empty
+    functions section, text their cells hold as typed is parsed. Style
+    sections are given as style layers, version 4 files saved them as
+    dicts by cell and later ones as lists of rectangle writes.
+    """
+    with open(path, 'rb') as myFile:
+        if Unpickler(myFile).load() != MAGIC_NUMBER:
+            raise IOError('File type not recognized')
+        if Unpickler(myFile).load() not in VERSIONS:
+            raise IOError('File version not supported')
+        sections = {name: Unpickler(myFile).load() for name in SECTIONS}
+        try:
+            sections['functions'] = Unpickler(myFile).load()
+        except EOFError:
+            sections['functions'] = {}
+    sections['cells'] = {
+        key: parseValue(value) if isinstance(value, str) else value
+        for key, value in sections['cells'].items()
+        }
+    for name in STYLES:
+        sections[name] = StyleLayer(sections[name])
+    return sections
+
+
+def linkFormulas(formulas):
+    """Replace the addresses saved as formula edges by the formulas"""
+    for f in formulas.values():
+        subsequent = f.subsequent
+        precedence = f.precedence
+        f.subsequent = weakref.WeakSet(formulas[idx] for idx in subsequent)
+        f.precedence = weakref.WeakSet(formulas[idx] for idx in precedence)
+    return formulas
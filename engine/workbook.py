@@ -0,0 +1,361 @@
+# Copyright Román U. Martínez
+# Distributed under the terms of the GNU General Public License
+
+# --------------------------------------------------------------------
+#    This file is part of Visual Numpy.
+#
+#    Visual Numpy is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Visual Numpy is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Visual Numpy.  If not, see <https://www.gnu.org/licenses/>.
+# --------------------------------------------------------------------
+
+import contextlib
+import numbers
+import weakref
+
+import numpy as np
+
+from engine import graph, scheduler, udf
+from engine.compiler import CompiledFormula
+from engine.formula import Formula
+from engine.graph import CircularReferenceError
+from engine.spatial import RectIndex, intersects
+from engine.store import BlockStore, GatherCache
+
+
+class Workbook():
+    """Cells and formulas of a sheet along with their dependencies
+
+    Cells are kept in a tile store, see engine.store, which is also
+    the cells mapping. Formulas are indexed by the ranges they read and the
+    ranges they spill into, so the formulas an edit touches are found
+    without visiting them all. Nothing here depends on Qt, MyModel wraps
+    a workbook for the views. Evaluations are timed by profiler when
+    one is set and edits are written to its trace if any. Tiles are
+    mapped to files in directory when given and only resident of them
+    are kept in memory when given. Formulas call the user defined
+    functions of the workbook, held in functions, see engine.udf.
+    """
+    def __init__(
+            self, cells=None, formulas=None, profiler=None,
+            directory=None, resident=None):
+        self.directory = directory
+        self.resident = resident
+        self.cells = {} if cells is None else cells
+        self.formulas = {} if formulas is None else formulas
+        self.profiler = profiler
+        self.functions = udf.Registry()
+
+    @property
+    def cells(self):
+        """Return the cells mapping"""
+        return self.store
+
+    @property
+    def trace(self):
+        """Return the trace edits are written to or None"""
+        if self.profiler is None:
+            return None
+        return self.profiler.trace
+
+    @cells.setter
+    def cells(self, cells):
+        """Replace the cells, a plain mapping is copied into tiles
+
+        Tiles written from now on go to the directory of the workbook,
+        the tiles kept in memory follow its resident count.
+        """
+        if isinstance(cells, BlockStore):
+            self.store = cells
+            self.store.directory = self.directory
+            self.store.pageTo(self.resident)
+        else:
+            self.store = BlockStore(cells, self.directory, self.resident)
+
+    def mapTiles(self, directory):
+        """Keep the tiles mapped to files in directory or in memory if None"""
+        self.directory = directory
+        self.store.moveTo(directory)
+
+    def pageTiles(self, resident):
+        """Keep at most resident tiles in memory or every one if None"""
+        self.resident = resident
+        self.store.pageTo(resident)
+
+    @property
+    def formulas(self):
+        """Return the formulas mapping"""
+        return self._formulas
+
+    @formulas.setter
+    def formulas(self, formulas):
+        """Replace the formulas mapping and rebuild its indexes"""
+        self._formulas = formulas
+        if any(f.ord is None for f in formulas.values()):
+            graph.rebuild(formulas.values())
+        self.readers = RectIndex()
+        self.writers = RectIndex()
+        for f in formulas.values():
+            self.readers.insert(f, f.indexes)
+            self.writers.insert(f, f.domain)
+
+    def addFormula(self, formula):
+        """Store formula at its address replacing the previous one"""
+        self.removeFormula(formula.row, formula.col)
+        self.formulas[formula.row, formula.col] = formula
+        self.readers.insert(formula, formula.indexes)
+        self.writers.insert(formula, formula.domain)
+
+    def removeFormula(self, row, column):
+        """Remove the formula stored at the given address if any"""
+        if (f := self.formulas.pop((row, column), None)) is not None:
+            graph.unlink(f)
+            self.readers.remove(f)
+            self.writers.remove(f)
+
+    def writersOf(self, rects):
+        """Return the formulas whose domain intersects any of rects"""
+        found = set()
+        for rect in rects:
+            found |= self.writers.query(*rect)
+        return found
+
+    def readersOf(self, cells):
+        """Return the formulas reading any of the given cells"""
+        found = set()
+        for row, column in cells:
+            found |= self.readers.queryPoint(row, column)
+        return found
+
+    def gatherRange(self, r1, c1, r2, c2):
+        """Return the values of the given cell range as a numpy array"""
+        return self.store.gather(r1, c1, r2, c2)
+
+    def cellValue(self, row, column):
+        """Return the raw value stored at the given cell"""
+        return self.cells.get((row, column), '0')
+
+    def setCell(self, row, column, value):
+        """Store value at the given cell"""
+        self.store.setValue(row, column, value)
+
+    def clearCell(self, row, column):
+        """Remove the value stored at the given cell if any"""
+        if (row, column) in self.store:
+            self.store.clearValue(row, column)
+
+    def setBlock(self, row, column, array):
+        """Store a 2-D array with its top left value at the given cell
+
+        One dimensional arrays are stored as a column.
+        """
+        if array.ndim == 1:
+            array = array.reshape(-1, 1)
+        self.store.setBlock(row, column, array)
+
+    def createFormula(self, text, address, indexes, domain, compiled=None):
+        """Link a new formula to its neighbours and store it
+
+        The formula replaces the one at address unless both have the same
+        text. Raise CircularReferenceError, leaving the workbook as it
+        was, when the formula would depend on itself.
+        """
+        possibleF = Formula(
+            text,
+            address,
+            indexes,
+            domain,
+            weakref.WeakSet(),
+            weakref.WeakSet(),
+            compiled=compiled
+            )
+        if any(intersects(r, d) for r in indexes for d in domain):
+            raise CircularReferenceError(*address)
+        replaced = self.formulas.get(address)
+        for rect in domain:
+            for f_ in self.readers.query(*rect):
+                if f_ is not replaced:
+                    graph.link(possibleF, f_)
+        for f_ in self.writersOf(indexes):
+            if f_ is not replaced:
+                graph.link(f_, possibleF)
+        try:
+            graph.place(possibleF)
+        except CircularReferenceError:
+            graph.unlink(possibleF)
+            raise
+        if replaced is None or replaced.text != text:
+            self.addFormula(possibleF)
+            return possibleF
+        graph.unlink(possibleF)
+        return replaced
+
+    def moveFormula(self, formula, rowDiff, columnDiff):
+        """Link a copy of a stored formula as if moved by the given deltas
+
+        The copy is shifted only when no circular reference comes up,
+        storing it is left to the caller.
+        """
+        newDomain = tuple(
+            (r1 + rowDiff, c1 + columnDiff, r2 + rowDiff, c2 + columnDiff)
+            for r1, c1, r2, c2 in formula.domain
+            )
+        for rect in formula.indexes:
+            if any(intersects(rect, d) for d in newDomain):
+                raise CircularReferenceError(formula.row, formula.col)
+        formula.precedence = weakref.WeakSet()
+        formula.subsequent = weakref.WeakSet()
+        for rect in newDomain:
+            for f_ in self.readers.query(*rect):
+                graph.link(formula, f_)
+        for f_ in self.writersOf(formula.indexes):
+            graph.link(f_, formula)
+        try:
+            graph.place(formula)
+        except CircularReferenceError:
+            graph.unlink(formula)
+            raise
+        formula.domain = newDomain
+        formula.row = formula.row + rowDiff
+        formula.col = formula.col + columnDiff
+
+    def evaluate(self, compiled, cache=None, processes=None, address=None):
+        """Evaluate a compiled formula against the current cells
+
+        A result found in cache is reused, processes evaluates the
+        formula in a worker process when given. The evaluation is
+        profiled for the formula at address when given.
+        """
+        profiler = self.profiler if address is not None else None
+        if cache is None:
+            key = None
+        else:
+            key = cache.key(compiled, self.store, self.functions)
+        if key is not None and (result := cache.get(key)) is not None:
+            if profiler is not None:
+                profiler.count(*address, compiled.text, result)
+            return result
+        if processes is None and profiler is not None:
+            with profiler.measure(*address, compiled.text, 'gather'):
+                namespace = compiled.bindings(
+                    self.gatherRange,
+                    self.cellValue,
+                    self.functions
+                    )
+            with profiler.measure(*address, compiled.text, 'eval'):
+                result = compiled.run(namespace)
+        elif processes is None:
+            result = compiled.evaluate(
+                self.gatherRange,
+                self.cellValue,
+                self.functions
+                )
+        else:
+            result, = processes.evaluate(
+                [compiled],
+                self.gatherRange,
+                self.cellValue,
+                functions=self.functions
+                )
+            if isinstance(result, Exception):
+                raise result
+        if key is not None:
+            cache.put(key, result)
+        if profiler is not None:
+            profiler.count(*address, compiled.text, result)
+        return result
+
+    def recalculate(
+            self, formulas, apply=None,
+            executor=None, processes=None, cache=None, batch=None):
+        """Recalculate formulas given in calculation order level by level
+
+        Every result is passed to apply with its formula, spill being
+        the default. The results of a level are applied inside the
+        context batch returns when given, so a view can repaint them
+        at once. Each distinct range is gathered once per call.
+        """
+        apply = apply or self.spill
+        batch = batch or contextlib.nullcontext
+        gathers = GatherCache(self.store)
+        for level in scheduler.levels(formulas):
+            results = scheduler.evaluate(
+                level,
+                gathers,
+                self.cellValue,
+                executor,
+                processes=processes,
+                cache=cache,
+                profiler=self.profiler,
+                functions=self.functions
+                )
+            with batch():
+                for f, result in results:
+                    if isinstance(result, Exception):
+                        print(result)
+                        continue
+                    apply(f, result)
+
+    def spill(self, formula, result):
+        """Write the result of formula at its address"""
+        if self.profiler is not None:
+            with self.profiler.measure(
+                    formula.row, formula.col, formula.text, 'scatter'):
+                self.write(formula, result)
+        else:
+            self.write(formula, result)
+
+    def write(self, formula, result):
+        """Write result as values starting at the address of formula"""
+        if isinstance(result, np.ndarray) and 1 <= result.ndim <= 2:
+            self.setBlock(formula.row, formula.col, result)
+        elif isinstance(result, (np.ndarray, numbers.Number)):
+            self.setCell(formula.row, formula.col, result)
+
+    def enter(self, row, column, text):
+        """Evaluate text as the formula of a cell and recalculate
+
+        Return the formula stored for the cell.
+        """
+        formula = self.define(row, column, text)
+        self.recalculate(graph.affected(formula.precedence))
+        return formula
+
+    def define(self, row, column, text):
+        """Evaluate text as the formula of a cell leaving its dependents
+
+        Return the formula stored for the cell.
+        """
+        if self.profiler is not None:
+            with self.profiler.measure(row, column, text, 'parse'):
+                compiled = CompiledFormula(text)
+        else:
+            compiled = CompiledFormula(text)
+        result = self.evaluate(compiled, address=(row, column))
+        shape = np.shape(result) if np.ndim(result) <= 2 else ()
+        shape = (tuple(shape) + (1, 1))[:2]
+        domain = (row, column, row + shape[0] - 1, column + shape[1] - 1),
+        formula = self.createFormula(
+            text,
+            (row, column),
+            compiled.rects(),
+            domain,
+            compiled
+            )
+        self.spill(formula, result)
+        return formula
+
+    def edit(self, row, column, value):
+        """Store value at the given cell and recalculate its readers"""
+        self.removeFormula(row, column)
+        self.setCell(row, column, value)
+        self.recalculate(graph.affected(self.readersOf([(row, column)])))
@@ -37,6 +37,10 @@ formula_mode = False
 historyIndex = -1
 drag = False
 domainHighlight = False
+workers = None
+backgroundRecalc = 200
+cacheBudget = 256 * 2**20
+residentTiles = 0
 REGEXP1 = re.compile(r'\[[A-Z]{1,3}[0-9]+:[A-Z]{1,3}[0-9]+]')
 REGEXP2 = re.compile(r'[A-Z]{1,3}[0-9]+')
 REGEXP3 = re.compile(r'[A-Z]{1,3}[0-9]+$')
@@ -0,0 +1,663 @@
+import sys
+import os
+import copy
+import gc
+import pickle
+import subprocess
+import threading
+import tracemalloc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import numpy as np
+
+sys.path.append(os.path.dirname(__file__)+'/..')
+from engine import fused, graph, replay, scheduler, trace, udf
+from engine.cache import ResultCache
+from engine.compiler import CompiledFormula, parseNumber, parseValue
+from engine.pager import Pager
+from engine.processes import ProcessPool
+from engine.profiler import PHASES, Profiler
+from engine.store import BlockStore, GatherCache, TILE_ROWS
+from engine.spatial import RectIndex
+from engine.styles import END, Palette, StyleLayer
+from engine.workbook import Workbook
+
+
+def test_compiledBindings():
+    compiled = CompiledFormula(' [A1:B3].sum()*C4+C4-[A1:B3].max()')
+    assert compiled.ranges == [((0, 0), (2, 1))]
+    assert compiled.scalars == [(3, 2)]
+    assert compiled.source == '_r0.sum()*_s0+_s0-_r0.max()'
+
+
+def test_compiledEvaluate():
+    compiled = CompiledFormula('[A1:A3]*B1')
+    result = compiled.evaluate(
+        lambda r1, c1, r2, c2: np.arange(r2 - r1 + 1).reshape(-1, 1),
+        lambda r, c: '2'
+        )
+    assert result.ravel().tolist() == [0, 2, 4]
+
+
+def test_compiledCopies():
+    compiled = CompiledFormula('np.arange(A1)')
+    assert copy.deepcopy(compiled) is compiled
+    restored = pickle.loads(pickle.dumps(compiled))
+    assert restored.source == compiled.source
+
+
+@pytest.mark.parametrize(
+    'text, expected', [
+        ('3', 3),
+        (' 2.5', 2.5),
+        ('1+2j', 1+2j),
+        ]
+    )
+def test_parseNumber(text, expected):
+    value = parseNumber(text)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+def test_storeGather():
+    cells = {(r, c): r * 1000 + c for r in range(300) for c in range(3)}
+    cells[5, 1] = '7'
+    store = BlockStore(cells)
+    array = store.gather(250, 0, 299, 2)
+    assert array.shape == (50, 3)
+    assert array[10, 2] == 260 * 1000 + 2
+    assert store.gather(4, 1, 5, 1).ravel().tolist() == [4001, 7]
+    assert store.gather(400, 0, 401, 0).ravel().tolist() == [0, 0]
+    store.setValue(260, 1, 'text')
+    with pytest.raises(ValueError):
+        store.gather(250, 0, 299, 2)
+    store.clearValue(260, 1)
+    assert store.gather(260, 1, 260, 1)[0, 0] == 0
+
+
+@pytest.mark.parametrize(
+    'cells, dtype', [
+        ({(0, 0): True, (1, 0): False}, np.bool_),
+        ({(0, 0): 3, (1, 0): '4'}, np.int64),
+        ({(0, 0): 3, (1, 0): 4+0j}, np.float64),
+        ({(0, 0): '2.5', (1, 0): 1}, np.float64),
+        ({(0, 0): 1j, (1, 0): 1}, np.complex128),
+        ({}, np.float64),
+        ]
+    )
+def test_storeDtype(cells, dtype):
+    assert BlockStore(cells).gather(0, 0, 1, 0).dtype == dtype
+
+
+def test_storeLargeIntegers():
+    big = 2**53 + 1
+    store = BlockStore({(0, 0): big, (2, 0): -big})
+    store[1, 0] = 0.5
+    assert store.tile(0, 0).values.dtype == np.float64
+    assert store[0, 0] == big and store[2, 0] == -big
+    store[3, 0] = big + 2
+    assert store[3, 0] == big + 2
+    store.setBlock(0, 1, np.array([[big], [2]]))
+    assert store[0, 1] == big and type(store[1, 1]) is int
+    assert store.gather(0, 1, 1, 1).ravel().tolist() == [big, 2]
+    assert store.gather(3, 0, 3, 0).dtype == np.int64
+    assert store.gather(3, 0, 3, 0)[0, 0] == big + 2
+    store[2, 1] = 1j
+    assert store[0, 1] == big and store[0, 0] == big
+
+
+def test_storeDtypePerRange():
+    store = BlockStore({(0, 0): 1, (1, 0): 2, (0, 1): 1.5j})
+    assert store.gather(0, 0, 1, 0).dtype == np.int64
+    assert store.gather(0, 0, 1, 1).dtype == np.complex128
+
+
+def test_rectIndex():
+    index = RectIndex()
+    index.insert('a', [(0, 0, 99, 0), (5, 3, 5, 3)])
+    index.insert('b', [(50, 0, 1000, 2)])
+    assert index.queryPoint(60, 0) == {'a', 'b'}
+    assert index.queryPoint(5, 3) == {'a'}
+    assert index.queryPoint(100, 1) == {'b'}
+    assert index.queryPoint(5, 1) == set()
+    assert index.query(0, 1, 10, 5) == {'a'}
+    assert index.query(900, 0, 2000, 0) == {'b'}
+    index.remove('a')
+    assert index.queryPoint(60, 0) == {'b'}
+    assert index.query(0, 0, 10, 5) == set()
+    assert len(index) == 1
+
+
+class Node():
+    def __init__(self, name):
+        self.row, self.col = name, 0
+        self.precedence = weakref.WeakSet()
+        self.subsequent = weakref.WeakSet()
+        self.ord = graph.nextOrd()
+
+
+def link(source, target):
+    graph.link(source, target)
+    graph.place(target)
+
+
+def test_rectIndexScaling():
+    class Nodes(dict):
+        lookups = 0
+
+        def get(self, key):
+            Nodes.lookups += 1
+            return super().get(key)
+
+    def pointLookups(owners):
+        index = RectIndex()
+        index.nodes = Nodes()
+        for column in range(owners):
+            index.insert(column, [(0, column, 99, column)])
+        assert index.query(10, 5, 20, 7) == {5, 6, 7}
+        Nodes.lookups = 0
+        for row in range(100):
+            column = row * 7 % owners
+            assert index.queryPoint(row, column) == {column}
+        return Nodes.lookups
+
+    assert pointLookups(30000) == pointLookups(1000) <= 100 * 7
+
+
+def test_graphOrder():
+    a, b, c, d = (Node(n) for n in 'abcd')
+    link(d, c)
+    link(c, b)
+    link(b, a)
+    assert graph.affected([d]) == [d, c, b, a]
+    assert graph.affected([b]) == [b, a]
+    for n in (a, b, c, d):
+        n.ord = None
+    graph.rebuild([a, b, c, d])
+    assert graph.affected([d]) == [d, c, b, a]
+
+
+def test_graphCycle():
+    a, b = Node('a'), Node('b')
+    link(a, b)
+    with pytest.raises(graph.CircularReferenceError):
+        link(b, a)
+
+
+def test_schedulerLevels():
+    a, b, c, d = (Node(n) for n in 'abcd')
+    for source, target in ((a, b), (a, c), (b, d), (c, d)):
+        link(source, target)
+    grouped = scheduler.levels(graph.affected([a]))
+    assert [set(level) for level in grouped] == [{a}, {b, c}, {d}]
+
+
+def test_schedulerEvaluate():
+    formulas = [Node('a'), Node('b')]
+    formulas[0].compiled = CompiledFormula('A1*2')
+    formulas[1].compiled = CompiledFormula('1/0')
+    with ThreadPoolExecutor(2) as executor:
+        results = scheduler.evaluate(
+            formulas, BlockStore(), lambda r, c: '3', executor
+            )
+    assert results[0] == (formulas[0], 6)
+    assert isinstance(results[1][1], ZeroDivisionError)
+
+
+def test_processPool():
+    pool = ProcessPool(1)
+    values = np.arange(100000.0).reshape(-1, 1)
+    compiled = [
+        CompiledFormula('[A1:A100000].sum()*B1'),
+        CompiledFormula('np.vectorize(lambda x: x + 1)([A1:A3])'),
+        CompiledFormula('[A1:A2]/C1')
+        ]
+    try:
+        results = pool.evaluate(
+            compiled,
+            lambda r1, c1, r2, c2: values[r1:r2 + 1, c1:c2 + 1],
+            lambda r, c: {(0, 1): '2', (0, 2): 'text'}[r, c]
+            )
+    finally:
+        pool.executor.shutdown()
+    assert results[0] == values.sum() * 2
+    assert results[1].ravel().tolist() == [1, 2, 3]
+    assert isinstance(results[2], ValueError)
+
+
+def test_storeVersion():
+    store = BlockStore({(0, 0): 1, (40, 0): 2})
+    version = store.version(0, 0, 9, 0)
+    store.setValue(40, 0, 3)
+    assert store.version(0, 0, 9, 0) == version
+    snapshot = store.snapshot()
+    store.setBlock(5, 0, np.ones((2, 1)))
+    assert store.version(0, 0, 9, 0) > version
+    assert snapshot.version(0, 0, 9, 0) == version
+    assert snapshot.gather(5, 0, 6, 0).ravel().tolist() == [0, 0]
+
+
+def test_storePartialSnapshot():
+    for resident in (None, 1):
+        store = BlockStore(
+            {(0, 0): 1, (TILE_ROWS, 0): 2, (0, 300): 3},
+            resident=resident
+            )
+        snapshot = store.snapshot([(0, 0, TILE_ROWS, 0)])
+        assert sorted(snapshot.tiles) == [(0, 0), (1, 0)]
+        tile = store.tile(0, 300)
+        store[0, 300] = 4
+        if resident is None:
+            assert store.shared == {(0, 0), (1, 0)}
+            assert store.tile(0, 300) is tile
+        store[0, 0] = store[TILE_ROWS, 0] = 5
+        assert snapshot[0, 0] == 1 and snapshot[TILE_ROWS, 0] == 2
+
+
+def test_resultCache():
+    cache = ResultCache(1000)
+    store = BlockStore({(0, 0): 1})
+    formula = Node('a')
+    formula.compiled = CompiledFormula('[A1:A2]*2')
+    formula.indexes = formula.compiled.rects()
+    scheduler.evaluate([formula], store, None, cache=cache)
+    key = cache.key(formula.compiled, store)
+    assert cache.get(key).ravel().tolist() == [2, 0]
+    store.setValue(1, 0, 5)
+    assert cache.get(cache.key(formula.compiled, store)) is None
+    cache.put(('big', ()), np.zeros(124))
+    assert cache.get(key) is None
+    assert cache.size <= cache.budget
+    assert cache.key(CompiledFormula('np.random.rand(3)'), store) is None
+
+
+def test_resultCacheFunctions():
+    cache = ResultCache(1000)
+    book = Workbook()
+    book.functions.define('def twice(x):\n    return x * 2\n')
+    compiled = CompiledFormula('twice(3)')
+    assert book.evaluate(compiled, cache) == 6
+    book.functions.load({})
+    with pytest.raises(NameError):
+        book.evaluate(compiled, cache)
+    book.functions.define('def twice(x):\n    return x * 3\n')
+    assert book.evaluate(compiled, cache) == 9
+
+
+def test_resultCacheVolatile():
+    cache = ResultCache(1000)
+    store = BlockStore({(0, 0): 2})
+    formula = Node('a')
+    formula.compiled = CompiledFormula('A1*np.random.random()')
+    formula.indexes = formula.compiled.rects()
+    (f, result), = scheduler.evaluate(
+        [formula], store, lambda r, c: store[r, c], cache=cache
+        )
+    assert not isinstance(result, Exception) and 0 <= result < 2
+    assert cache.size == 0 and not cache.results
+
+
+def test_gatherCache():
+    store = BlockStore({(0, 0): 1, (1, 0): 2})
+    gathers = GatherCache(store)
+    array = gathers.gather(0, 0, 1, 0)
+    assert gathers.gather(0, 0, 1, 0) is array
+    assert not array.flags.writeable
+    store.setValue(1, 0, 3)
+    assert gathers.gather(0, 0, 1, 0).ravel().tolist() == [1, 3]
+    assert array.ravel().tolist() == [1, 2]
+
+
+def test_gatherCacheParallel():
+    store = BlockStore({(0, 0): 1, (0, 1): 2})
+    barrier = threading.Barrier(2, timeout=5)
+    gathered = []
+
+    class Slow():
+        def version(self, *rect):
+            return store.version(*rect)
+
+        def gather(self, *rect):
+            gathered.append(rect)
+            if rect[1] < 2:
+                barrier.wait()
+            return store.gather(*rect)
+
+    gathers = GatherCache(Slow())
+    ranges = [(0, 0, 0, 0), (0, 1, 0, 1), (0, 0, 0, 0), (0, 1, 0, 1)]
+    with ThreadPoolExecutor(4) as executor:
+        arrays = list(executor.map(lambda r: gathers.gather(*r), ranges))
+    assert arrays[0] is arrays[2] and arrays[1] is arrays[3]
+    assert sorted(gathered) == ranges[:2]
+    with pytest.raises(ValueError):
+        GatherCache(BlockStore({(0, 0): 'text'})).gather(0, 0, 0, 0)
+
+
+def test_workbook():
+    book = Workbook()
+    book.setCell(0, 0, 2)
+    book.enter(0, 1, '[A1:A3]*2')
+    book.enter(0, 2, '[B1:B3].sum()')
+    assert book.cells[0, 2] == 4
+    book.edit(1, 0, 5)
+    assert book.cells[1, 1] == 10
+    assert book.cells[0, 2] == 14
+    with pytest.raises(graph.CircularReferenceError):
+        book.enter(1, 0, 'C1+1')
+    assert book.cells[1, 0] == 5
+    formula = book.formulas[0, 2]
+    book.moveFormula(formula, 2, 0)
+    assert (formula.row, formula.col) == (2, 2)
+    with pytest.raises(graph.CircularReferenceError):
+        book.moveFormula(book.formulas[0, 1], 0, -1)
+
+
+def test_workbookQtFree():
+    code = 'import sys, engine.workbook; print("PySide6" in sys.modules)'
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(__file__) + '/..',
+        capture_output=True,
+        text=True
+        )
+    assert result.stdout.strip() == 'False'
+
+
+def test_fusedEvaluate(monkeypatch):
+    monkeypatch.setattr(fused, 'numexpr', None)
+    monkeypatch.setattr(fused, 'CHUNK_SIZE', 1000)
+    a = np.arange(2 ** 15 + 7, dtype=float).reshape(-1, 1)
+    b = np.arange(2 ** 15 + 7).reshape(-1, 1)
+    compiled = CompiledFormula('np.sqrt([A1:A3]*2+[B1:B3]**2)-C1')
+    assert compiled.fused is not None
+    ranges = {0: a, 1: b}
+    result = compiled.fused.evaluate(compiled.bindings(
+        lambda r1, c1, r2, c2: ranges[c1],
+        lambda row, column: 3
+        ))
+    assert result.shape == a.shape
+    assert np.allclose(result, np.sqrt(a * 2 + b ** 2) - 3)
+    small = compiled.bindings(
+        lambda r1, c1, r2, c2: ranges[c1][:10],
+        lambda row, column: 3
+        )
+    assert compiled.fused.evaluate(small) is None
+    tile = np.arange((2 ** 15 + 7) * 4.0).reshape(-1, 4)
+    ranges = {0: tile[:, :2], 1: tile[:, 2:]}
+    namespace = compiled.bindings(
+        lambda r1, c1, r2, c2: ranges[c1],
+        lambda row, column: 3
+        )
+    for name, value in namespace.items():
+        if isinstance(value, np.ndarray):
+            assert not value.flags.c_contiguous
+    tracemalloc.start()
+    result = compiled.fused.evaluate(namespace)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 1.5 * result.nbytes
+    a, b = tile[:, :2], tile[:, 2:]
+    assert np.allclose(result, np.sqrt(a * 2 + b ** 2) - 3)
+    assert CompiledFormula('[A1:A3].sum()*2').fused is None
+    assert CompiledFormula('C1*2').fused is None
+
+
+def test_udf():
+    functions = udf.Registry()
+    name = functions.define('def twice(x):\n    return x * 2\n')
+    assert name == 'twice'
+    compiled = CompiledFormula('twice([A1:A2]).sum()+twice(B1)')
+    result = compiled.evaluate(
+        lambda r1, c1, r2, c2: np.ones((r2 - r1 + 1, c2 - c1 + 1)),
+        lambda row, column: 3,
+        functions
+        )
+    assert result == 10
+    assert functions.sources() == {
+        'twice': 'def twice(x):\n    return x * 2\n'
+        }
+    for source in ('x = 1', 'def A1(x):\n    return x\n'):
+        with pytest.raises(ValueError):
+            functions.define(source)
+    first = Workbook({(0, 0): 4})
+    second = Workbook({(0, 0): 4})
+    first.functions.load(functions.sources())
+    second.functions.define('def twice(x):\n    return x * 3\n')
+    first.enter(0, 1, 'twice(A1)')
+    second.enter(0, 1, 'twice(A1)')
+    assert first.cells[0, 1] == 8 and second.cells[0, 1] == 12
+    second.functions.load({})
+    assert 'twice' in first.functions.functions()
+    pool = ProcessPool(1)
+    try:
+        results = pool.evaluate(
+            [compiled, compiled],
+            lambda r1, c1, r2, c2: np.ones((r2 - r1 + 1, c2 - c1 + 1)),
+            lambda row, column: 3,
+            functions=first.functions
+            )
+        assert results[0] == 10
+        results = pool.evaluate(
+            [compiled],
+            lambda r1, c1, r2, c2: np.ones((r2 - r1 + 1, c2 - c1 + 1)),
+            lambda row, column: 3,
+            functions=second.functions
+            )
+        assert isinstance(results[0], NameError)
+    finally:
+        pool.executor.shutdown()
+    functions.load({})
+    assert not functions.functions()
+
+
+def test_profiler():
+    profiler = Profiler()
+    book = Workbook(profiler=profiler)
+    book.enter(0, 0, '1')
+    assert not profiler.stats
+    profiler.enabled = True
+    book.enter(0, 1, 'np.arange(4)*A1')
+    book.enter(0, 2, '[B1:B4].sum()')
+    book.edit(0, 0, 2)
+    report = profiler.report()
+    assert sorted(s.text for s in report) == [
+        '[B1:B4].sum()', 'np.arange(4)*A1'
+        ]
+    assert all(s.calls == 2 for s in report)
+    stats = profiler.stats[0, 1, 'np.arange(4)*A1']
+    assert stats.size == 32
+    assert all(getattr(stats, phase) > 0 for phase in PHASES)
+    assert stats.asDict()['total'] == stats.total
+    assert profiler.report('size')[0] is stats
+    profiler.reset()
+    assert not profiler.report()
+
+
+def test_trace(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    book = Workbook()
+    book.setCell(0, 0, 1)
+    formula = book.enter(0, 1, '[A1:A2]*2')
+    writer = trace.TraceWriter(path)
+    writer.edit(0, 0, 3 + 1j)
+    writer.order([formula], [formula])
+    writer.sample(0, 1, 'eval', 0.5)
+    writer.formula(1, 0, '4')
+    writer.edit(2, 0, np.zeros(3))
+    writer.close()
+    records = list(trace.read(path))
+    assert [r['event'] for r in records] == [
+        'start', 'edit', 'order', 'sample', 'formula', 'edit'
+        ]
+    assert trace.decode(records[1]['value']) == 3 + 1j
+    assert records[2]['order'][0]['shapes'] == [[2, 1]]
+    assert trace.decode(records[5]['value']) is None
+    book.profiler = Profiler()
+    cascades = replay.replay(book, records)
+    assert len(cascades) == 1
+    assert cascades[0]['formulas'] == 1
+    assert cascades[0]['traced'] == 0.5
+    assert cascades[0]['replayed'] > 0
+    assert book.cells[0, 1] == 6 + 2j
+    assert book.formulas[1, 0].text == '4'
+
+
+def test_storeMapping():
+    store = BlockStore({(0, 0): '5', (1, 0): 7, (300, 2): 'text'})
+    store[2, 0] = 2.5 + 1j
+    store[3, 0] = np.arange(3)
+    store[4, 0] = 2 ** 70
+    assert store[0, 0] == '5' and store[1, 0] == 7
+    assert type(store[1, 0]) is int
+    assert store[2, 0] == 2.5 + 1j and store[300, 2] == 'text'
+    assert store[3, 0].tolist() == [0, 1, 2] and store[4, 0] == 2 ** 70
+    assert (5, 0) not in store and store.get((5, 0), '') == ''
+    assert len(store) == 6
+    assert sorted(store) == [(0, 0), (1, 0), (2, 0), (3, 0), (4, 0), (300, 2)]
+    copied = store.copy()
+    del store[300, 2]
+    store.setBlock(0, 0, np.ones((4, 1)))
+    assert (300, 2) not in store and store[0, 0] == 1.0
+    assert copied[300, 2] == 'text' and copied[0, 0] == '5'
+    assert dict(copied.items())[1, 0] == 7
+    with pytest.raises(KeyError):
+        del store[300, 2]
+
+
+@pytest.mark.parametrize(
+    'text, expected', [
+        ('12', 12),
+        (' -2.5 ', -2.5),
+        ('3+4j', 3 + 4j),
+        ('True', True),
+        ('abc', 'abc'),
+        ('1e999', '1e999'),
+        ('', '')
+        ]
+    )
+def test_parseValue(text, expected):
+    value = parseValue(text)
+    assert value == expected and type(value) is type(expected)
+
+
+def test_styleLayer():
+    layer = StyleLayer({(5, 2): 'cell'})
+    layer.setRange(0, 2, END, 2, 'column')
+    assert len(layer) == 1 and layer[5, 2] == 'column'
+    assert layer[10 ** 6, 2] == 'column' and (0, 1) not in layer
+    layer[5, 2] = 'cell'
+    layer.setRange(3, 0, 4, 4, 'block')
+    layer.transform(0, 1, 5, 3, lambda v: (v or '') + '!')
+    assert layer[5, 2] == 'cell!' and layer[3, 1] == 'block!'
+    assert layer[1, 2] == 'column!' and layer[6, 2] == 'column'
+    assert layer[0, 1] == '!' and layer[3, 4] == 'block'
+    copied = layer.copy()
+    layer.setRange(0, 0, END, END, 'all')
+    assert len(layer) == 1 and layer.get((5, 2)) == 'all'
+    assert copied[5, 2] == 'cell!'
+    restored = StyleLayer(copied.map(str.upper).entries())
+    assert restored[3, 1] == 'BLOCK!' and restored[6, 2] == 'COLUMN'
+    assert restored.overlaps(6, 0, 9, 5) and not restored.overlaps(6, 0, 9, 1)
+
+
+def test_stylePalette():
+    palette = Palette(str.lower)
+    layer = StyleLayer(palette=palette)
+    first = 'Bold'
+    layer[0, 0] = first
+    layer.setRange(1, 0, 9, 0, 'BOLD')
+    layer[0, 1] = 'plain'
+    assert len(palette) == 2 and layer[5, 0] is first
+    assert layer.points[0, 0][1] == 0 and layer.points[0, 1][1] == 1
+    calls = []
+
+    def upper(value):
+        calls.append(value)
+        return value.upper()
+    layer.transform(0, 0, 9, 1, upper, '')
+    assert calls == ['', 'Bold', 'plain'] and layer[9, 1] == ''
+    assert layer[0, 0] is first and layer[9, 0] is first
+    assert layer.copy().palette is palette
+    mapped = layer.map(str.title, Palette(str))
+    assert mapped[3, 0] is mapped[0, 0] and mapped[0, 1] == 'Plain'
+
+
+def test_mappedStore(tmp_path):
+    store = BlockStore({(0, 0): 1, (1, 0): 'text'}, str(tmp_path))
+    store.setBlock(0, 256, np.arange(TILE_ROWS * 128).reshape(-1, 128))
+    tile = store.tile(0, 0)
+    assert isinstance(tile.values, np.memmap)
+    assert isinstance(tile.kinds, np.memmap)
+    snapshot = store.snapshot()
+    store[2, 0] = 2.5
+    assert isinstance(store.tile(0, 0).values, np.memmap)
+    assert store.tile(0, 0).values.dtype == np.float64
+    assert snapshot.tile(0, 0) is tile and (2, 0) not in snapshot
+    assert store[1, 0] == 'text' and store[0, 0] == 1
+    view = store.gather(0, 256, TILE_ROWS - 1, 383)
+    assert not view.flags.writeable and type(view) is np.ndarray
+    assert np.shares_memory(view, store.tile(0, 256).values)
+    store[0, 256] = -1
+    assert view[0, 0] == 0 and store.gather(0, 256, 0, 256)[0, 0] == -1
+    store.moveTo(None)
+    assert type(store.tile(0, 0).values) is np.ndarray
+    assert store[2, 0] == 2.5 and store[TILE_ROWS - 1, 383] == len(store) - 4
+    book = Workbook(directory=str(tmp_path))
+    book.cells = {(0, 0): 3}
+    book.enter(0, 1, 'A1*2')
+    assert isinstance(book.store.tile(0, 0).values, np.memmap)
+    assert book.cells[0, 1] == 6
+
+
+def test_pager():
+    store = BlockStore({(0, 0): 'text', (0, 1): 2 ** 70}, resident=2)
+    block = np.arange(3 * TILE_ROWS * 2.0).reshape(-1, 2)
+    store.setBlock(TILE_ROWS, 0, block)
+    tiles = store.tiles
+    assert isinstance(tiles, Pager) and len(tiles) == 4
+    assert len(tiles.tiles) == 2 and tiles.counters['evictions'] == 2
+    tiles.reset()
+    assert store[0, 0] == 'text' and store[0, 1] == 2 ** 70
+    assert tiles.counters['misses'] == 1 and tiles.counters['hits'] == 1
+    gathered = store.gather(TILE_ROWS, 0, 4 * TILE_ROWS - 1, 1)
+    size = tiles.spill.size
+    assert (gathered == block).all()
+    store.gather(0, 1, 4 * TILE_ROWS - 1, 1)
+    assert tiles.spill.size == size
+    tile = store.gather(TILE_ROWS, 0, 2 * TILE_ROWS - 1, TILE_ROWS - 1)
+    assert tile.flags.owndata and not store.shared
+    snapshot = store.snapshot()
+    assert not snapshot.tiles.tiles and not store.shared
+    store[TILE_ROWS, 0] = -1
+    store.tiles.resize(1)
+    assert snapshot[TILE_ROWS, 0] == 0 and store[TILE_ROWS, 0] == -1
+    live = {id(tile) for tile in store.tiles.tiles.values()}
+    assert len(snapshot.tiles.tiles) == 1
+    assert not live & {id(t) for t in snapshot.tiles.tiles.values()}
+    assert snapshot.tiles.counters is not tiles.counters
+    assert len(store) == len(snapshot) == block.size + 2
+    store.pageTo(None)
+    assert type(store.tiles) is dict and store[4 * TILE_ROWS - 1, 1] == 1535
+    store = BlockStore(resident=1)
+    spill = store.tiles.spill
+    size = 0
+    for i in range(200):
+        store[0, 0] = store[TILE_ROWS, 0] = i
+        store[0, 0]
+        if i < 10:
+            size = max(size, spill.size)
+        assert spill.size <= 2 * size
+    snapshot = store.snapshot()
+    for i in range(50):
+        store[0, 0] = store[TILE_ROWS, 0] = -i
+        store[0, 0]
+    assert snapshot[TILE_ROWS, 0] == 199 and store[TILE_ROWS, 0] == -49
+    del snapshot
+    gc.collect()
+    assert spill.unused() and spill.size <= 3 * size
+    book = Workbook(resident=1)
+    book.cells = {(0, 0): 3, (TILE_ROWS, 0): 4}
+    book.enter(0, 1, 'A1*A{}'.format(TILE_ROWS + 1))
+    assert isinstance(book.store.tiles, Pager) and book.cells[0, 1] == 12
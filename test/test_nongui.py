@@ -3,12 +3,18 @@ import os
 import csv
 
 import pytest
+import numpy as np
 from PySide6.QtCore import Qt, QEvent, QItemSelectionModel, QItemSelection
 from PySide6.QtWidgets import QStyleOptionViewItem
-from PySide6.QtGui import QKeyEvent
+from PySide6.QtGui import QFont, QKeyEvent
 
 sys.path.append(os.path.dirname(__file__)+'/..')
+from MyModel import MyModel
 from MyWidgets import MainWindow
+import globals_
+from engine import replay, trace
+from engine.compiler import parseValue
+from engine.profiler import Profiler
 
 
 dirname = os.path.dirname(__file__)
@@ -182,3 +188,283 @@ def test_createFormula(app):
         )
     command.event(event)
     assert model.formulas[0, 0]
+
+
+def test_setBlock(app):
+    model = app.view.model()
+    emitted = []
+
+    def record(*args):
+        emitted.append(args)
+
+    model.dataChanged.connect(record)
+    block = np.arange(6).reshape(2, 3)
+    model.setBlock(60, 60, block)
+    model.dataChanged.disconnect(record)
+    assert len(emitted) == 1
+    assert model.rowCount() >= 62
+    assert model.dataContainer[61, 62] == 5
+    assert model.gatherRange(60, 60, 61, 62).tolist() == block.tolist()
+    app.createNew()
+
+
+def test_formulaRects(app):
+    model = app.view.model()
+    app.calculate('[A1:B2].sum()+C3', 4, 4)
+    app.calculate('np.arange(3)', 0, 6)
+    assert model.formulas[4, 4].indexes == ((0, 0, 1, 1), (2, 2, 2, 2))
+    assert model.formulas[4, 4].domain == ((4, 4, 4, 4),)
+    assert model.formulas[0, 6].domain == ((0, 6, 2, 6),)
+    app.calculate('[G1:G3].sum()', 1, 6)
+    assert (1, 6) not in model.formulas
+    app.createNew()
+
+
+def test_circularReference(app):
+    model = app.view.model()
+    app.calculate('A1*2', 0, 1)
+    app.calculate('B1+1', 0, 2)
+    app.calculate('C1-1', 0, 0)
+    assert (0, 0) not in model.formulas
+    app.calculate('5', 0, 0)
+    assert model.dataContainer[0, 2] == 11
+    app.calculate('[A1:A2].sum()', 0, 1)
+    assert model.formulas[0, 1].ord < model.formulas[0, 2].ord
+    app.createNew()
+
+
+def test_backgroundRecalc(app, qtbot, monkeypatch):
+    model = app.view.model()
+    monkeypatch.setattr(globals_, 'backgroundRecalc', 2)
+    app.calculate('1', 0, 0)
+    app.calculate('A1+1', 0, 1)
+    app.calculate('B1+1', 0, 2)
+    app.calculate('[A1:C1].sum()', 0, 3)
+    assert model.dataContainer[0, 3] == 6
+    app.calculate('10', 0, 0)
+    assert model.dataContainer[0, 3] == 6
+    qtbot.waitUntil(lambda: model.dataContainer[0, 3] == 33)
+    assert not app.recalcPending
+    app.createNew()
+
+
+def test_undoStore(app):
+    model = app.view.model()
+    app.calculate('[A1:A2].sum()', 0, 1)
+    version = model.store.version(0, 0, 1, 0)
+    app.calculate('4', 0, 0)
+    assert model.dataContainer[0, 1] == 4
+    assert model.store.version(0, 0, 1, 0) > version
+    app.view.undo()
+    assert model.gatherRange(0, 0, 1, 0).ravel().tolist() == [0, 0]
+    assert model.store.version(0, 0, 1, 0) == version
+    app.createNew()
+
+
+def test_batch(app):
+    model = app.view.model()
+    app.calculate('[A1:A3].sum()', 0, 1)
+    emitted = []
+
+    def record(*args):
+        emitted.append(args)
+
+    model.dataChanged.connect(record)
+    with model.batch():
+        for row in range(3):
+            model.setData(model.index(row, 0), row + 1)
+        assert model.dataContainer[0, 1] == 0
+    model.dataChanged.disconnect(record)
+    assert model.dataContainer[0, 1] == 6
+    assert emitted[-1][0].row() == 0 and emitted[-1][1].row() == 2
+    assert len(emitted) == 2
+    app.createNew()
+
+
+def test_batchLevel(app):
+    model = app.view.model()
+    app.calculate('1', 0, 0)
+    for column in range(1, 5):
+        app.calculate('A1*{}'.format(column), 0, column)
+    app.calculate('[B1:E1].sum()', 1, 0)
+    history = len(model.history)
+    emitted = []
+
+    def record(*args):
+        emitted.append((args[0].row(), args[0].column()))
+
+    model.dataChanged.connect(record)
+    model.setData(model.index(0, 0), '2')
+    model.dataChanged.disconnect(record)
+    assert model.dataContainer[1, 0] == 20
+    assert emitted == [(0, 1), (1, 0)]
+    assert len(model.history) == history
+    app.createNew()
+
+
+def test_functions(app):
+    model = app.view.model()
+    model.engine.functions.define('def twice(x):\n    return x * 2\n')
+    app.calculate('4', 0, 0)
+    app.calculate('twice(A1)', 0, 1)
+    assert model.dataContainer[0, 1] == 8
+    app.saveFileAs(dirname + '/testFunctions')
+    app.createNew()
+    assert not model.engine.functions.functions()
+    try:
+        app.loadFile(dirname + '/testFunctions.vnp')
+    finally:
+        os.remove(dirname + '/testFunctions.vnp')
+    assert 'twice' in model.engine.functions.functions()
+    app.calculate('5', 0, 0)
+    assert model.dataContainer[0, 1] == 10
+    app.createNew()
+
+
+def test_profilerPanel(app):
+    app.profilerPanel.recordBox.setChecked(True)
+    app.calculate('2', 0, 0)
+    app.calculate('[A1:A2].sum()*3', 0, 1)
+    app.calculate('5', 0, 0)
+    app.profilerPanel.recordBox.setChecked(False)
+    table = app.profilerPanel.table
+    rows = {table.item(r, 0).text(): r for r in range(table.rowCount())}
+    assert table.item(rows['B1'], 1).text() == '[A1:A2].sum()*3'
+    assert table.item(rows['B1'], 2).data(Qt.DisplayRole) == 2
+    assert app.profiler.stats[0, 1, '[A1:A2].sum()*3'].scatter > 0
+    app.profilerPanel.reset()
+    assert table.rowCount() == 0
+    app.createNew()
+
+
+def test_trace(app, tmp_path, capsys):
+    model = app.view.model()
+    app.calculate('1', 0, 0)
+    app.calculate('[A1:A2]*2', 0, 1)
+    app.saveFileAs(str(tmp_path / 'traced'))
+    app.recordTrace(True, str(tmp_path / 'trace.jsonl'))
+    assert app.traceAction.isChecked()
+    model.setData(model.index(1, 0), '5')
+    app.calculate('[B1:B2].sum()', 0, 2)
+    app.createNew()
+    assert app.profiler.trace is None
+    cascades = replay.main([
+        str(tmp_path / 'traced.vnp'),
+        str(tmp_path / 'trace.jsonl')
+        ])
+    assert [c['formulas'] for c in cascades] == [1, 0]
+    assert 'replayed ms' in capsys.readouterr().out
+
+
+def test_traceModel(qapp, tmp_path):
+    model = MyModel()
+    model.setData(model.index(0, 0), '1')
+    model.engine.profiler = Profiler()
+    model.engine.profiler.trace = trace.TraceWriter(str(tmp_path / 't.jsonl'))
+    model.setData(model.index(1, 0), '2')
+    model.engine.profiler.trace.close()
+    events = trace.read(str(tmp_path / 't.jsonl'))
+    assert [e['cell'] for e in events if e['event'] == 'edit'] == [[1, 0]]
+
+
+def test_parsedEntry(app):
+    model = app.view.model()
+    model.thousandsSep = True
+    index = model.index(0, 3)
+    option = QStyleOptionViewItem()
+    delegate = app.view.itemDelegateForIndex(index)
+    editor = delegate.createEditor(app.view, option, index)
+    editor.setText('1500')
+    delegate.setModelData(editor, model, index)
+    assert type(model.dataContainer[0, 3]) is int
+    assert model.data(index) == '1,500'
+    editor.setText('False')
+    delegate.setModelData(editor, model, index)
+    assert model.dataContainer[0, 3] is False
+    assert model.data(index) == 'False'
+    app.importFile(dirname + '/csv_sample.csv')
+    values = list(model.dataContainer.values())
+    assert any(isinstance(v, str) for v in values)
+    assert all(
+        not isinstance(v, str) or isinstance(parseValue(v), str)
+        for v in values
+        )
+    app.createNew()
+
+
+def test_styleColumn(app, tmp_path):
+    view = app.view
+    model = view.model()
+    sModel = view.selectionModel()
+    app.calculate('np.arange(3)', 0, 1)
+    sModel.select(
+        QItemSelection(model.index(0, 1), model.index(0, 1)),
+        QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Columns
+        )
+    app.changeFonts(QFont.setBold, True)
+    app.alignRight()
+    assert len(model.fonts) == 1 and len(model.alignmentDict) == 1
+    model.insertRows(model.rowCount(), 10)
+    assert model.data(model.index(model.rowCount() - 1, 1), Qt.FontRole).bold()
+    assert not model.data(model.index(0, 2), Qt.FontRole).bold()
+    app.saveFileAs(str(tmp_path / 'styled'))
+    app.createNew()
+    app.loadFile(str(tmp_path / 'styled.vnp'))
+    assert model.fonts[10 ** 5, 1].bold()
+    assert model.alignmentDict[2, 1] & Qt.AlignRight
+    app.createNew()
+
+
+def test_stylePalette(app, tmp_path):
+    view = app.view
+    model = view.model()
+    sModel = view.selectionModel()
+    for row in (0, 2):
+        sModel.select(
+            model.index(row, row),
+            QItemSelectionModel.ClearAndSelect
+            )
+        app.changeFonts(QFont.setItalic, True)
+    italic = model.data(model.index(0, 0), Qt.FontRole)
+    assert italic.italic()
+    assert model.data(model.index(2, 2), Qt.FontRole) is italic
+    app.saveFileAs(str(tmp_path / 'palette'))
+    app.createNew()
+    app.loadFile(str(tmp_path / 'palette.vnp'))
+    italic = model.fonts[0, 0]
+    assert italic.italic() and model.fonts[2, 2] is italic
+    assert model.fonts.points[0, 0][1] == model.fonts.points[2, 2][1]
+    app.createNew()
+
+
+def test_mapCells(app, tmp_path):
+    model = app.view.model()
+    app.calculate('np.arange(6).reshape(3, 2)', 0, 0)
+    app.mapAction.toggled.disconnect(app.mapCells)
+    app.mapAction.setChecked(True)
+    app.mapAction.toggled.connect(app.mapCells)
+    app.mapCells(True, str(tmp_path))
+    assert isinstance(model.store.tile(0, 0).values, np.memmap)
+    app.calculate('[A1:B3].sum()', 0, 3)
+    assert model.dataContainer[0, 3] == 15
+    app.createNew()
+    app.calculate('7', 0, 0)
+    assert isinstance(model.store.tile(0, 0).values, np.memmap)
+    app.mapAction.setChecked(False)
+    assert type(model.store.tile(0, 0).values) is np.ndarray
+    app.createNew()
+
+
+def test_residentTiles(app):
+    model = app.view.model()
+    app.setResidentTiles(1)
+    app.calculate('np.arange(600).reshape(300, 2)', 0, 0)
+    app.calculate('[A1:B300].sum()', 0, 3)
+    assert model.dataContainer[0, 3] == 179700
+    app.profilerPanel.refresh()
+    assert 'evictions' in app.profilerPanel.tilesLabel.text()
+    assert model.store.tiles.counters['misses'] > 0
+    app.createNew()
+    assert model.store.tiles.resident == 1
+    app.setResidentTiles(0)
+    assert type(model.store.tiles) is dict